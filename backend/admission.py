@@ -0,0 +1,93 @@
+import math
+import threading
+import time
+
+
+class AdmissionRejected(Exception):
+    """Raised when a generation request would exceed the server's capacity"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Bounded admission for generation requests.
+
+    A request holds a slot from the moment its handler starts until its
+    response (or stream) is finished. It is rejected up front when its
+    endpoint is at its concurrency limit or when max_pending requests are
+    already admitted, so queue wait stays bounded instead of growing with
+    the load. Retry-After is estimated from how long recent requests to the
+    same endpoint held their slot.
+    """
+
+    def __init__(self, max_pending=32, limits=None, max_retry_after=60):
+        self.max_pending = max_pending
+        self.limits = dict(limits or {})
+        self.max_retry_after = max_retry_after
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._hold_seconds = {}  # moving average of slot hold time per endpoint
+        self.stats = {
+            "admitted": 0,
+            "rejected": 0,
+            "rejected_endpoint_limit": 0,
+            "rejected_queue_full": 0,
+            "peak_pending": 0,
+        }
+
+    def limit(self, endpoint):
+        return self.limits.get(endpoint, self.max_pending)
+
+    def acquire(self, endpoint):
+        """Take a slot for endpoint and return a function that releases it; raises AdmissionRejected at capacity"""
+        with self._lock:
+            running = self._in_flight.get(endpoint, 0)
+            pending = sum(self._in_flight.values())
+            if running >= self.limit(endpoint):
+                self.stats["rejected_endpoint_limit"] += 1
+                reason = f"{endpoint} is at its concurrency limit ({self.limit(endpoint)} requests)"
+            elif pending >= self.max_pending:
+                self.stats["rejected_queue_full"] += 1
+                reason = f"Server is at capacity ({self.max_pending} generation requests in progress)"
+            else:
+                self._in_flight[endpoint] = running + 1
+                self.stats["admitted"] += 1
+                self.stats["peak_pending"] = max(self.stats["peak_pending"], pending + 1)
+                return self._releaser(endpoint)
+            self.stats["rejected"] += 1
+            retry_after = self._retry_after(endpoint)
+        raise AdmissionRejected(reason, retry_after)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                max_pending=self.max_pending,
+                pending=sum(self._in_flight.values()),
+                in_flight={endpoint: count for endpoint, count in self._in_flight.items() if count},
+                limits=dict(self.limits),
+            )
+
+    def _releaser(self, endpoint):
+        acquired = time.perf_counter()
+        released = []
+
+        def release():
+            held = time.perf_counter() - acquired
+            with self._lock:
+                # Idempotent: streamed responses release on close, which may follow an error path
+                if released:
+                    return
+                released.append(held)
+                self._in_flight[endpoint] -= 1
+                average = self._hold_seconds.get(endpoint)
+                self._hold_seconds[endpoint] = held if average is None else 0.8 * average + 0.2 * held
+
+        return release
+
+    def _retry_after(self, endpoint):
+        # A slot frees up roughly once per average hold time; whole seconds, as the header requires
+        return max(1, min(self.max_retry_after, math.ceil(self._hold_seconds.get(endpoint, 1.0))))
@@ -0,0 +1,313 @@
+import importlib.util
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+from transformers import DynamicCache, StaticCache
+
+logger = logging.getLogger(__name__)
+
+# eager: the model's forward pass as is (the default)
+# compiled: decode steps run a torch.compile'd graph over a preallocated static KV cache
+# onnx: decode steps run an exported ONNX graph on ONNX Runtime (CPU, fp32)
+BACKENDS = ("eager", "compiled", "onnx")
+
+# Cache lengths (prompt + output tokens) the compiled backend builds static caches for
+DEFAULT_STATIC_LENGTHS = (512, 1024, 2048)
+
+
+def check_backend(backend, device, precision="fp32"):
+    """Raise ValueError if an inference backend is unknown or cannot run with this device / precision / install"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}. Expected one of: {', '.join(BACKENDS)}")
+    if backend == "compiled" and precision == "int8-dynamic":
+        raise ValueError("The compiled backend does not support int8-dynamic quantization")
+    if backend == "onnx":
+        if device != "cpu" or precision != "fp32":
+            raise ValueError("The onnx backend runs fp32 models on CPU only")
+        for package in ("onnx", "onnxscript", "onnxruntime"):
+            if importlib.util.find_spec(package) is None:
+                raise ValueError(f"The onnx backend needs {package}: pip install onnx onnxscript onnxruntime")
+
+
+def create_backend(backend, model, device, precision="fp32", max_batch_size=8,
+                   static_lengths=DEFAULT_STATIC_LENGTHS, onnx_path=None):
+    """Build the named backend around a loaded model"""
+    check_backend(backend, device, precision)
+    if backend == "compiled":
+        return CompiledBackend(model, device, max_batch_size, static_lengths)
+    if backend == "onnx":
+        return OnnxBackend(model, device, onnx_path)
+    return EagerBackend(model, device)
+
+
+class EagerBackend:
+    """
+    Runs the forward passes of the generation engine.
+
+    forward() serves prefills and speculative verification (any number of
+    new tokens, optional cache); decode() serves the batched one-token steps,
+    the hot loop the other backends replace. Both take and return KV caches
+    in the legacy tuple format the engine keeps between steps.
+    """
+
+    name = "eager"
+
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.stats = {"decode_steps": 0, "decode_seconds": 0.0, "warmup_seconds": 0.0}
+
+    def forward(self, input_ids, past=None, attention_mask=None, position_ids=None):
+        """Run input_ids after the cached tokens in past; returns (logits, legacy cache)"""
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=DynamicCache.from_legacy_cache(past) if past is not None else None,
+            use_cache=True,
+        )
+        return outputs.logits, outputs.past_key_values.to_legacy_cache()
+
+    def decode(self, input_ids, past, attention_mask, position_ids):
+        """One decode step for a left-padded batch: input_ids [batch, 1], attention_mask covering past + 1"""
+        start = time.perf_counter()
+        logits, cache = self._decode(input_ids, past, attention_mask, position_ids)
+        self.stats["decode_steps"] += 1
+        self.stats["decode_seconds"] += time.perf_counter() - start
+        return logits, cache
+
+    def warmup(self):
+        """Pay one-time compile / export costs before the first request"""
+
+    def snapshot(self):
+        return dict(self.stats)
+
+    def _decode(self, input_ids, past, attention_mask, position_ids):
+        return self.forward(input_ids, past, attention_mask, position_ids)
+
+
+class CompiledBackend(EagerBackend):
+    """
+    Decode steps through torch.compile over a preallocated static KV cache.
+
+    The batch is padded up to a power-of-two bucket (up to max_batch_size)
+    and its cache into a StaticCache of the smallest static length that fits,
+    so every step of a bucket has the same shapes and reuses one compiled
+    graph; the new token's keys and values are written in place instead of
+    concatenated. The cache returned to the engine is a view of the static
+    buffer, so it is only copied in when the batch changes (a request joins
+    or leaves) or outgrows its length bucket. One static cache is kept at a
+    time. Steps longer than the largest static length decode eagerly.
+    Prefills and speculative verification stay eager.
+    """
+
+    name = "compiled"
+
+    def __init__(self, model, device, max_batch_size=8, static_lengths=DEFAULT_STATIC_LENGTHS):
+        super().__init__(model, device)
+        self.batch_sizes = sorted({min(1 << i, max_batch_size) for i in range(max_batch_size.bit_length() + 1)})
+        self.static_lengths = sorted(static_lengths)
+        # Every (batch, length) bucket is a separate graph
+        buckets = len(self.batch_sizes) * len(self.static_lengths)
+        torch._dynamo.config.recompile_limit = max(torch._dynamo.config.recompile_limit, buckets)
+        self._step = torch.compile(self._static_forward, dynamic=False)
+        self._static = None
+        self._shape = None
+        self._view = None
+        self.stats.update(static_cache_allocations=0, static_cache_copies=0, eager_decode_steps=0)
+
+    def warmup(self):
+        """Compile the graph of every (batch, length) bucket, so no request waits for a compile"""
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for total in self.static_lengths:
+                for batch in self.batch_sizes:
+                    self._decode(
+                        torch.zeros(batch, 1, dtype=torch.long, device=self.device),
+                        self._empty_cache(batch, total - 1),
+                        torch.ones(batch, total, dtype=torch.long, device=self.device),
+                        torch.full((batch, 1), total - 1, dtype=torch.long, device=self.device),
+                    )
+        self._static, self._shape, self._view = None, None, None
+        self.stats["warmup_seconds"] += time.perf_counter() - start
+        logger.info(f"Compiled {len(self.batch_sizes) * len(self.static_lengths)} decode graphs "
+                    f"(batch sizes {self.batch_sizes}, cache lengths {self.static_lengths}) in {self.stats['warmup_seconds']:.1f}s")
+
+    def _decode(self, input_ids, past, attention_mask, position_ids):
+        rows, length = attention_mask.shape
+        batch = next(size for size in self.batch_sizes if size >= rows)
+        total = next((size for size in self.static_lengths if size >= length), None)
+        if total is None:
+            self.stats["eager_decode_steps"] += 1
+            return self.forward(input_ids, past, attention_mask, position_ids)
+
+        if self._shape != (batch, total):
+            self._static = StaticCache(
+                self.model.config, max_batch_size=batch, max_cache_len=total,
+                device=self.device, dtype=past[0][0].dtype
+            )
+            self._shape, self._view = (batch, total), None
+            self.stats["static_cache_allocations"] += 1
+        if past is not self._view:
+            for layer, (key, value) in enumerate(past):
+                self._static.key_cache[layer][:rows, :, :length - 1].copy_(key)
+                self._static.value_cache[layer][:rows, :, :length - 1].copy_(value)
+            self.stats["static_cache_copies"] += 1
+
+        # Padding rows attend to their first slot only, so they stay finite and never affect real rows
+        ids = input_ids.new_zeros(batch, 1)
+        ids[:rows] = input_ids
+        positions = position_ids.new_zeros(batch, 1)
+        positions[:rows] = position_ids
+        mask = attention_mask.new_zeros(batch, total)
+        mask[:rows, :length] = attention_mask
+        mask[rows:, 0] = 1
+        cache_position = torch.tensor([length - 1], device=self.device)
+
+        logits = self._step(self._static, ids, mask, positions, cache_position)
+        self._view = tuple(
+            (key[:rows, :, :length], value[:rows, :, :length])
+            for key, value in zip(self._static.key_cache, self._static.value_cache)
+        )
+        return logits[:rows], self._view
+
+    def _static_forward(self, cache, input_ids, attention_mask, position_ids, cache_position):
+        return self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=cache,
+            cache_position=cache_position,
+            use_cache=True,
+        ).logits
+
+    def _empty_cache(self, batch, length):
+        config = self.model.config
+        heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        dtype = next(self.model.parameters()).dtype
+        return tuple(
+            (torch.zeros(batch, heads, length, head_dim, dtype=dtype, device=self.device),) * 2
+            for _ in range(config.num_hidden_layers)
+        )
+
+
+class _ExportCache(DynamicCache):
+    """DynamicCache without the emptiness checks (len() of a tensor) that would pin the batch size in an export"""
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+        self.key_cache[layer_idx] = torch.cat([self.key_cache[layer_idx], key_states], dim=-2)
+        self.value_cache[layer_idx] = torch.cat([self.value_cache[layer_idx], value_states], dim=-2)
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def get_seq_length(self, layer_idx=0):
+        return self.key_cache[layer_idx].shape[-2]
+
+
+class _DecodeStep(torch.nn.Module):
+    """One decode step with the KV cache as flat tensors in and out, the shape an ONNX graph needs"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, past):
+        cache = _ExportCache()
+        cache.key_cache, cache.value_cache = list(past[0::2]), list(past[1::2])
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+            past_key_values=cache, use_cache=True,
+        )
+        return (outputs.logits,) + tuple(tensor for layer in outputs.past_key_values.to_legacy_cache() for tensor in layer)
+
+
+def export_onnx_decoder(model, path):
+    """Export the model's decode step to path (with dynamic batch and cache length) unless it already exists"""
+    if os.path.exists(path):
+        return path
+    start = time.perf_counter()
+    layers = model.config.num_hidden_layers
+    past_names = [f"past_{layer}_{kind}" for layer in range(layers) for kind in ("key", "value")]
+    batch, length = torch.export.Dim("batch"), torch.export.Dim("past")
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # Export into a scratch directory next to the target and move the files over, so a reader never
+    # sees a partly written graph; the graph refers to its weights file by name, so the names stay
+    scratch = tempfile.mkdtemp(dir=directory)
+    partial = os.path.join(scratch, os.path.basename(path))
+    with torch.no_grad():
+        # Example sizes of 1 would be specialized as constants, so the example batch has two rows
+        _, example_past = EagerBackend(model, "cpu").forward(torch.ones(2, 2, dtype=torch.long))
+        example = (torch.ones(2, 1, dtype=torch.long), torch.ones(2, 3, dtype=torch.long),
+                   torch.full((2, 1), 2, dtype=torch.long), [tensor for layer in example_past for tensor in layer])
+        torch.onnx.export(
+            _DecodeStep(model).eval(), example, partial, dynamo=True,
+            input_names=["input_ids", "attention_mask", "position_ids"] + past_names,
+            output_names=["logits"] + [name.replace("past", "present") for name in past_names],
+            dynamic_shapes=({0: batch}, {0: batch, 1: torch.export.Dim("total")}, {0: batch},
+                            [{0: batch, 2: length}] * len(past_names)),
+        )
+    if os.path.exists(f"{partial}.data"):
+        os.replace(f"{partial}.data", f"{path}.data")
+    os.replace(partial, path)
+    shutil.rmtree(scratch, ignore_errors=True)
+    logger.info(f"Exported ONNX decode graph to {path} in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+class OnnxBackend(EagerBackend):
+    """
+    Decode steps through an exported ONNX graph on ONNX Runtime.
+
+    The graph takes the batch's KV cache as inputs and returns it extended by
+    one token, with dynamic batch and cache lengths, so one export serves
+    every step. It is exported on first use (or at warmup) and reused from
+    onnx_path afterwards; delete the file after changing the model. Tensors
+    are handed over as numpy arrays without copies when contiguous.
+    Prefills and speculative verification stay eager.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model, device, onnx_path):
+        super().__init__(model, device)
+        self.onnx_path = onnx_path
+        self._session = None
+
+    def warmup(self):
+        start = time.perf_counter()
+        self._load()
+        with torch.inference_mode():
+            self._decode(
+                torch.zeros(1, 1, dtype=torch.long), self.forward(torch.tensor([[1, 1]]))[1],
+                torch.ones(1, 3, dtype=torch.long), torch.full((1, 1), 2, dtype=torch.long),
+            )
+        self.stats["warmup_seconds"] += time.perf_counter() - start
+
+    def _load(self):
+        if self._session is None:
+            import onnxruntime
+            export_onnx_decoder(self.model, self.onnx_path)
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            self._session = onnxruntime.InferenceSession(
+                self.onnx_path, options, providers=["CPUExecutionProvider"]
+            )
+            self._past_names = [entry.name for entry in self._session.get_inputs()[3:]]
+        return self._session
+
+    def _decode(self, input_ids, past, attention_mask, position_ids):
+        session = self._load()
+        feeds = {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy(),
+            "position_ids": position_ids.numpy(),
+        }
+        tensors = [tensor for layer in past for tensor in layer]
+        feeds.update({name: tensor.contiguous().numpy() for name, tensor in zip(self._past_names, tensors)})
+        logits, *present = (torch.from_numpy(array) for array in session.run(None, feeds))
+        return logits, tuple(zip(present[0::2], present[1::2]))
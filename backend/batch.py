@@ -0,0 +1,139 @@
+"""
+Run a JSONL file of jobs through the backend in bulk.
+
+Each line is {"id": ..., "endpoint": "/optimize", "body": {...}}; "request_id"
+works as the id key too, and lines without one are numbered. Jobs run
+shortest prompt first, so the requests decoding together have similar
+lengths and little padding, with as many in flight as the engine batches.
+They run at low priority, so live editor requests are admitted first.
+
+Results are appended to --output as JSONL as they finish, and that file is
+the checkpoint: rerunning the same command skips every job that already
+has a successful result there.
+
+    MODEL_PATH=./Deepseek-Instruct python batch.py jobs.jsonl --output results.jsonl
+    python batch.py jobs.jsonl --output results.jsonl --url http://127.0.0.1:5000
+"""
+import argparse
+import json
+import os
+import threading
+import urllib.request
+
+# Routes a batch job may target; /generate is left out because chat turns depend on their order
+BATCH_ENDPOINTS = ("/complete", "/hf-complete", "/fill_in_the_middle", "/debug", "/optimize", "/analyze_multi")
+
+
+def parse_jobs(items):
+    """Validate job dicts (or JSONL lines) and give each an "id"; raises ValueError on the first bad job"""
+    jobs, seen = [], set()
+    for number, item in enumerate(items, 1):
+        if isinstance(item, str):
+            if not item.strip():
+                continue
+            try:
+                item = json.loads(item)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Job {number} is not valid JSON: {e}")
+        if not isinstance(item, dict):
+            raise ValueError(f"Job {number} must be an object")
+        job_id = str(item.get("id") or item.get("request_id") or number)
+        if job_id in seen:
+            raise ValueError(f"Duplicate job id {job_id}")
+        if item.get("endpoint") not in BATCH_ENDPOINTS:
+            raise ValueError(f"Job {job_id}: endpoint must be one of {', '.join(BATCH_ENDPOINTS)}")
+        if not isinstance(item.get("body"), dict):
+            raise ValueError(f'Job {job_id}: missing "body" object')
+        seen.add(job_id)
+        jobs.append({"id": job_id, "endpoint": item["endpoint"], "body": item["body"]})
+    return jobs
+
+
+def job_text(job):
+    """The prompt text of a job, used to order jobs by length"""
+    body = job["body"]
+    if isinstance(body.get("selections"), list):
+        return "\n".join(str(s.get("text", "")) for s in body["selections"] if isinstance(s, dict))
+    return str(body.get("text") or body.get("code") or body.get("prompt") or "")
+
+
+class BatchCheckpoint:
+    """
+    Append-only JSONL file of job results.
+
+    Jobs with a 200 result in the file count as completed, so a rerun can
+    skip them; failed jobs are retried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # a line cut short when the previous run was interrupted
+                    if result.get("status") == 200:
+                        self.completed.add(result["id"])
+
+    def record(self, result):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+            if result.get("status") == 200:
+                self.completed.add(result["id"])
+
+
+def run_remote(url, jobs):
+    """POST jobs to a running server's /batch and yield the streamed result lines"""
+    request = urllib.request.Request(
+        url.rstrip("/") + "/batch", data=json.dumps({"jobs": jobs}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            if line.strip():
+                yield json.loads(line)
+
+
+def run_local(jobs):
+    """Load the model in this process and run the jobs through the server's batch runner"""
+    import server
+    server.model_manager.load()
+    if not server.model_manager.wait_ready():
+        raise RuntimeError(f"Model failed to load: {server.model_manager.error}")
+    yield from server.run_batch(jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of jobs through the backend in bulk")
+    parser.add_argument("jobs", help='JSONL file of {"id", "endpoint", "body"} jobs')
+    parser.add_argument("--output", required=True, help="JSONL results file, also used as the resume checkpoint")
+    parser.add_argument("--url", help="Send the jobs to a running server instead of loading the model here")
+    args = parser.parse_args()
+
+    with open(args.jobs) as f:
+        jobs = parse_jobs(f)
+    checkpoint = BatchCheckpoint(args.output)
+    remaining = [job for job in jobs if job["id"] not in checkpoint.completed]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(remaining)} already completed, running {len(remaining)}")
+    if not remaining:
+        return
+
+    failed = 0
+    results = run_remote(args.url, remaining) if args.url else run_local(remaining)
+    for result in results:
+        if result.get("done"):
+            continue
+        checkpoint.record(result)
+        failed += result.get("status") != 200
+        print(f"{result['id']}: {result['status']}")
+    print(f"Finished: {len(checkpoint.completed)} of {len(jobs)} jobs completed, {failed} failed this run")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+"""
+Replay a JSONL workload against the backend and report latency and throughput.
+
+Each workload line is {"endpoint": "/complete", "body": {...}} with an
+optional "at" (seconds from the start). Lines without "at" either arrive as a
+Poisson process at --rate requests/sec, or, when --rate is 0, are sent
+back-to-back by --concurrency workers. With a rate the load is open-loop:
+every request is sent at its arrival time however many are still in flight,
+and its latency and time-to-first-token count from that arrival time, so a
+backed-up server can't hide its queueing delay (coordinated omission).
+
+By default the Flask app is imported and driven in-process, so a CPU-only box
+with no network only needs a local model (see make_tiny_model.py):
+
+    MODEL_PATH=./tiny-model python benchmark.py --synthetic 200 --concurrency 8 --stream
+    python benchmark.py --url http://127.0.0.1:5000 --workload jobs.jsonl --rate 5
+
+The report has p50/p95/p99 latency and time-to-first-token per endpoint.
+Throughput (generated tokens/sec), mean queue wait and mean decode step time
+come from the engine's /stats counters.
+
+--workers replays the same workload once per worker-pool size (MODEL_WORKERS),
+each in a fresh process, and reports how throughput scales:
+
+    MODEL_PATH=./tiny-model python benchmark.py --synthetic 200 --concurrency 16 --workers 1,2,4
+
+--backends does the same per inference backend (INFERENCE_BACKEND), to compare
+decode step time and latency of eager, compiled and ONNX Runtime decoding:
+
+    MODEL_PATH=./tiny-model python benchmark.py --synthetic 200 --concurrency 8 --backends eager,compiled,onnx
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+STREAMABLE_ENDPOINTS = ("/generate", "/complete", "/debug", "/optimize")
+
+SNIPPETS = [
+    "def binary_search(items, target):\n    low, high = 0, len(items) - 1\n    while low <= high:\n"
+    "        middle = (low + high) // 2\n        if items[middle] == target:\n            return middle\n",
+    "class Cache:\n    def __init__(self, capacity):\n        self.capacity = capacity\n        self.entries = {}\n\n"
+    "    def get(self, key):\n        return self.entries.get(key)\n",
+    "function groupBy(items, key) {\n    const groups = {};\n    for (const item of items) {\n"
+    "        (groups[item[key]] ||= []).push(item);\n    }\n    return groups;\n}\n",
+]
+
+CHAT_PROMPTS = [
+    "How do I read a file line by line in Python?",
+    "Can you show the same with a context manager?",
+    "What is the time complexity of sorting a list?",
+    "Explain list comprehensions with an example.",
+]
+
+
+def synthetic_workload(count, seed=0):
+    """
+    A mixed editor workload: /hf-complete keystroke bursts on one document,
+    one-off /complete and /optimize calls, and multi-turn /generate chats.
+    """
+    rng = random.Random(seed)
+    jobs = []
+    while len(jobs) < count:
+        kind = rng.random()
+        snippet = rng.choice(SNIPPETS)
+        language = "JavaScript" if snippet.startswith("function") else "Python"
+        if kind < 0.6:
+            # A burst of keystrokes: each request extends the previous prefix and supersedes it
+            document = f"file{rng.randrange(1000)}"
+            cut = rng.randrange(20, len(snippet) - 10)
+            for step in range(5):
+                jobs.append({"endpoint": "/hf-complete", "burst": step, "body": {
+                    "code": snippet[:cut + step * 2], "languageName": language,
+                    "clientId": "bench", "documentId": document,
+                }})
+        elif kind < 0.75:
+            jobs.append({"endpoint": "/complete", "body": {"text": snippet, "languageName": language}})
+        elif kind < 0.85:
+            jobs.append({"endpoint": "/optimize", "body": {"text": snippet, "languageName": language}})
+        else:
+            session = f"chat{rng.randrange(1000)}"
+            for prompt in rng.sample(CHAT_PROMPTS, 2):
+                jobs.append({"endpoint": "/generate", "body": {"prompt": prompt, "sessionId": session}})
+    return jobs[:count]
+
+
+def schedule(jobs, rate, seed=0):
+    """Assign Poisson arrival times to jobs without "at"; keystrokes after the first in a burst follow 50ms apart"""
+    rng = random.Random(seed)
+    clock = 0.0
+    for job in jobs:
+        if "at" in job:
+            clock = job["at"]
+            continue
+        clock += 0.05 if job.get("burst") else rng.expovariate(rate)
+        job["at"] = clock
+    return sorted(jobs, key=lambda job: job["at"])
+
+
+class InProcessClient:
+    """Drives the Flask app directly through its test client"""
+
+    def __init__(self):
+        import server
+        server.model_manager.load()
+        if not server.model_manager.wait_ready():
+            raise RuntimeError(f"Model failed to load: {server.model_manager.error}")
+        self.app = server.app
+        self._local = threading.local()
+
+    def post(self, endpoint, body):
+        """Send one request; returns the status and perf_counter() times of the first chunk (or None) and the end"""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.post(endpoint, json=body, buffered=False)
+        first = None
+        try:
+            for chunk in response.response:
+                if first is None and chunk.strip():
+                    first = time.perf_counter()
+        finally:
+            response.close()
+        return response.status_code, first, time.perf_counter()
+
+    def get_json(self, path):
+        return self.app.test_client().get(path).get_json()
+
+
+class HttpClient:
+    """Talks to a running server over HTTP"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def post(self, endpoint, body):
+        request = urllib.request.Request(
+            self.url + endpoint, data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        first = None
+        try:
+            with urllib.request.urlopen(request) as response:
+                status = response.status
+                for line in response:
+                    if first is None and line.strip():
+                        first = time.perf_counter()
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status, first, time.perf_counter()
+
+    def get_json(self, path):
+        with urllib.request.urlopen(self.url + path) as response:
+            return json.loads(response.read())
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    values = sorted(values)
+
+    def rank(q):
+        return round(values[min(int(q * len(values)), len(values) - 1)] * 1000, 2)
+
+    return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99)}
+
+
+def run(client, jobs, concurrency=4, rate=0.0, stream=False):
+    """Send every job and return one result dict per request plus the wall time"""
+    results = []
+    lock = threading.Lock()
+
+    def send(job):
+        body = dict(job["body"])
+        if stream and job["endpoint"] in STREAMABLE_ENDPOINTS:
+            body["stream"] = "jsonl"
+        # Open loop: timed from when the request was due, not from when a thread got round to sending it
+        sent = start + job["at"] if rate > 0 else time.perf_counter()
+        status, first, finished = client.post(job["endpoint"], body)
+        latency = finished - sent
+        first = first - sent if first is not None else None
+        with lock:
+            results.append({
+                "endpoint": job["endpoint"],
+                "status": status,
+                "latency": latency,
+                # Non-streaming responses arrive in one piece
+                "ttft": first if first is not None and "stream" in body else latency,
+            })
+
+    start = time.perf_counter()
+    # Closed loop: concurrency senders back to back. Open loop: a sender per request, never capping in-flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(jobs), 1) if rate > 0 else concurrency) as pool:
+        futures = []
+        for job in (schedule(jobs, rate) if rate > 0 else jobs):
+            if rate > 0:
+                time.sleep(max(0.0, job["at"] - (time.perf_counter() - start)))
+            futures.append(pool.submit(send, job))
+        for future in futures:
+            future.result()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, wall_seconds, engine_before, engine_after):
+    by_endpoint = collections.defaultdict(list)
+    for result in results:
+        by_endpoint[result["endpoint"]].append(result)
+
+    endpoints = {}
+    for endpoint, rows in sorted(by_endpoint.items()):
+        ok = [r for r in rows if r["status"] == 200]
+        endpoints[endpoint] = {
+            "requests": len(rows),
+            "status": dict(collections.Counter(r["status"] for r in rows)),
+            "latency_ms": percentiles([r["latency"] for r in ok]),
+            "ttft_ms": percentiles([r["ttft"] for r in ok]),
+        }
+
+    delta = {key: engine_after.get(key, 0) - engine_before.get(key, 0) for key in engine_after
+             if isinstance(engine_after[key], (int, float))}
+    started = delta.get("requests_started", 0)
+    backend_steps = delta.get("backend_decode_steps", 0)
+    return {
+        "requests": len(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "requests_per_second": round(len(results) / wall_seconds, 2) if wall_seconds else 0.0,
+        "generated_tokens": delta.get("generated_tokens", 0),
+        "tokens_per_second": round(delta.get("generated_tokens", 0) / wall_seconds, 2) if wall_seconds else 0.0,
+        "mean_queue_wait_ms": round(delta.get("queue_wait_seconds", 0) * 1000 / started, 2) if started else 0.0,
+        "decode_steps": delta.get("decode_steps", 0),
+        "mean_decode_step_ms": round(delta.get("backend_decode_seconds", 0) * 1000 / backend_steps, 3) if backend_steps else 0.0,
+        "max_batch_seen": engine_after.get("max_batch_seen"),
+        "endpoints": endpoints,
+    }
+
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report['wall_seconds']}s "
+          f"({report['requests_per_second']} req/s, {report['tokens_per_second']} tok/s, "
+          f"mean queue wait {report['mean_queue_wait_ms']} ms, mean decode step {report['mean_decode_step_ms']} ms)")
+    print(f"{'endpoint':<22}{'n':>6}{'p50':>10}{'p95':>10}{'p99':>10}{'ttft p50':>10}{'ttft p95':>10}  status")
+    for endpoint, row in report["endpoints"].items():
+        latency, ttft = row["latency_ms"], row["ttft_ms"]
+        print(f"{endpoint:<22}{row['requests']:>6}{str(latency['p50']):>10}{str(latency['p95']):>10}"
+              f"{str(latency['p99']):>10}{str(ttft['p50']):>10}{str(ttft['p95']):>10}  {row['status']}")
+
+
+def compare(key, variable, values, workload_path, argv):
+    """Run this benchmark in a fresh process per value of an environment variable and collect the reports"""
+    reports = []
+    for value in values:
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            command = [sys.executable, os.path.abspath(__file__), "--workload", workload_path, "--output", output.name] + argv
+            subprocess.run(command, env=dict(os.environ, **{variable: str(value)}), check=True)
+            with open(output.name) as f:
+                reports.append(dict(json.load(f), **{key: value}))
+    return reports
+
+
+def print_comparison(reports, key):
+    base = reports[0]["tokens_per_second"] or 1.0
+    print(f"{key:>10}{'tok/s':>10}{'req/s':>10}{'speedup':>10}{'step ms':>10}{'p50 ms (all)':>14}{'p95 ms (all)':>14}")
+    for report in reports:
+        rows = report["endpoints"].values()
+        p50 = max((row["latency_ms"]["p50"] or 0) for row in rows) if rows else 0
+        p95 = max((row["latency_ms"]["p95"] or 0) for row in rows) if rows else 0
+        print(f"{report[key]:>10}{report['tokens_per_second']:>10}{report['requests_per_second']:>10}"
+              f"{round(report['tokens_per_second'] / base, 2):>10}{report['mean_decode_step_ms']:>10}{p50:>14}{p95:>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a JSONL workload and report latency and throughput")
+    parser.add_argument("--workload", help="JSONL file of {endpoint, body[, at]} jobs")
+    parser.add_argument("--synthetic", type=int, default=0, help="Generate a mixed workload of this many requests")
+    parser.add_argument("--url", help="Benchmark a running server instead of the in-process app")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent senders in closed loop (no --rate)")
+    parser.add_argument("--rate", type=float, default=0.0, help="Poisson arrival rate in requests/sec (0: closed loop)")
+    parser.add_argument("--stream", action="store_true", help="Stream responses from endpoints that support it")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    parser.add_argument("--save-workload", help="Also write the jobs as JSONL to this file (to replay them later)")
+    parser.add_argument("--workers", help="Comma-separated worker-pool sizes to compare, e.g. 1,2,4 (in-process only)")
+    parser.add_argument("--backends", help="Comma-separated inference backends to compare, e.g. eager,compiled,onnx "
+                                           "(in-process only)")
+    args = parser.parse_args()
+
+    if args.workload:
+        with open(args.workload) as f:
+            jobs = [json.loads(line) for line in f if line.strip()]
+    elif args.synthetic:
+        jobs = synthetic_workload(args.synthetic, args.seed)
+    else:
+        parser.error("Provide --workload or --synthetic")
+    if args.save_workload:
+        with open(args.save_workload, "w") as f:
+            f.writelines(json.dumps(job) + "\n" for job in jobs)
+
+    if args.workers or args.backends:
+        if args.url:
+            parser.error("--workers and --backends start their own servers and can't be combined with --url")
+        if args.workers and args.backends:
+            parser.error("Compare either --workers or --backends, not both")
+        if args.workers:
+            key, variable, values = "workers", "MODEL_WORKERS", [int(n) for n in args.workers.split(",")]
+        else:
+            key, variable, values = "backend", "INFERENCE_BACKEND", args.backends.split(",")
+        # Every run replays the identical jobs, so the reports differ only in the compared setting
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl") as workload:
+            workload.writelines(json.dumps(job) + "\n" for job in jobs)
+            workload.flush()
+            argv = ["--concurrency", str(args.concurrency), "--rate", str(args.rate), "--seed", str(args.seed)]
+            reports = compare(key, variable, values, workload.name, argv + ["--stream"] * args.stream)
+        print_comparison(reports, key)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(reports, f, indent=2)
+        return
+
+    client = HttpClient(args.url) if args.url else InProcessClient()
+    engine_before = client.get_json("/stats")["engine"]
+    results, wall_seconds = run(client, jobs, args.concurrency, args.rate, args.stream)
+    engine_after = client.get_json("/stats")["engine"]
+
+    report = summarize(results, wall_seconds, engine_before, engine_after)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import bisect
+import collections
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Characters outside the Basic Multilingual Plane take two UTF-16 code units (a surrogate pair)
+ASTRAL_PATTERN = re.compile("[\U00010000-\U0010FFFF]")
+
+
+class DocumentVersionError(Exception):
+    """Raised when an edit does not apply to the server's copy of the document"""
+
+
+def utf16_starts(text):
+    """UTF-16 offsets at which the astral characters of text start, in order"""
+    return [match.start() + number for number, match in enumerate(ASTRAL_PATTERN.finditer(text))]
+
+
+def utf16_to_index(starts, offset):
+    """Convert a UTF-16 code unit offset (as VS Code counts) to a str index, given utf16_starts() of the text"""
+    # Every astral character that ends at or before the offset counts two units but one index
+    return offset - bisect.bisect_right(starts, offset - 2)
+
+
+def split_chunks(text, max_lines=40):
+    """
+    Split text into content-defined chunks that end after a blank line.
+
+    Chunk boundaries depend only on nearby content, so an edit changes the
+    chunk it lands in and leaves the others (and their cached tokens) intact.
+    """
+    chunks, rest = _split_closed_chunks(text, max_lines)
+    return chunks + [rest] if rest else chunks
+
+
+def _split_closed_chunks(text, max_lines):
+    """split_chunks() without the final chunk when text doesn't end on a chunk boundary; returns (chunks, rest)"""
+    chunks, current, count = [], [], 0
+    for line in text.splitlines(keepends=True):
+        current.append(line)
+        count += 1
+        if (not line.strip() and count > 1) or count >= max_lines:
+            chunks.append("".join(current))
+            current, count = [], 0
+    return chunks, "".join(current)
+
+
+class Document:
+    """Server-side copy of an editor document with per-chunk cached tokenization"""
+
+    def __init__(self, document_id, text, language_name="", file_name="", version=0, max_chunk_lines=40):
+        self.document_id = document_id
+        self.language_name = language_name
+        self.file_name = file_name
+        self.version = version
+        self.max_chunk_lines = max_chunk_lines
+        self.last_used = time.monotonic()
+        self._token_cache = {}
+        self._set_text(text)
+
+    def apply_changes(self, changes):
+        """
+        Apply VS Code style content changes ({rangeOffset, rangeLength, text}) in order.
+
+        Offsets and lengths count UTF-16 code units, as the editor does. If any
+        change is invalid, none of them are applied.
+        """
+        # Edits replace these rather than change them in place, so keeping the references is enough to roll back
+        state = self.text, self._utf16_starts, self.chunks, self.chunk_starts
+        try:
+            for change in changes:
+                offset = change.get("rangeOffset") if isinstance(change, dict) else None
+                length = change.get("rangeLength", 0) if isinstance(change, dict) else None
+                if not isinstance(offset, int) or not isinstance(length, int):
+                    raise ValueError("Each change needs integer rangeOffset and rangeLength fields")
+                if not isinstance(change.get("text", ""), str):
+                    raise ValueError("Each change needs a string text field")
+                if offset < 0 or length < 0 or offset + length > len(self.text) + len(self._utf16_starts):
+                    raise DocumentVersionError(f"Edit range {offset}+{length} is outside the document")
+                self._replace(offset, length, change.get("text", ""))
+        except Exception:
+            self.text, self._utf16_starts, self.chunks, self.chunk_starts = state
+            raise
+
+    def char_index(self, offset):
+        """The str index of a UTF-16 offset into the document (e.g. the editor's cursor), clamped to the text"""
+        return max(0, min(utf16_to_index(self._utf16_starts, offset), len(self.text)))
+
+    def _replace(self, offset, length, inserted):
+        """
+        Replace a UTF-16 range of the text, re-chunking only around it: from the
+        chunk before the edit up to the first old chunk boundary after it where
+        the new split closes a chunk too, since the rest then splits as before.
+        """
+        starts = self._utf16_starts
+        start, end = utf16_to_index(starts, offset), utf16_to_index(starts, offset + length)
+        text = self.text[:start] + inserted + self.text[end:]
+        delta = len(inserted) - (end - start)
+
+        # Astral characters before the edit stay put, those after it move by the change in UTF-16 length
+        # (positions come from the str indices, since an offset inside a surrogate pair is rounded up)
+        before, after = bisect.bisect_left(starts, offset), bisect.bisect_left(starts, offset + length)
+        unit_start, unit_end = start + before, end + after
+        inserted_starts = utf16_starts(inserted)
+        shift = unit_start + len(inserted) + len(inserted_starts) - unit_end
+        self._utf16_starts = (
+            starts[:before]
+            + [unit_start + position for position in inserted_starts]
+            + [position + shift for position in starts[after:]]
+        )
+
+        chunks, chunk_starts = self.chunks, self.chunk_starts
+        # Starting a chunk early keeps a line break the edit joins or splits (\r + \n) inside the re-split text
+        first = max(bisect.bisect_right(chunk_starts, start) - 2, 0)
+        position = chunk_starts[first] if chunks else 0
+        # Old boundaries strictly after the edit have unchanged text on both sides
+        resume = bisect.bisect_right(chunk_starts, end)
+        while True:
+            stop = chunk_starts[resume] + delta if resume < len(chunks) else len(text)
+            new_chunks, rest = _split_closed_chunks(text[position:stop], self.max_chunk_lines)
+            if not rest or resume >= len(chunks):
+                break
+            resume += 1
+        if rest:
+            new_chunks.append(rest)
+        new_starts = []
+        for chunk in new_chunks:
+            new_starts.append(position)
+            position += len(chunk)
+
+        self.text = text
+        self.chunks = chunks[:first] + new_chunks + chunks[resume:]
+        self.chunk_starts = chunk_starts[:first] + new_starts + [chunk_start + delta for chunk_start in chunk_starts[resume:]]
+        # Forget the replaced chunks' tokens (one that also occurs elsewhere is just tokenized again)
+        for chunk in set(chunks[first:resume]).difference(new_chunks):
+            self._token_cache.pop(chunk, None)
+
+    def _set_text(self, text):
+        self.text = text
+        self._utf16_starts = utf16_starts(text)
+        self.chunks = split_chunks(text, self.max_chunk_lines)
+        self.chunk_starts = []
+        offset = 0
+        for chunk in self.chunks:
+            self.chunk_starts.append(offset)
+            offset += len(chunk)
+        # Keep token ids only for chunks that still exist; new chunks are tokenized lazily
+        live = set(self.chunks)
+        self._token_cache = {chunk: ids for chunk, ids in self._token_cache.items() if chunk in live}
+
+
+class DocumentStore:
+    """
+    Per-document state for the incremental sync protocol.
+
+    Clients open a document once and then send edit deltas. Prompts are built
+    from a window of cached chunk tokens around the cursor, so request size
+    and tokenization cost stay roughly constant regardless of file length.
+    Least recently used documents are dropped past max_documents or idle_ttl.
+    """
+
+    def __init__(self, tokenizer, max_documents=256, idle_ttl=3600, max_chunk_lines=40):
+        self.tokenizer = tokenizer
+        self.max_documents = max_documents
+        self.idle_ttl = idle_ttl
+        self.max_chunk_lines = max_chunk_lines
+        self._documents = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "edits": 0, "evicted": 0, "chunks_tokenized": 0, "chunk_cache_hits": 0}
+
+    def open(self, document_id, text, language_name="", file_name="", version=0):
+        document = Document(document_id, text, language_name, file_name, version, self.max_chunk_lines)
+        with self._lock:
+            self._documents.pop(document_id, None)
+            self._documents[document_id] = document
+            self.stats["opened"] += 1
+            self._evict()
+        return document
+
+    def edit(self, document_id, version, changes, base_version=None):
+        with self._lock:
+            document = self._get_locked(document_id)
+            if base_version is not None and base_version != document.version:
+                raise DocumentVersionError(
+                    f"Edit for {document_id} is based on version {base_version}, server has {document.version}"
+                )
+            if version is not None and version <= document.version:
+                raise DocumentVersionError(
+                    f"Stale edit for {document_id}: version {version} <= server version {document.version}"
+                )
+            document.apply_changes(changes)
+            if version is not None:
+                document.version = version
+            self.stats["edits"] += 1
+            return document
+
+    def close(self, document_id):
+        with self._lock:
+            return self._documents.pop(document_id, None) is not None
+
+    def get(self, document_id):
+        with self._lock:
+            return self._get_locked(document_id)
+
+    def build_window(self, document, cursor, token_budget, suffix_ratio=0.0):
+        """
+        Return (prefix_ids, suffix_ids) around a character cursor within token_budget tokens.
+
+        The prefix grows backwards from the cursor in whole chunks, so its first
+        token only moves when the cursor crosses a chunk boundary and the prefix
+        KV cache keeps matching between keystrokes.
+
+        Only the chunk list is read under the lock; edits replace it rather than
+        change it in place, so tokenizing happens outside the lock.
+        """
+        with self._lock:
+            cursor = max(0, min(cursor, len(document.text)))
+            chunks, chunk_starts, token_cache = document.chunks, document.chunk_starts, document._token_cache
+        index = max(bisect.bisect_right(chunk_starts, cursor) - 1, 0)
+        start = chunk_starts[index] if chunks else 0
+        chunk = chunks[index] if chunks else ""
+        head, tail = chunk[:cursor - start], chunk[cursor - start:]
+
+        suffix_budget = int(token_budget * suffix_ratio)
+        prefix_budget = token_budget - suffix_budget
+
+        prefix = self._encode(head)
+        if len(prefix) > prefix_budget:
+            prefix = prefix[len(prefix) - prefix_budget:]
+        for previous in reversed(range(index)):
+            ids = self._chunk_ids(token_cache, chunks[previous])
+            if len(prefix) + len(ids) > prefix_budget:
+                break
+            prefix = ids + prefix
+
+        suffix = []
+        if suffix_budget > 0:
+            suffix = self._encode(tail)
+            for following in range(index + 1, len(chunks)):
+                if len(suffix) >= suffix_budget:
+                    break
+                suffix = suffix + self._chunk_ids(token_cache, chunks[following])
+            suffix = suffix[:suffix_budget]
+        return prefix, suffix
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, open_documents=len(self._documents))
+
+    def _chunk_ids(self, token_cache, chunk):
+        ids = token_cache.get(chunk)
+        if ids is None:
+            ids = self._encode(chunk)
+            with self._lock:
+                token_cache[chunk] = ids
+                self.stats["chunks_tokenized"] += 1
+        else:
+            with self._lock:
+                self.stats["chunk_cache_hits"] += 1
+        return ids
+
+    def _encode(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"] if text else []
+
+    def _get_locked(self, document_id):
+        document = self._documents.get(document_id)
+        if document is None:
+            raise KeyError(document_id)
+        document.last_used = time.monotonic()
+        self._documents.move_to_end(document_id)
+        return document
+
+    def _evict(self):
+        now = time.monotonic()
+        for document_id in [d for d, doc in self._documents.items() if now - doc.last_used > self.idle_ttl]:
+            del self._documents[document_id]
+            self.stats["evicted"] += 1
+        while len(self._documents) > self.max_documents:
+            self._documents.popitem(last=False)
+            self.stats["evicted"] += 1
@@ -0,0 +1,743 @@
+import collections
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+import torch
+
+from backends import EagerBackend
+
+logger = logging.getLogger(__name__)
+
+# Finish reasons for requests that were abandoned rather than completed
+CANCEL_REASONS = ("cancelled", "superseded", "expired")
+
+
+class GenerationCancelled(Exception):
+    """Raised by GenerationRequest.wait() when the request was cancelled or superseded"""
+
+    def __init__(self, req, message=None):
+        super().__init__(message or f"Request {req.request_id} was {req.finish_reason}")
+        self.request_id = req.request_id
+        self.reason = req.finish_reason
+
+
+class GenerationExpired(GenerationCancelled):
+    """Raised by GenerationRequest.wait() when the request's deadline passed before it was prefilled"""
+
+    def __init__(self, req):
+        super().__init__(req, f"Request {req.request_id} expired before generation started")
+
+
+class GenerationRequest:
+    """A single prompt waiting for, or running in, the shared decode loop"""
+
+    def __init__(self, input_ids, max_new_tokens, do_sample=False, temperature=1.0,
+                 top_p=1.0, eos_token_id=None, stream=False, request_id=None,
+                 supersede_key=None, supersede_group=None, stop_hooks=None, seed=None, past=None, keep_cache=False,
+                 draft_tokens=0, draft_ngram=3, priority=0, deadline=None, logprobs=False):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.eos_token_id = eos_token_id
+        # A fixed seed makes sampled output reproducible regardless of what else is in the batch
+        self.seed = seed
+        self.generator = None
+        self.request_id = request_id or uuid.uuid4().hex
+        # Requests sharing a supersede key (client + document) replace each other, except requests
+        # submitted under the same supersede group (e.g. the candidates of one HTTP request)
+        self.supersede_key = supersede_key
+        self.supersede_group = supersede_group
+        # Callables checked between decode steps; a truthy return value stops the request with that reason
+        self.stop_hooks = list(stop_hooks or [])
+        # KV cache (legacy format) covering a prefix of input_ids, e.g. a chat session's earlier turns
+        self.past = past
+        # When set, the finished sequence's KV cache is left in self.cache for the caller to keep
+        self.keep_cache = keep_cache
+        self.cache = None
+        # Prompt-lookup speculative decoding: up to draft_tokens tokens are proposed per step by
+        # matching the last draft_ngram tokens earlier in the prompt/output (0 disables)
+        self.draft_tokens = draft_tokens
+        self.draft_ngram = draft_ngram
+        # Lower values are admitted first, and outrank running requests when the batch is full;
+        # equal priorities go by earliest deadline, then arrival order (0 = interactive)
+        self.priority = priority
+        # Wall-clock time (time.time()) after which the result is useless to the caller: the request
+        # is dropped if it hasn't been prefilled by then, and otherwise returns what it has so far
+        self.deadline = deadline
+        # When set, the model's log-probability of every sampled token is kept in token_logprobs
+        self.logprobs = logprobs
+        self.token_logprobs = []
+
+        self.output_ids = []
+        self.finish_reason = None
+        # Decode steps left unused because the request stopped before max_new_tokens (stop hook or cancel)
+        self.decode_steps_saved = 0
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.prefill_seconds = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        self._stream = queue.Queue() if stream else None
+        self._cancel_reason = None
+        self._callbacks = []
+        self._callback_lock = threading.Lock()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def mean_logprob(self):
+        """Average log-probability of the sampled tokens (requires logprobs=True), used to rank candidates"""
+        if not self.token_logprobs:
+            return float("-inf")
+        return sum(self.token_logprobs) / len(self.token_logprobs)
+
+    def wait(self, timeout=None):
+        """Block until the request has finished and return the generated token ids"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        if self.finish_reason == "expired":
+            raise GenerationExpired(self)
+        if self.finish_reason in CANCEL_REASONS:
+            raise GenerationCancelled(self)
+        return self.output_ids
+
+    def joins(self, latest):
+        """Whether this request belongs to the group of the latest requests for its supersede key"""
+        return bool(latest) and self.supersede_group is not None and latest[0].supersede_group == self.supersede_group
+
+    def add_done_callback(self, callback):
+        """Call callback(request) once the request finishes (immediately if it already has)"""
+        with self._callback_lock:
+            if not self.done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self, reason="cancelled"):
+        """Ask the engine to abandon this request at the next decode step boundary"""
+        if not self.done:
+            self._cancel_reason = reason
+
+    def stopping_reason(self):
+        """Return why the request should stop now (cancellation, its deadline or a stop hook), or None"""
+        if self._cancel_reason:
+            return self._cancel_reason
+        if self.expired():
+            return "deadline" if self.output_ids else "expired"
+        for hook in self.stop_hooks:
+            reason = hook(self)
+            if reason:
+                return reason
+        return None
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def iter_tokens(self):
+        """Yield generated token ids as they are decoded (requires stream=True)"""
+        while True:
+            token_id = self._stream.get()
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    def _push(self, token_id):
+        self.output_ids.append(token_id)
+        if self._stream is not None:
+            self._stream.put(token_id)
+
+    def _finish(self, reason, error=None):
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        with self._callback_lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        if self._stream is not None:
+            self._stream.put(None)
+        for callback in callbacks:
+            callback(self)
+
+
+def _token_probs(logits, req):
+    """Sampling distribution for one position after temperature and top-p"""
+    logits = logits.float() / max(req.temperature, 1e-5)
+    probs = torch.softmax(logits, dim=-1)
+    if req.top_p < 1.0:
+        sorted_probs, sorted_idx = torch.sort(probs, descending=True)
+        cumulative = torch.cumsum(sorted_probs, dim=-1)
+        # Always keep the most likely token, drop everything past the nucleus
+        remove = cumulative - sorted_probs > req.top_p
+        sorted_probs[remove] = 0.0
+        probs = torch.zeros_like(probs).scatter_(0, sorted_idx, sorted_probs)
+    return probs
+
+
+def _sample_next_token(logits, req):
+    """Pick the next token for one sequence from its last-position logits"""
+    if not req.do_sample:
+        return int(torch.argmax(logits).item())
+    return int(torch.multinomial(_token_probs(logits, req), 1, generator=req.generator).item())
+
+
+def _prompt_lookup(tokens, max_ngram, num_draft):
+    """
+    Propose up to num_draft tokens by finding the trailing n-gram earlier in tokens.
+
+    Tries n-gram sizes from max_ngram down to 1 and returns what followed the
+    most recent earlier occurrence, or [] when nothing matches.
+    """
+    if num_draft <= 0:
+        return []
+    for size in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        tail = tokens[-size:]
+        for start in range(len(tokens) - size - 1, -1, -1):
+            if tokens[start + size - 1] == tail[-1] and tokens[start:start + size] == tail:
+                return tokens[start + size:start + size + num_draft]
+    return []
+
+
+def _verify_draft(logits, draft, req):
+    """
+    Return the tokens to accept given logits for [last token] + draft.
+
+    Greedy requests keep the draft up to the first token the model would not
+    have picked, then add the model's own token. Sampled requests use the
+    speculative sampling rule (accept draft token d with probability p(d),
+    otherwise resample with d excluded), which leaves the output distribution
+    unchanged.
+    """
+    accepted = []
+    for position, token in enumerate(draft):
+        if not req.do_sample:
+            choice = int(torch.argmax(logits[position]).item())
+            accepted.append(choice)
+            if choice != token:
+                return accepted
+            continue
+        probs = _token_probs(logits[position], req)
+        if torch.rand(1, generator=req.generator).item() < probs[token].item():
+            accepted.append(token)
+            continue
+        probs[token] = 0.0
+        if probs.sum() <= 0:
+            accepted.append(int(torch.argmax(logits[position]).item()))
+        else:
+            accepted.append(int(torch.multinomial(probs, 1, generator=req.generator).item()))
+        return accepted
+    accepted.append(_sample_next_token(logits[len(draft)], req))
+    return accepted
+
+
+def _schedule_key(req):
+    """Admission order of waiting requests: priority, then earliest deadline; ties keep arrival order"""
+    return req.priority, req.deadline if req.deadline is not None else float("inf")
+
+
+def _left_pad_cache(cache, mask, length):
+    """Left-pad a legacy KV cache and its attention mask to the given sequence length"""
+    pad = length - mask.shape[1]
+    if pad == 0:
+        return cache, mask
+    padded = []
+    for key, value in cache:
+        key_pad = key.new_zeros(key.shape[0], key.shape[1], pad, key.shape[3])
+        value_pad = value.new_zeros(value.shape[0], value.shape[1], pad, value.shape[3])
+        padded.append((torch.cat([key_pad, key], dim=2), torch.cat([value_pad, value], dim=2)))
+    mask = torch.cat([mask.new_zeros(mask.shape[0], pad), mask], dim=1)
+    return tuple(padded), mask
+
+
+class GenerationEngine:
+    """
+    Continuous batching scheduler shared by every endpoint.
+
+    Requests are prefilled individually as they arrive and then joined into a
+    single left-padded batch that advances one token per decode step. Finished
+    sequences leave the batch between steps so short requests are not held up
+    by long ones. When a prefix cache is given, prefill starts after the
+    longest cached prefix of the prompt. Requests with draft_tokens set run
+    outside the batch with their own cache, verifying several prompt-lookup
+    draft tokens per forward pass.
+
+    Waiting requests are admitted by priority, then deadline. When the batch
+    is full and a waiting request outranks a running one, the lowest-priority
+    running request is preempted between decode steps: it goes back to the
+    queue with its KV cache and resumes where it stopped. Requests whose
+    deadline passes while queued are dropped without being prefilled.
+
+    Forward passes go through an inference backend (see backends.py); the
+    default runs the model eagerly.
+    """
+
+    def __init__(self, model, device, max_batch_size=8, prefix_cache=None, backend=None):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.backend = backend or EagerBackend(model, device)
+
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._active = []
+        self._speculative = []
+        self._cache = None
+        self._mask = None
+        self._thread = None
+        self._inflight = {}
+        self._latest_by_key = {}
+        self._profile_request = None
+        self._profiler = None
+        self._profiler_steps = 0
+        self._profiler_path = None
+        self.last_profile = None
+
+        self.stats = {
+            "requests_submitted": 0,
+            "requests_finished": 0,
+            "requests_failed": 0,
+            "requests_started": 0,
+            "queue_wait_seconds": 0.0,
+            "prefill_tokens": 0,
+            "prefill_tokens_reused": 0,
+            "decode_steps": 0,
+            "generated_tokens": 0,
+            "max_batch_seen": 0,
+            "requests_cancelled": 0,
+            "requests_superseded": 0,
+            "requests_expired": 0,
+            "requests_deadline": 0,
+            "requests_preempted": 0,
+            "decode_steps_saved": 0,
+            "speculative_steps": 0,
+            "speculative_tokens": 0,
+            "draft_tokens_proposed": 0,
+            "draft_tokens_accepted": 0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+            self._thread.start()
+            logger.info(f"Generation engine started (max batch size {self.max_batch_size})")
+        return self
+
+    def submit(self, input_ids, max_new_tokens, **kwargs):
+        """Queue a prompt for generation and return its request handle"""
+        req = GenerationRequest(input_ids, max_new_tokens, **kwargs)
+        with self._cond:
+            if req.supersede_key is not None:
+                latest = self._latest_by_key.get(req.supersede_key, [])
+                if req.joins(latest):
+                    latest.append(req)
+                else:
+                    for previous in list(latest):
+                        self._cancel_locked(previous, "superseded")
+                    self._latest_by_key[req.supersede_key] = [req]
+            self._inflight[req.request_id] = req
+            self._pending.append(req)
+            self.stats["requests_submitted"] += 1
+            self._cond.notify()
+        return req
+
+    def cancel(self, request_id=None, supersede_key=None):
+        """Cancel an in-flight request by id, or the latest requests for a supersede key; returns whether any was found"""
+        with self._cond:
+            if request_id is not None:
+                requests = [self._inflight[request_id]] if request_id in self._inflight else []
+            else:
+                requests = list(self._latest_by_key.get(supersede_key, []))
+            return any([self._cancel_locked(req, "cancelled") for req in requests])
+
+    def capture_profile(self, steps, path):
+        """Profile the next `steps` iterations of the decode loop and write a Chrome trace to path"""
+        with self._cond:
+            if self._profile_request is not None or self._profiler is not None:
+                return False
+            self._profile_request = {"steps": steps, "path": path}
+            return True
+
+    def generate(self, input_ids, max_new_tokens, timeout=None, **kwargs):
+        """Submit a prompt and block until its generated token ids are available"""
+        return self.submit(input_ids, max_new_tokens, **kwargs).wait(timeout)
+
+    def snapshot(self):
+        with self._cond:
+            proposed, steps = self.stats["draft_tokens_proposed"], self.stats["speculative_steps"]
+            return dict(
+                self.stats,
+                **{f"backend_{key}": value for key, value in self.backend.snapshot().items()},
+                backend=self.backend.name,
+                queue_depth=len(self._pending),
+                active=len(self._active) + len(self._speculative),
+                # Share of drafted tokens the model agreed with, and tokens produced per speculative
+                # forward pass (1.0 would be plain decoding)
+                draft_acceptance_rate=round(self.stats["draft_tokens_accepted"] / proposed, 4) if proposed else 0.0,
+                speculative_speedup=round(self.stats["speculative_tokens"] / steps, 3) if steps else 0.0,
+            )
+
+    def _cancel_locked(self, req, reason):
+        if req.done:
+            return False
+        if req in self._pending:
+            # Not started yet: release it immediately instead of waiting for the loop
+            self._pending.remove(req)
+            self._stop(req, reason)
+        else:
+            req.cancel(reason)
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._active and not self._speculative:
+                    self._cond.wait()
+                self._drop_expired()
+                admitted = []
+                running = len(self._active) + len(self._speculative)
+                while self._pending and running + len(admitted) < self.max_batch_size:
+                    req = min(self._pending, key=_schedule_key)
+                    self._pending.remove(req)
+                    admitted.append(req)
+
+            self._profile_step()
+            with torch.inference_mode():
+                # A request that fails on its own (bad prompt, stop hook, its own forward pass) fails
+                # alone; only an error in the shared batch takes every running request down with it
+                for req in admitted:
+                    try:
+                        self._prefill(req)
+                    except Exception as e:
+                        self._fail(req, e)
+                try:
+                    if self._active:
+                        self._sweep_stopped()
+                    if self._active:
+                        self._decode_step()
+                except Exception as e:
+                    logger.exception("Generation engine decode step failed")
+                    self._fail_all(e)
+                if self._speculative:
+                    self._speculative_step()
+                if self._pending:
+                    try:
+                        self._preempt()
+                    except Exception as e:
+                        logger.exception("Generation engine preemption failed")
+                        self._fail_all(e)
+
+    def _drop_expired(self):
+        """Finish queued requests whose deadline has passed, before they cost a prefill"""
+        for req in [req for req in self._pending if req.expired()]:
+            self._pending.remove(req)
+            self._stop(req, "expired")
+
+    def _preempt(self):
+        """
+        Send the lowest-priority running requests back to the queue while
+        waiting requests outrank them and there is no free slot. A preempted
+        request keeps its KV cache (as req.past) and output so far, so it
+        resumes with a one-token prefill once it is admitted again.
+        """
+        with self._cond:
+            waiting = sorted(self._pending, key=_schedule_key)
+        running = [(req, row, None) for row, req in enumerate(self._active)]
+        running += [(req, None, cache) for req, cache in self._speculative]
+        free = self.max_batch_size - len(running)
+        victims = []
+        for req in waiting[max(free, 0):]:
+            if not running:
+                break
+            # The latest admitted among the lowest priority has the least work to lose
+            victim = max(running, key=lambda item: (item[0].priority, item[0].started_at or 0.0))
+            if victim[0].priority <= req.priority:
+                break
+            running.remove(victim)
+            victims.append(victim)
+        if not victims:
+            return
+
+        rows = {row for _, row, _ in victims if row is not None}
+        for req, row, cache in victims:
+            req.past = self._row_cache(row) if row is not None else cache
+        if rows:
+            self._retire([row for row in range(len(self._active)) if row not in rows])
+        preempted = {id(req) for req, _, _ in victims}
+        self._speculative = [(req, cache) for req, cache in self._speculative if id(req) not in preempted]
+        with self._cond:
+            for req, _, _ in victims:
+                self._pending.append(req)
+            self.stats["requests_preempted"] += len(victims)
+        logger.info(f"Preempted {len(victims)} request(s) for higher-priority work")
+
+    def _profile_step(self):
+        """Start, advance or finish an on-demand profiler capture around loop iterations with work"""
+        if self._profile_request is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if str(self.device).startswith("cuda"):
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self._profiler.start()
+            self._profiler_steps = self._profile_request["steps"]
+            self._profiler_path = self._profile_request["path"]
+            self._profile_request = None
+            return
+        if self._profiler is None:
+            return
+        self._profiler_steps -= 1
+        if self._profiler_steps > 0:
+            return
+        profiler, self._profiler = self._profiler, None
+        profiler.stop()
+        os.makedirs(os.path.dirname(self._profiler_path) or ".", exist_ok=True)
+        profiler.export_chrome_trace(self._profiler_path)
+        self.last_profile = {
+            "path": self._profiler_path,
+            "captured_at": time.time(),
+            "top_ops": profiler.key_averages().table(sort_by="self_cpu_time_total", row_limit=15),
+        }
+        logger.info(f"Profiler trace written to {self._profiler_path}")
+
+    def _prefill(self, req):
+        # A preempted request comes back with output: its prompt is now everything generated so far
+        resumed = bool(req.output_ids)
+        prompt_ids = req.input_ids + req.output_ids
+        if not resumed:
+            req.started_at = time.time()
+            self.stats["requests_started"] += 1
+            self.stats["queue_wait_seconds"] += req.started_at - req.submitted_at
+        reason = req.stopping_reason()
+        if reason:
+            req.cache = req.past if req.keep_cache and reason not in CANCEL_REASONS else None
+            req.past = None
+            self._stop(req, reason)
+            return
+        if req.seed is not None and req.generator is None:
+            req.generator = torch.Generator(device=self.device).manual_seed(req.seed)
+
+        reused, past = 0, None
+        if req.past is not None:
+            # Caller-supplied caches are private to the caller and bypass the shared prefix cache
+            reused, past = req.past[0][0].shape[2], req.past
+            req.past = None
+        elif self.prefix_cache is not None:
+            reused, past = self.prefix_cache.match(req.input_ids)
+        # At least one prompt token has to go through the model to produce logits
+        if reused >= len(prompt_ids):
+            reused = len(prompt_ids) - 1
+            past = tuple((k[:, :, :reused], v[:, :, :reused]) for k, v in past) if reused else None
+
+        input_ids = torch.tensor([prompt_ids[reused:]], device=self.device)
+        prefill_start = time.time()
+        logits, cache = self.backend.forward(input_ids, past)
+        if not resumed:
+            req.first_token_at = time.time()
+            req.prefill_seconds = req.first_token_at - prefill_start
+        self.stats["prefill_tokens"] += input_ids.shape[1]
+        self.stats["prefill_tokens_reused"] += reused
+
+        if self.prefix_cache is not None and not req.keep_cache and not resumed:
+            self.prefix_cache.insert(req.input_ids, cache)
+
+        # Set before accepting the token: a request that finishes here hands this cache back
+        req.cache = cache if req.keep_cache else None
+        logits = logits[0, -1]
+        if self._accept_token(req, _sample_next_token(logits, req), logits=logits):
+            return
+        req.cache = None
+
+        if req.draft_tokens > 0:
+            self._speculative.append((req, cache))
+            return
+        mask = torch.ones(1, len(prompt_ids), dtype=torch.long, device=self.device)
+        self._join_batch(req, cache, mask)
+
+    def _join_batch(self, req, cache, mask):
+        """Append a prefilled sequence to the running batch, padding whichever side is shorter"""
+        if self._active:
+            length = max(self._mask.shape[1], mask.shape[1])
+            batch_cache, batch_mask = _left_pad_cache(self._cache, self._mask, length)
+            cache, mask = _left_pad_cache(cache, mask, length)
+            # Built in full before assignment, so a failure here leaves the running batch intact
+            cache = tuple(
+                (torch.cat([bk, k], dim=0), torch.cat([bv, v], dim=0))
+                for (bk, bv), (k, v) in zip(batch_cache, cache)
+            )
+            mask = torch.cat([batch_mask, mask], dim=0)
+        self._cache, self._mask = cache, mask
+        self._active.append(req)
+        self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(self._active))
+
+    def _sweep_stopped(self):
+        """Retire rows that were cancelled or hit a stop hook since the last step"""
+        keep = []
+        for row, req in enumerate(self._active):
+            try:
+                reason = req.stopping_reason()
+                if reason:
+                    self._stop(req, reason, row)
+                else:
+                    keep.append(row)
+            except Exception as e:
+                self._fail(req, e)
+        if len(keep) < len(self._active):
+            self._retire(keep)
+
+    def _decode_step(self):
+        input_ids = torch.tensor([[req.output_ids[-1]] for req in self._active], device=self.device)
+        # The newest token is not in the cache yet, so its position is the count of cached real tokens
+        position_ids = self._mask.sum(dim=1, keepdim=True)
+        mask = torch.cat([self._mask, self._mask.new_ones(self._mask.shape[0], 1)], dim=1)
+
+        logits, self._cache = self.backend.decode(input_ids, self._cache, mask, position_ids)
+        self._mask = mask
+        self.stats["decode_steps"] += 1
+
+        keep = []
+        for row, req in enumerate(self._active):
+            row_logits = logits[row, -1]
+            if not self._accept_token(req, _sample_next_token(row_logits, req), row, row_logits):
+                keep.append(row)
+        if len(keep) < len(self._active):
+            self._retire(keep)
+
+    def _speculative_step(self):
+        """Advance every speculative request by one draft-and-verify forward pass"""
+        running = []
+        for req, cache in self._speculative:
+            try:
+                reason = req.stopping_reason()
+                if reason:
+                    req.cache = cache if req.keep_cache and reason not in CANCEL_REASONS else None
+                    self._stop(req, reason)
+                    continue
+                cache = self._speculate(req, cache)
+            except Exception as e:
+                # Each speculative request runs its own forward pass, so its failure is its own
+                self._fail(req, e)
+                continue
+            if cache is not None:
+                running.append((req, cache))
+        self._speculative = running
+
+    def _speculate(self, req, cache):
+        """Verify a prompt-lookup draft for one request; returns its cache, or None once it finished"""
+        remaining = req.max_new_tokens - len(req.output_ids)
+        draft = _prompt_lookup(req.input_ids + req.output_ids, req.draft_ngram, min(req.draft_tokens, remaining - 1))
+        input_ids = torch.tensor([[req.output_ids[-1]] + draft], device=self.device)
+        logits, extended = self.backend.forward(input_ids, cache)
+        accepted = _verify_draft(logits[0], draft, req)
+
+        # Keep the cache up to the last accepted draft token; the newest token is fed next step
+        length = cache[0][0].shape[2] + len(accepted)
+        cache = tuple((k[:, :, :length], v[:, :, :length]) for k, v in extended)
+        self.stats["speculative_steps"] += 1
+        self.stats["speculative_tokens"] += len(accepted)
+        self.stats["draft_tokens_proposed"] += len(draft)
+        self.stats["draft_tokens_accepted"] += len(accepted) - 1
+
+        req.cache = cache if req.keep_cache else None
+        for position, token_id in enumerate(accepted):
+            if self._accept_token(req, token_id, logits=logits[0, position]):
+                return None
+        req.cache = None
+        return cache
+
+    def _accept_token(self, req, token_id, row=None, logits=None):
+        """Record a sampled token (scored against its logits if requested) and finish the request if it is complete"""
+        self.stats["generated_tokens"] += 1
+        if req.logprobs and logits is not None:
+            req.token_logprobs.append(float(torch.log_softmax(logits.float(), dim=-1)[token_id]))
+        if req.eos_token_id is not None and token_id == req.eos_token_id:
+            self._complete(req, "eos", row)
+            return True
+        req._push(token_id)
+        if len(req.output_ids) >= req.max_new_tokens:
+            self._complete(req, "length", row)
+            return True
+        return False
+
+    def _complete(self, req, reason, row=None):
+        if req.keep_cache and row is not None:
+            req.cache = self._row_cache(row)
+        self.stats["requests_finished"] += 1
+        self._forget(req)
+        req._finish(reason)
+
+    def _stop(self, req, reason, row=None):
+        """Finish a request early and count the decode steps it no longer needs"""
+        if req.keep_cache and row is not None and reason not in CANCEL_REASONS:
+            req.cache = self._row_cache(row)
+        req.decode_steps_saved = max(req.max_new_tokens - len(req.output_ids), 0)
+        with self._cond:
+            self.stats[f"requests_{reason}"] = self.stats.get(f"requests_{reason}", 0) + 1
+            self.stats["decode_steps_saved"] += req.decode_steps_saved
+            self._forget(req)
+        req._finish(reason)
+
+    def _row_cache(self, row):
+        """Copy one batch row's KV cache without its left padding"""
+        start = self._mask.shape[1] - int(self._mask[row].sum().item())
+        return tuple(
+            (k[row:row + 1, :, start:].clone(), v[row:row + 1, :, start:].clone())
+            for k, v in self._cache
+        )
+
+    def _forget(self, req):
+        with self._cond:
+            self._inflight.pop(req.request_id, None)
+            latest = self._latest_by_key.get(req.supersede_key) if req.supersede_key is not None else None
+            if latest is not None and req in latest:
+                latest.remove(req)
+                if not latest:
+                    del self._latest_by_key[req.supersede_key]
+
+    def _retire(self, keep):
+        """Drop finished rows from the batch and trim padding no remaining row needs"""
+        self._active = [self._active[row] for row in keep]
+        if not self._active:
+            self._cache, self._mask = None, None
+            return
+        index = torch.tensor(keep, device=self.device)
+        mask = self._mask.index_select(0, index)
+        # Leading columns that are padding for every remaining row can be dropped
+        start = int((mask.sum(dim=0) > 0).nonzero()[0].item())
+        self._mask = mask[:, start:]
+        self._cache = tuple(
+            (k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+            for k, v in self._cache
+        )
+
+    def _fail(self, req, error):
+        """Finish one request with an error; called from an except block, so the traceback is logged"""
+        logger.exception(f"Generation failed for request {req.request_id}")
+        req.cache = None
+        if not req.done:
+            self.stats["requests_failed"] += 1
+            self._forget(req)
+            req._finish("error", error)
+
+    def _fail_all(self, error):
+        """Fail every running request after an error in a step they all share (the batched decode)"""
+        for req in self._active + [req for req, _ in self._speculative]:
+            if not req.done:
+                self.stats["requests_failed"] += 1
+                self._forget(req)
+                req._finish("error", error)
+        self._active = []
+        self._speculative = []
+        self._cache, self._mask = None, None
@@ -0,0 +1,218 @@
+import bisect
+import collections
+import hashlib
+import re
+import threading
+import time
+
+# Code tokens: identifiers, numbers, runs of whitespace (indentation matters) and single symbols
+TOKEN_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+(?:\.\d+)?|[ \t]+|\S")
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+LINE_START = "\n"  # context token for the start of a line
+
+
+class NgramCompleter:
+    """
+    Per-language n-gram model over code tokens, for completions without the LLM.
+
+    Every line learned adds its (context -> next token) counts for contexts of
+    1 to order-1 preceding tokens on the line, and its identifiers to a sorted
+    per-language vocabulary. A completion first finishes a partly typed
+    identifier (from the n-grams, else the most frequent vocabulary word with
+    that prefix), then extends the line one token at a time from the longest
+    context seen, for as long as one follower clearly dominates (min_share),
+    and stops at the end of the line. Lines are learned once (by hash), so
+    re-sending a whole document only costs the hashing of its lines. Keystroke
+    requests go through learn_typing(), which hashes their whole prefix only
+    the first time a source (client and file) is seen. Contexts are kept in
+    LRU order and the least recently updated ones are dropped beyond
+    max_contexts; each vocabulary stops growing at max_vocabulary.
+    """
+
+    def __init__(self, order=6, max_contexts=200000, max_followers=16, max_seen_lines=200000,
+                 max_vocabulary=50000, min_share=0.4, max_sources=1024):
+        self.order = order
+        self.max_contexts = max_contexts
+        self.max_followers = max_followers
+        self.max_seen_lines = max_seen_lines
+        self.max_vocabulary = max_vocabulary
+        self.min_share = min_share
+        self.max_sources = max_sources
+        self._lock = threading.Lock()
+        self._contexts = collections.OrderedDict()  # (language, context tokens) -> Counter of next tokens
+        self._seen = collections.OrderedDict()  # hashes of learned lines
+        self._sources = collections.OrderedDict()  # sources whose full text learn_typing() has learned
+        self._vocabulary = {}  # language -> sorted identifiers
+        self._frequency = {}  # language -> Counter of identifiers
+        self.stats = {
+            "lines_learned": 0,
+            "lines_skipped": 0,
+            "contexts_evicted": 0,
+            "completions": 0,
+            "completions_empty": 0,
+        }
+
+    def learn(self, text, language_name=""):
+        """Learn the complete lines of text; a trailing partial line (the one being typed) is left out"""
+        language = (language_name or "").lower()
+        lines = text.split("\n")[:-1]
+        with self._lock:
+            for line in lines:
+                if not line.strip():
+                    continue
+                digest = hashlib.blake2b(f"{language}\0{line}".encode("utf-8"), digest_size=8).digest()
+                if digest in self._seen:
+                    self._seen.move_to_end(digest)
+                    self.stats["lines_skipped"] += 1
+                    continue
+                self._seen[digest] = None
+                if len(self._seen) > self.max_seen_lines:
+                    self._seen.popitem(last=False)
+                self._learn_line(language, line)
+                self.stats["lines_learned"] += 1
+            while len(self._contexts) > self.max_contexts:
+                self._contexts.popitem(last=False)
+                self.stats["contexts_evicted"] += 1
+
+    def learn_typing(self, text, language_name="", source=None):
+        """
+        Learn from the code before the cursor of a keystroke request: all of it
+        the first time source is seen, then only the line just above the
+        cursor's, which is the one a newline has just finished.
+        """
+        with self._lock:
+            first = source is not None and source not in self._sources
+            if source is not None:
+                self._sources[source] = None
+                self._sources.move_to_end(source)
+                if len(self._sources) > self.max_sources:
+                    self._sources.popitem(last=False)
+        if first:
+            self.learn(text, language_name)
+            return
+        end = text.rfind("\n")
+        if end >= 0:
+            self.learn(text[text.rfind("\n", 0, end) + 1:end + 1], language_name)
+
+    def complete(self, text, language_name="", max_tokens=16):
+        """Continue the last line of text up to its end; returns "" when nothing similar was seen"""
+        language = (language_name or "").lower()
+        line = text.rsplit("\n", 1)[-1]
+        tokens = [LINE_START] + TOKEN_PATTERN.findall(line)
+        completion = []
+        with self._lock:
+            # Finish an identifier the cursor is in the middle of
+            if IDENTIFIER_PATTERN.fullmatch(tokens[-1]):
+                partial = tokens.pop()
+                rest = self._predict(language, tokens, lambda token: token.startswith(partial) and token != partial)
+                rest = rest or self._lookup(language, partial)
+                if rest is not None:
+                    completion.append(rest[len(partial):])
+                tokens.append(rest or partial)
+            while len(completion) < max_tokens:
+                token = self._predict(language, tokens, min_share=self.min_share)
+                if token is None:
+                    break
+                completion.append(token)
+                tokens.append(token)
+            self.stats["completions"] += 1
+            if not completion:
+                self.stats["completions_empty"] += 1
+        return "".join(completion).rstrip()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                contexts=len(self._contexts),
+                vocabulary=sum(len(words) for words in self._vocabulary.values()),
+                languages=len(self._vocabulary),
+                max_contexts=self.max_contexts,
+            )
+
+    def _learn_line(self, language, line):
+        tokens = [LINE_START] + TOKEN_PATTERN.findall(line) + [LINE_START]
+        words = self._vocabulary.setdefault(language, [])
+        frequency = self._frequency.setdefault(language, collections.Counter())
+        for token in tokens:
+            if not IDENTIFIER_PATTERN.fullmatch(token):
+                continue
+            if token not in frequency:
+                if len(words) >= self.max_vocabulary:
+                    continue
+                bisect.insort(words, token)
+            frequency[token] += 1
+        for end in range(1, len(tokens)):
+            for size in range(1, min(self.order - 1, end) + 1):
+                key = (language, tuple(tokens[end - size:end]))
+                followers = self._contexts.get(key)
+                if followers is None:
+                    followers = self._contexts[key] = collections.Counter()
+                else:
+                    self._contexts.move_to_end(key)
+                followers[tokens[end]] += 1
+                if len(followers) > 2 * self.max_followers:
+                    # Keep the counters small: only the most frequent followers survive
+                    self._contexts[key] = collections.Counter(dict(followers.most_common(self.max_followers)))
+
+    def _predict(self, language, tokens, accept=None, min_share=0.0):
+        """
+        Most frequent next token after the longest seen context (back-off), or
+        None at the end of the line or when no follower has min_share of the
+        context's counts.
+        """
+        for size in range(min(self.order - 1, len(tokens)), 0, -1):
+            followers = self._contexts.get((language, tuple(tokens[-size:])))
+            if not followers:
+                continue
+            # A filter (finishing a partial identifier) may need a shorter context to find a match
+            for token, count in followers.most_common():
+                if accept is None or accept(token):
+                    if token == LINE_START or count < min_share * sum(followers.values()):
+                        return None
+                    return token
+        return None
+
+    def _lookup(self, language, prefix, scan=64):
+        """Most frequent known identifier that extends prefix, among the first `scan` in sorted order"""
+        words = self._vocabulary.get(language, [])
+        frequency = self._frequency.get(language, {})
+        start = bisect.bisect_right(words, prefix)
+        matches = []
+        for word in words[start:start + scan]:
+            if not word.startswith(prefix):
+                break
+            matches.append(word)
+        return max(matches, key=lambda word: frequency[word]) if matches else None
+
+
+class LatencyEstimate:
+    """
+    Moving average of how long model completions take, to tell whether a deadline can still be met.
+
+    Only completions from the model update it, and nothing goes to the model
+    while the estimate says it is too slow, so the estimate expires max_age
+    seconds after the last observation; the next request then goes to the
+    model and measures it again.
+    """
+
+    def __init__(self, weight=0.2, max_age=10.0):
+        self.weight = weight
+        self.max_age = max_age
+        self._value = None
+        self._observed_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self):
+        """Estimated seconds per completion, or None before the first or after a stale observation"""
+        with self._lock:
+            if self._value is None or time.monotonic() - self._observed_at > self.max_age:
+                return None
+            return self._value
+
+    def observe(self, seconds):
+        with self._lock:
+            fresh = self._value is not None and time.monotonic() - self._observed_at <= self.max_age
+            self._value = (1 - self.weight) * self._value + self.weight * seconds if fresh else seconds
+            self._observed_at = time.monotonic()
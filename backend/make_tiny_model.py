@@ -0,0 +1,78 @@
+"""
+Build a tiny randomly initialised causal LM for offline benchmarks and smoke tests.
+
+No network access is needed: a small byte-level BPE tokenizer is trained on a
+built-in code corpus and saved with a Llama model of roughly a hundred thousand
+parameters. Point the server at it with MODEL_PATH.
+
+    python make_tiny_model.py --output ./tiny-model
+    MODEL_PATH=./tiny-model python benchmark.py --synthetic 200
+"""
+import argparse
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+CORPUS = [
+    "def fibonacci(n):\n    if n < 2:\n        return n\n    return fibonacci(n - 1) + fibonacci(n - 2)\n",
+    "class Stack:\n    def __init__(self):\n        self.items = []\n\n    def push(self, item):\n        self.items.append(item)\n",
+    "for i in range(10):\n    print(i)\n",
+    "function add(a, b) {\n    return a + b;\n}\n",
+    "const items = list.filter((x) => x > 0).map((x) => x * 2);\n",
+    "Human: How do I reverse a list in Python?\n\nAssistant: Use items[::-1] or items.reverse().\n",
+    "Programming Language: Python\nFile: main.py\n\nimport os\nimport sys\n",
+    "# Optimized Python:\ndef has_duplicates(items):\n    return len(set(items)) != len(items)\n",
+]
+
+
+def build(output, vocab_size=1024, hidden_size=64, layers=2, heads=4, kv_heads=2, seed=0):
+    tokenizer = Tokenizer(models.BPE(unk_token=None))
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=["<s>", "</s>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator(CORPUS * 20, trainer)
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<s>",
+        eos_token="</s>",
+        model_input_names=["input_ids", "attention_mask"],
+    )
+
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=heads,
+        num_key_value_heads=kv_heads,
+        max_position_embeddings=4096,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(seed)
+    model = LlamaForCausalLM(config)
+    model.save_pretrained(output)
+    tokenizer.save_pretrained(output)
+    return sum(p.numel() for p in model.parameters())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a tiny random model for offline benchmarks")
+    parser.add_argument("--output", default="./tiny-model")
+    parser.add_argument("--vocab-size", type=int, default=1024)
+    parser.add_argument("--hidden-size", type=int, default=64)
+    parser.add_argument("--layers", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    parameters = build(args.output, args.vocab_size, args.hidden_size, args.layers, seed=args.seed)
+    print(f"Saved tiny model ({parameters:,} parameters) to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
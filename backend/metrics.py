@@ -0,0 +1,231 @@
+import collections
+import contextlib
+import math
+import threading
+import time
+
+# Latency buckets in seconds, from sub-millisecond phases up to long generations
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Request phases in pipeline order, as reported in traces
+PHASE_ORDER = ("parse", "prompt", "tokenize", "queue", "prefill", "decode", "detokenize", "postprocess", "handler")
+TOKEN_BUCKETS = (1, 4, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, value) for labels, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, count=1, **labels):
+        """Record value; count > 1 records it that many times (e.g. once per token of a request)"""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += count
+            state[1] += value * count
+            state[2] += count
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for labels, (counts, total, count) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    out.append((f"{self.name}_bucket", labels + (("le", _format_value(bound)),), bucket_count))
+                out.append((f"{self.name}_sum", labels, total))
+                out.append((f"{self.name}_count", labels, count))
+        return out
+
+
+class MetricsRegistry:
+    """
+    Metrics rendered in the Prometheus text exposition format.
+
+    Counters, gauges and histograms are updated on the hot path; collectors
+    are called at scrape time and return (name, help, {labels: value}) tuples
+    for values that already live elsewhere, such as engine or cache stats.
+    """
+
+    def __init__(self, namespace="codegenie"):
+        self.namespace = namespace
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        return self._register(Counter(f"{self.namespace}_{name}", help_text))
+
+    def gauge(self, name, help_text):
+        return self._register(Gauge(f"{self.namespace}_{name}", help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(f"{self.namespace}_{name}", help_text, buckets))
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for collector in self._collectors:
+            for name, help_text, values in collector():
+                name = f"{self.namespace}_{name}"
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in values.items():
+                    lines.append(f"{name}{_format_labels(tuple(sorted(labels)))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+class RequestTrace:
+    """
+    Timing breakdown of one HTTP request.
+
+    Handlers record their own phases (parse, tokenize, detokenize, ...) and
+    attach the engine requests they submit; queue wait, prefill and decode
+    come from the timestamps the engine leaves on those requests.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.requests = []
+        self.submitted = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def attach(self, req):
+        if self.submitted is None:
+            # Everything between parsing and the first submit that isn't tokenization is prompt building
+            self.submitted = time.perf_counter()
+            self.add("prompt", self.submitted - self.started - sum(self.phases.values()))
+        self.requests.append(req)
+
+    def close(self, handled):
+        """
+        Book the handler time not covered by any phase or by waiting on the
+        engine: post-processing after generation, or the whole handler for
+        requests that never reached the engine (e.g. response cache hits).
+        """
+        waited = 0.0
+        if self.requests:
+            finished = [req.finished_at or time.time() for req in self.requests]
+            waited = max(finished) - min(req.submitted_at for req in self.requests)
+        remainder = handled - self.started - sum(self.phases.values()) - waited
+        self.add("postprocess" if self.requests else "handler", max(remainder, 0.0))
+
+    def generation(self):
+        """
+        Queue/prefill seconds and token counts summed over the finished engine
+        requests. Decode is wall-clock time with any request decoding, so
+        requests decoding side by side (n candidates, /analyze_multi) aren't
+        counted once each.
+        """
+        totals = {"queue": 0.0, "prefill": 0.0, "decode": 0.0, "input_tokens": 0, "output_tokens": 0, "decode_steps_saved": 0}
+        spans = []
+        for req in self.requests:
+            if req.started_at is None:
+                continue
+            totals["queue"] += req.started_at - req.submitted_at
+            totals["prefill"] += req.prefill_seconds or 0.0
+            if req.first_token_at is not None and req.finished_at is not None:
+                spans.append((req.first_token_at, req.finished_at))
+            totals["input_tokens"] += len(req.input_ids)
+            totals["output_tokens"] += len(req.output_ids)
+            totals["decode_steps_saved"] += req.decode_steps_saved
+        end = None
+        for start, finish in sorted(spans):
+            start = start if end is None else max(start, end)
+            totals["decode"] += max(finish - start, 0.0)
+            end = finish if end is None else max(end, finish)
+        return totals
+
+    def breakdown(self, total):
+        """All phases in milliseconds plus token counts, as returned in the X-Trace header"""
+        generation = self.generation()
+        measured = dict(self.phases)
+        if self.requests:
+            measured.update(queue=generation["queue"], prefill=generation["prefill"], decode=generation["decode"])
+        phases = {name: measured.pop(name) for name in PHASE_ORDER if name in measured}
+        phases.update(measured, total=total)
+        return {
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in phases.items()},
+            "input_tokens": generation["input_tokens"],
+            "output_tokens": generation["output_tokens"],
+            "decode_steps_saved": generation["decode_steps_saved"],
+        }
+
+
+def format_server_timing(breakdown):
+    """Server-Timing header value (shown by browser dev tools) for a trace breakdown"""
+    return ", ".join(f"{name};dur={ms}" for name, ms in breakdown["phases_ms"].items())
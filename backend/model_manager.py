@@ -0,0 +1,140 @@
+import glob
+import logging
+import os
+import resource
+import threading
+import time
+
+from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers.utils import is_accelerate_available
+
+from precision import apply_precision, check_precision, load_dtype, model_nbytes
+
+logger = logging.getLogger(__name__)
+
+# Passed whenever the tokenizer is loaded, here and when worker processes reload it for stop hooks
+TOKENIZER_KWARGS = {"trust_remote_code": True}
+
+
+def current_rss_mb():
+    """Resident set size of this process in MB (Linux /proc, falls back to the peak)"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class ModelManager:
+    """
+    Loads the tokenizer and model exactly once and tracks readiness.
+
+    Safetensors checkpoints are memory-mapped, and when accelerate is
+    installed low_cpu_mem_usage skips the randomly initialised copy of the
+    weights, so peak memory stays close to one model. Loading can run in a
+    background thread while the server answers /health with "loading";
+    on_loaded runs once the weights are in place (e.g. to build the engine)
+    and warmup runs a short generation before the status flips to "ready".
+    The precision mode (see precision.PRECISIONS) is applied right after loading.
+    """
+
+    def __init__(self, model_path, device, precision="fp32", on_loaded=None, warmup=None):
+        self.model_path = model_path
+        self.device = device
+        self.precision = precision
+        # Quantization API that apply_precision used, e.g. which torchao config class
+        self.quantization = None
+        self.on_loaded = on_loaded
+        self.warmup = warmup
+
+        self.model = None
+        self.tokenizer = None
+        self.status = "not_loaded"
+        self.error = None
+        self.timings = {}
+        self.memory = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def load(self, background=False):
+        """Start loading (at most once); returns immediately when background is True"""
+        with self._lock:
+            if self.status != "not_loaded":
+                return
+            self.status = "loading"
+        if background:
+            self._thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+            self._thread.start()
+        else:
+            self._load()
+
+    def wait_ready(self, timeout=None):
+        """Block until loading has finished (successfully or not); returns whether the model is ready"""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def snapshot(self):
+        return {
+            "status": self.status,
+            "error": self.error,
+            "model_path": self.model_path,
+            "device": self.device,
+            "precision": self.precision,
+            "quantization": self.quantization,
+            "safetensors": bool(glob.glob(os.path.join(self.model_path, "*.safetensors"))),
+            "timings": self.timings,
+            "memory": dict(self.memory, rss_mb=current_rss_mb(), peak_rss_mb=peak_rss_mb()),
+        }
+
+    def _load(self):
+        start = time.monotonic()
+        self.memory["rss_before_load_mb"] = current_rss_mb()
+        try:
+            check_precision(self.precision, self.device)
+            logger.info(f"Loading tokenizer and model from {self.model_path} ({self.precision})...")
+            tokenizer = AutoTokenizer.from_pretrained(self.model_path, **TOKENIZER_KWARGS)
+            model = AutoModelForCausalLM.from_pretrained(
+                self.model_path,
+                trust_remote_code=True,
+                torch_dtype=load_dtype(self.precision),
+                low_cpu_mem_usage=is_accelerate_available(),
+            )
+            model.to(self.device)
+            model.eval()
+            model, self.quantization = apply_precision(model, self.precision, self.device)
+            self.model, self.tokenizer = model, tokenizer
+            self.timings["load_seconds"] = round(time.monotonic() - start, 3)
+            self.memory["peak_rss_after_load_mb"] = peak_rss_mb()
+            self.memory["model_mb"] = round(model_nbytes(model) / (1024 * 1024), 1)
+            logger.info(f"Model loaded successfully on {self.device} in {self.timings['load_seconds']}s")
+
+            if self.on_loaded is not None:
+                self.on_loaded(self)
+
+            if self.warmup is not None:
+                self.status = "warming_up"
+                warmup_start = time.monotonic()
+                self.warmup(self)
+                self.timings["warmup_seconds"] = round(time.monotonic() - warmup_start, 3)
+                logger.info(f"Warmup finished in {self.timings['warmup_seconds']}s")
+
+            self.timings["time_to_ready_seconds"] = round(time.monotonic() - start, 3)
+            self.memory["peak_rss_at_ready_mb"] = peak_rss_mb()
+            self.status = "ready"
+        except Exception as e:
+            logger.error(f"Failed to load model: {str(e)}")
+            self.error = str(e)
+            self.status = "failed"
+        finally:
+            self._ready.set()
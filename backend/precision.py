@@ -0,0 +1,95 @@
+import importlib.util
+import inspect
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# fp32: full precision (the default)
+# bf16: bfloat16 weights and activations
+# int8-dynamic: int8 Linear weights, activations quantized on the fly (CPU only)
+# int8-weight / int4-weight: weight-only quantization via torchao, where installed
+PRECISIONS = ("fp32", "bf16", "int8-dynamic", "int8-weight", "int4-weight")
+
+
+def check_precision(precision, device):
+    """Raise ValueError if a precision mode is unknown or cannot run on this device / install"""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}. Expected one of: {', '.join(PRECISIONS)}")
+    if precision == "int8-dynamic" and device != "cpu":
+        raise ValueError("int8-dynamic quantization only runs on CPU")
+    if precision.endswith("-weight") and importlib.util.find_spec("torchao") is None:
+        raise ValueError(f"{precision} needs torchao: pip install torchao")
+    if precision == "int4-weight" and device == "cpu":
+        _int4_cpu_layout()
+
+
+def load_dtype(precision):
+    """dtype to pass to from_pretrained, so bf16 weights are never materialized in fp32"""
+    return torch.bfloat16 if precision in ("bf16", "int4-weight") else torch.float32
+
+
+def apply_precision(model, precision, device):
+    """
+    Quantize a loaded model in place for the given precision mode; returns the
+    model and the quantization API that was used (None for fp32 and bf16).
+    """
+    method = None
+    if precision == "int8-dynamic":
+        # The output projection stays in full precision: it decides every token and is a small share of the weights
+        output = model.get_output_embeddings()
+        qconfig_spec = {
+            name: torch.ao.quantization.default_dynamic_qconfig
+            for name, module in model.named_modules()
+            if isinstance(module, torch.nn.Linear) and module is not output
+        }
+        model = torch.ao.quantization.quantize_dynamic(model, qconfig_spec, dtype=torch.qint8)
+        method = "torch.ao.quantization.quantize_dynamic"
+    elif precision.endswith("-weight"):
+        import torchao
+        from torchao.quantization import quantize_
+        config, name = _weight_only_config(precision, device)
+        quantize_(model, config)
+        method = f"torchao {torchao.__version__} {name}"
+    if precision != "fp32":
+        logger.info(f"Model converted to {precision}" + (f" with {method}" if method else ""))
+    return model, method
+
+
+def _weight_only_config(precision, device):
+    """
+    torchao config for a weight-only mode and the name of the API that built
+    it: the Int8/Int4WeightOnlyConfig classes, else the deprecated
+    int8/int4_weight_only() functions of releases that predate them.
+    """
+    import torchao.quantization as quantization
+    bits = 4 if precision == "int4-weight" else 8
+    options = {"layout": _int4_cpu_layout()} if bits == 4 and device == "cpu" else {}
+    name = f"Int{bits}WeightOnlyConfig"
+    if hasattr(quantization, name):
+        if options and "version" in inspect.signature(getattr(quantization, name)).parameters:
+            options["version"] = 1  # the layout-based implementation, which has the CPU int4 kernel
+    else:
+        name = f"int{bits}_weight_only"
+    return getattr(quantization, name)(**options), name
+
+
+def _int4_cpu_layout():
+    try:
+        from torchao.dtypes import Int4CPULayout
+    except ImportError:
+        raise ValueError("int4-weight on CPU needs a torchao release with Int4CPULayout; this one has no CPU int4 kernel") from None
+    return Int4CPULayout()
+
+
+def model_nbytes(model):
+    """Bytes held by parameters and buffers, including packed quantized weights"""
+    total = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+    for module in model.modules():
+        packed = getattr(module, "_packed_params", None)
+        if packed is not None and hasattr(packed, "_weight_bias"):
+            weight, bias = packed._weight_bias()
+            total += weight.numel() * weight.element_size()
+            total += bias.numel() * bias.element_size() if bias is not None else 0
+    return total
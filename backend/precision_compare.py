@@ -0,0 +1,130 @@
+"""
+Compare precision modes on a fixed prompt set.
+
+Each mode is loaded in a fresh process, so its resident memory is measured
+on its own. The prompts are generated greedily through the same engine the
+server uses. The run reports tokens/sec and peak RSS, plus how closely the
+output tokens agree with the fp32 run.
+
+    python precision_compare.py --modes fp32,bf16,int8-dynamic --max-new-tokens 64
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+
+DEFAULT_PROMPTS = [
+    "Programming Language: Python\n\ndef fibonacci(n):",
+    "Programming Language: Python\n\nclass LRUCache:\n    def __init__(self, capacity):",
+    "Programming Language: JavaScript\n\nfunction debounce(fn, wait) {",
+    "Programming Language: Python\n\nOptimize the following Python to improve its time and space complexity.\n\n"
+    "def has_duplicates(items):\n    for i in range(len(items)):\n        for j in range(i + 1, len(items)):\n"
+    "            if items[i] == items[j]:\n                return True\n    return False\n\n# Optimized Python:\n",
+    "Human: What is the difference between a list and a tuple in Python?\n\nAssistant:",
+]
+
+
+def run_mode(model_path, precision, prompts, max_new_tokens, results):
+    # Imported here so each spawned process pays (and measures) its own load
+    import torch
+    from engine import GenerationEngine
+    from model_manager import ModelManager, current_rss_mb, peak_rss_mb
+
+    manager = ModelManager(model_path, "cpu", precision=precision)
+    manager.load()
+    if not manager.ready:
+        results.put({"precision": precision, "error": manager.error})
+        return
+
+    tokenizer = manager.tokenizer
+    engine = GenerationEngine(manager.model, "cpu", max_batch_size=1).start()
+    encoded = [tokenizer(prompt)["input_ids"] for prompt in prompts]
+    engine.generate(encoded[0], 4, eos_token_id=tokenizer.eos_token_id)  # warmup
+
+    outputs, generated = [], 0
+    start = time.perf_counter()
+    for input_ids in encoded:
+        output_ids = engine.generate(input_ids, max_new_tokens, eos_token_id=tokenizer.eos_token_id)
+        outputs.append(list(output_ids))
+        generated += len(output_ids)
+    elapsed = time.perf_counter() - start
+
+    results.put({
+        "precision": precision,
+        "threads": torch.get_num_threads(),
+        "load_seconds": manager.timings.get("load_seconds"),
+        "model_mb": manager.memory.get("model_mb"),
+        "rss_mb": current_rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        "generated_tokens": generated,
+        "tokens_per_second": round(generated / elapsed, 2) if elapsed > 0 else 0.0,
+        "outputs": outputs,
+    })
+
+
+def agreement(reference, outputs):
+    """Share of reference tokens reproduced before the first divergence, and exact-match rate"""
+    matched = total = exact = 0
+    for ref, out in zip(reference, outputs):
+        prefix = 0
+        while prefix < min(len(ref), len(out)) and ref[prefix] == out[prefix]:
+            prefix += 1
+        matched += prefix
+        total += max(len(ref), 1)
+        exact += ref == out
+    return round(matched / total, 4), round(exact / max(len(reference), 1), 4)
+
+
+def compare(model_path, modes, prompts, max_new_tokens):
+    if "fp32" not in modes:
+        modes = ["fp32"] + modes
+    context = multiprocessing.get_context("spawn")
+    report = []
+    for precision in modes:
+        results = context.Queue()
+        process = context.Process(target=run_mode, args=(model_path, precision, prompts, max_new_tokens, results))
+        process.start()
+        result = results.get()
+        process.join()
+        report.append(result)
+
+    reference = next((r["outputs"] for r in report if r["precision"] == "fp32" and "outputs" in r), None)
+    for result in report:
+        if "outputs" in result and reference is not None:
+            result["token_agreement"], result["exact_match_rate"] = agreement(reference, result.pop("outputs"))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare model precision modes on a fixed prompt set")
+    parser.add_argument("--model", default=os.environ.get("MODEL_PATH", "./Deepseek-Instruct"))
+    parser.add_argument("--modes", default="fp32,bf16,int8-dynamic", help="Comma-separated precision modes")
+    parser.add_argument("--prompts", help="JSONL file with a 'prompt' field per line (default: built-in set)")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    prompts = DEFAULT_PROMPTS
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = [json.loads(line)["prompt"] for line in f if line.strip()]
+
+    report = compare(args.model, [m.strip() for m in args.modes.split(",") if m.strip()], prompts, args.max_new_tokens)
+
+    print(f"{'precision':<14}{'tok/s':>10}{'peak RSS MB':>14}{'model MB':>11}{'agreement':>11}{'exact':>8}")
+    for result in report:
+        if "token_agreement" not in result:
+            print(f"{result['precision']:<14}  failed: {result.get('error', 'no fp32 reference')}")
+            continue
+        print(
+            f"{result['precision']:<14}{result['tokens_per_second']:>10}{result['peak_rss_mb']:>14}"
+            f"{result['model_mb']:>11}{result['token_agreement']:>11}{result['exact_match_rate']:>8}"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
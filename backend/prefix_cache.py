@@ -0,0 +1,172 @@
+import logging
+import threading
+import time
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def _slice_kv(kv, start, end=None):
+    """Copy the [start:end) token range out of a legacy (key, value) per-layer cache"""
+    return tuple(
+        (key[:, :, start:end].clone(), value[:, :, start:end].clone())
+        for key, value in kv
+    )
+
+
+def _kv_nbytes(kv):
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in kv)
+
+
+class _Node:
+    __slots__ = ("tokens", "kv", "children", "parent", "last_access", "nbytes")
+
+    def __init__(self, tokens=(), kv=None, parent=None):
+        self.tokens = tuple(tokens)
+        self.kv = kv
+        self.children = {}
+        self.parent = parent
+        self.last_access = time.monotonic()
+        self.nbytes = _kv_nbytes(kv) if kv is not None else 0
+
+
+class PrefixCache:
+    """
+    Radix tree of past_key_values keyed by token ids.
+
+    Each edge holds the KV block for its run of tokens, so a prompt that shares
+    a prefix with anything seen before (the previous keystroke's document, a
+    language context header, a fixed instruction preamble) only needs to
+    prefill the tokens after the longest cached match. Leaves are evicted in
+    LRU order once the stored blocks exceed the byte budget.
+
+    min_tokens applies to both sides: shorter prompts aren't stored, and
+    shorter matches (a shared BOS token or import line) count as misses,
+    since gathering their KV costs about as much as prefilling them.
+    hit_rate is the share of looked-up prompt tokens served from the cache.
+    """
+
+    def __init__(self, max_bytes, min_tokens=16):
+        self.max_bytes = max_bytes
+        self.min_tokens = min_tokens
+        self._root = _Node()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "lookup_tokens": 0,
+            "matched_tokens": 0,
+            "inserted_tokens": 0,
+            "evicted_nodes": 0,
+        }
+
+    def match(self, tokens):
+        """Return (length, kv) for the longest cached prefix of at least min_tokens tokens, kv is None on a miss"""
+        with self._lock:
+            self.stats["lookups"] += 1
+            self.stats["lookup_tokens"] += len(tokens)
+            node, pos, segments = self._root, 0, []
+            now = time.monotonic()
+            while pos < len(tokens):
+                child = node.children.get(tokens[pos])
+                if child is None:
+                    break
+                common = _common_length(child.tokens, tokens, pos)
+                child.last_access = now
+                segments.append((child, common))
+                pos += common
+                if common < len(child.tokens):
+                    break
+                node = child
+
+            if pos == 0 or pos < self.min_tokens:
+                return 0, None
+            self.stats["hits"] += 1
+            self.stats["matched_tokens"] += pos
+            kv = tuple(
+                (
+                    torch.cat([seg.kv[layer][0][:, :, :length] for seg, length in segments], dim=2),
+                    torch.cat([seg.kv[layer][1][:, :, :length] for seg, length in segments], dim=2),
+                )
+                for layer in range(len(segments[0][0].kv))
+            )
+            return pos, kv
+
+    def insert(self, tokens, kv):
+        """Store the KV cache of a fully prefilled prompt (batch size 1, one entry per token)"""
+        if len(tokens) < self.min_tokens:
+            return
+        with self._lock:
+            node, pos = self._root, 0
+            now = time.monotonic()
+            while pos < len(tokens):
+                child = node.children.get(tokens[pos])
+                if child is None:
+                    leaf = _Node(tokens[pos:], _slice_kv(kv, pos), parent=node)
+                    node.children[leaf.tokens[0]] = leaf
+                    self.total_bytes += leaf.nbytes
+                    self.stats["inserted_tokens"] += len(leaf.tokens)
+                    break
+                common = _common_length(child.tokens, tokens, pos)
+                if common < len(child.tokens):
+                    child = self._split(child, common)
+                child.last_access = now
+                node = child
+                pos += common
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node()
+            self.total_bytes = 0
+
+    def snapshot(self):
+        with self._lock:
+            lookup_tokens = self.stats["lookup_tokens"]
+            return dict(
+                self.stats,
+                hit_rate=round(self.stats["matched_tokens"] / lookup_tokens, 4) if lookup_tokens else 0.0,
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+            )
+
+    def _split(self, node, at):
+        """Split node's edge so its first `at` tokens become a new parent node"""
+        upper = _Node(node.tokens[:at], _slice_kv(node.kv, 0, at), parent=node.parent)
+        upper.last_access = node.last_access
+        self.total_bytes -= node.nbytes
+        node.tokens = node.tokens[at:]
+        node.kv = _slice_kv(node.kv, at)
+        node.nbytes = _kv_nbytes(node.kv)
+        self.total_bytes += node.nbytes + upper.nbytes
+
+        node.parent.children[upper.tokens[0]] = upper
+        upper.children[node.tokens[0]] = node
+        node.parent = upper
+        return upper
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            victim = None
+            stack = list(self._root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif victim is None or node.last_access < victim.last_access:
+                    victim = node
+            if victim is None:
+                break
+            del victim.parent.children[victim.tokens[0]]
+            self.total_bytes -= victim.nbytes
+            self.stats["evicted_nodes"] += 1
+
+
+def _common_length(edge, tokens, pos):
+    length = 0
+    limit = min(len(edge), len(tokens) - pos)
+    while length < limit and edge[length] == tokens[pos + length]:
+        length += 1
+    return length
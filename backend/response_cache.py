@@ -0,0 +1,136 @@
+import collections
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_prompt(text):
+    """Normalize line endings and trailing whitespace so cosmetic edits still hit the cache"""
+    lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+    return "\n".join(line.rstrip() for line in lines).strip()
+
+
+def _size(entry):
+    return len(entry.encode("utf-8"))
+
+
+class ResponseCache:
+    """
+    LRU cache of finished endpoint responses with a byte budget.
+
+    Entries are keyed on a hash of the endpoint, normalized prompt, language
+    context and generation parameters, so only deterministic generations
+    (greedy, or sampling with a fixed seed) should be stored. When a path is
+    given, entries are also written to a SQLite file and survive restarts;
+    the on-disk copy is trimmed to the same byte budget.
+    """
+
+    def __init__(self, max_bytes, path=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._hit_seconds = 0.0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._db.commit()
+            logger.info(f"Response cache persisted to {path}")
+
+    @staticmethod
+    def make_key(endpoint, prompt, language_context, params):
+        payload = json.dumps(
+            {
+                "endpoint": endpoint,
+                "prompt": normalize_prompt(prompt),
+                "language_context": language_context,
+                "params": params,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return the cached response body for key, or None"""
+        start = time.perf_counter()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+            elif self._db is not None:
+                row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = row[0]
+                    self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self._db.commit()
+                    self._store_memory(key, entry)
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self._hit_seconds += time.perf_counter() - start
+        return json.loads(entry)
+
+    def put(self, key, value):
+        entry = json.dumps(value)
+        with self._lock:
+            self._store_memory(key, entry)
+            self.stats["stores"] += 1
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, entry, _size(entry), time.time()),
+                )
+                self._trim_disk()
+                self._db.commit()
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats,
+                entries=len(self._entries),
+                bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else 0.0,
+                avg_hit_latency_ms=round(self._hit_seconds * 1000 / self.stats["hits"], 3) if self.stats["hits"] else 0.0,
+                persistent=self._db is not None,
+            )
+
+    def _store_memory(self, key, entry):
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.total_bytes -= _size(previous)
+        self._entries[key] = entry
+        self.total_bytes += _size(entry)
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= _size(evicted)
+            self.stats["evictions"] += 1
+
+    def _trim_disk(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
@@ -0,0 +1,448 @@
+"""
+Cache-affinity router in front of several backend nodes.
+
+Synced documents, chat sessions and prefix caches live in the node that
+served them, so requests are consistent-hashed on their documentId (else
+sessionId, else clientId) to a node; chat requests without either fall back
+to the caller's address. Requests with no affinity go to the least busy node.
+Nodes are health-checked via /health and only nodes with a ready model are
+on the ring; when one joins or leaves, only the keys it owns move. The
+extension re-opens documents the new owner doesn't know.
+
+Run the nodes without their own tunnels and point the extension (or the
+ngrok tunnel, with --ngrok) at the router:
+
+    USE_NGROK=0 PROXY_HOPS=1 PORT=5001 python server.py
+    USE_NGROK=0 PROXY_HOPS=1 PORT=5002 python server.py
+    python router.py --nodes http://127.0.0.1:5001,http://127.0.0.1:5002 --port 5000
+
+GET /router/stats reports per-node health and load; POST /router/nodes
+{"add": url} or {"remove": url} changes the node set at runtime.
+"""
+import argparse
+import bisect
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from flask import Flask, Response, jsonify, request
+from flask_cors import CORS
+
+logger = logging.getLogger(__name__)
+
+# Routes whose per-caller state (the chat session) falls back to the caller's address
+ADDRESS_AFFINITY_PATHS = ("/generate", "/clear_history")
+# Request headers passed on to nodes; hop-by-hop and host headers are not
+FORWARD_HEADERS = ("Content-Type", "Accept", "X-Trace")
+# Response headers the router sets itself
+SKIP_RESPONSE_HEADERS = ("connection", "content-length", "date", "keep-alive", "server", "transfer-encoding")
+
+
+def connection_failed(error):
+    """
+    Whether a proxy error means the node could not be reached, so the request
+    never ran there and may be retried elsewhere. Timeouts don't count: the
+    node may still be generating, and a POST must not run twice.
+    """
+    reason = error.reason if isinstance(error, urllib.error.URLError) else error
+    return isinstance(reason, ConnectionError)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring with virtual nodes.
+
+    Each node owns `replicas` points on the ring and a key belongs to the
+    first point at or after its hash, so adding or removing a node only
+    moves the keys of that node.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self._owners))
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = _hash(f"{node}#{replica}")
+            index = bisect.bisect(self._points, point)
+            self._points.insert(index, point)
+            self._owners.insert(index, node)
+
+    def remove(self, node):
+        keep = [(point, owner) for point, owner in zip(self._points, self._owners) if owner != node]
+        self._points = [point for point, _ in keep]
+        self._owners = [owner for _, owner in keep]
+
+    def node_for(self, key):
+        if not self._points:
+            return None
+        return self._owners[bisect.bisect(self._points, _hash(key)) % len(self._points)]
+
+
+class Router:
+    """
+    Node membership, health and load for the routing proxy.
+
+    A node is healthy once /health reports a ready model and unhealthy after
+    `failures_to_down` failed checks or proxied connections in a row. The
+    ring holds the healthy nodes only and is rebuilt when that set changes.
+    The owners of recently routed keys are remembered, so each rebuild can
+    report how many of them moved.
+    """
+
+    def __init__(self, nodes=(), replicas=100, health_interval=2.0, health_timeout=2.0,
+                 failures_to_down=2, recent_keys=10000):
+        self.replicas = replicas
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.failures_to_down = failures_to_down
+        self._lock = threading.Lock()
+        self._nodes = {}
+        self._ring = HashRing(replicas=replicas)
+        self._recent = collections.OrderedDict()  # key -> node it was last routed to
+        self._recent_limit = recent_keys
+        self._stopping = threading.Event()
+        self.stats = {
+            "requests_routed": 0,
+            "requests_affinity": 0,
+            "requests_least_loaded": 0,
+            "requests_retried": 0,
+            "requests_unavailable": 0,
+            "rebalances": 0,
+            "keys_moved": 0,
+        }
+        for node in nodes:
+            self.add_node(node)
+
+    def start(self):
+        self.check_health()
+        threading.Thread(target=self._health_loop, name="router-health", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+
+    def add_node(self, url):
+        url = url.rstrip("/")
+        with self._lock:
+            if url in self._nodes:
+                return False
+            self._nodes[url] = {
+                "healthy": False, "status": "unknown", "model": None, "failures": 0, "last_check": None,
+                "in_flight": 0, "requests": 0, "errors": 0, "latency_ms": None,
+            }
+        logger.info(f"Node {url} added, joins the ring once it is healthy")
+        return True
+
+    def remove_node(self, url):
+        url = url.rstrip("/")
+        with self._lock:
+            if self._nodes.pop(url, None) is None:
+                return False
+            self._rebuild_locked()
+        logger.info(f"Node {url} removed")
+        return True
+
+    def route(self, key=None, exclude=()):
+        """Pick the node for a request: the ring owner of key, else the least busy healthy node"""
+        with self._lock:
+            healthy = [url for url, node in self._nodes.items() if node["healthy"] and url not in exclude]
+            if exclude:
+                self.stats["requests_retried"] += 1
+            if not healthy:
+                self.stats["requests_unavailable"] += 1
+                return None
+            if key is not None:
+                url = self._ring.node_for(key)
+                if url in exclude:
+                    # Failover while the ring still lists the node: next healthy owner on a ring without it
+                    url = HashRing(healthy, self.replicas).node_for(key)
+                self._recent[key] = url
+                self._recent.move_to_end(key)
+                if len(self._recent) > self._recent_limit:
+                    self._recent.popitem(last=False)
+                self.stats["requests_affinity"] += 1
+            else:
+                url = min(healthy, key=lambda u: (self._nodes[u]["in_flight"], self._nodes[u]["requests"]))
+                self.stats["requests_least_loaded"] += 1
+            self.stats["requests_routed"] += 1
+            return url
+
+    def healthy_nodes(self):
+        with self._lock:
+            return [url for url, node in self._nodes.items() if node["healthy"]]
+
+    def begin(self, url):
+        with self._lock:
+            node = self._nodes.get(url)
+            if node is not None:
+                node["in_flight"] += 1
+                node["requests"] += 1
+        return time.perf_counter()
+
+    def end(self, url, started, error=False):
+        """Record a finished proxied request; connection errors count towards taking the node down"""
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            node = self._nodes.get(url)
+            if node is None:
+                return
+            node["in_flight"] -= 1
+            if error:
+                node["errors"] += 1
+                self._mark_locked(url, False, "unreachable")
+                return
+            average = node["latency_ms"]
+            node["latency_ms"] = round(elapsed_ms if average is None else 0.8 * average + 0.2 * elapsed_ms, 3)
+
+    def check_health(self):
+        """Poll /health on every node and update the ring"""
+        with self._lock:
+            urls = list(self._nodes)
+        for url in urls:
+            try:
+                with urllib.request.urlopen(f"{url}/health", timeout=self.health_timeout) as response:
+                    health = json.loads(response.read())
+                model = health.get("model")
+                status = "ready" if model == "ready" else f"model {model}"
+                ok = health.get("status") == "ok" and model == "ready"
+            except Exception as e:
+                model, status, ok = None, f"unreachable ({e.__class__.__name__})", False
+            with self._lock:
+                if url in self._nodes:
+                    self._nodes[url]["model"] = model
+                    self._nodes[url]["last_check"] = time.time()
+                    self._mark_locked(url, ok, status)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                healthy_nodes=sum(node["healthy"] for node in self._nodes.values()),
+                in_flight=sum(node["in_flight"] for node in self._nodes.values()),
+                nodes={url: dict(node) for url, node in self._nodes.items()},
+            )
+
+    def _health_loop(self):
+        while not self._stopping.wait(self.health_interval):
+            self.check_health()
+
+    def _mark_locked(self, url, ok, status):
+        node = self._nodes[url]
+        node["status"] = status
+        node["failures"] = 0 if ok else node["failures"] + 1
+        # Up after one good check, down after a few bad ones so a single slow /health doesn't move keys
+        healthy = ok or (node["healthy"] and node["failures"] < self.failures_to_down)
+        if healthy != node["healthy"]:
+            node["healthy"] = healthy
+            if healthy:
+                logger.info(f"Node {url} is up")
+            else:
+                logger.warning(f"Node {url} is down ({status})")
+            self._rebuild_locked()
+
+    def _rebuild_locked(self):
+        healthy = [url for url, node in self._nodes.items() if node["healthy"]]
+        self._ring = HashRing(healthy, self.replicas)
+        moved = 0
+        for key, url in self._recent.items():
+            owner = self._ring.node_for(key)
+            if owner != url:
+                self._recent[key] = owner
+                moved += 1
+        self.stats["rebalances"] += 1
+        self.stats["keys_moved"] += moved
+        logger.info(f"Ring rebuilt with {len(healthy)} healthy node(s), {moved} recent key(s) moved")
+
+
+def routing_key(path, data, client_address):
+    """Affinity key of a request: its document, session or client, or None when any node will do"""
+    if isinstance(data, dict):
+        for field in ("documentId", "sessionId", "clientId"):
+            if data.get(field):
+                return f"{field}:{data[field]}"
+    if path in ADDRESS_AFFINITY_PATHS:
+        return f"address:{client_address}"
+    return None
+
+
+def create_app(router, timeout=600):
+    """Flask app that answers the router's own endpoints and proxies everything else"""
+    app = Flask(__name__)
+    # Webview fetches are cross-origin, as with a single server
+    CORS(app)
+
+    def client_address():
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        return forwarded.split(",")[0].strip() or request.remote_addr
+
+    def send(url, body):
+        headers = {name: request.headers[name] for name in FORWARD_HEADERS if name in request.headers}
+        forwarded = request.headers.get("X-Forwarded-For")
+        headers["X-Forwarded-For"] = f"{forwarded}, {request.remote_addr}" if forwarded else request.remote_addr
+        target = f"{url}{request.full_path if request.query_string else request.path}"
+        proxied = urllib.request.Request(target, data=body if request.method != "GET" else None,
+                                         headers=headers, method=request.method)
+        try:
+            return urllib.request.urlopen(proxied, timeout=timeout)
+        except urllib.error.HTTPError as e:
+            return e  # error statuses are answers too, and carry a body
+
+    def relay(url, upstream, started):
+        def body():
+            error = False
+            try:
+                while True:
+                    # read1 returns as soon as some bytes arrive, so streamed tokens aren't held back
+                    chunk = upstream.read1(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+            except OSError as e:
+                error = connection_failed(e)
+                raise
+            finally:
+                upstream.close()
+                router.end(url, started, error)
+
+        headers = [(name, value) for name, value in upstream.headers.items()
+                   if name.lower() not in SKIP_RESPONSE_HEADERS]
+        headers.append(("X-Backend-Node", url))
+        return Response(body(), status=upstream.status, headers=headers)
+
+    @app.route("/router/stats", methods=["GET"])
+    def router_stats():
+        return jsonify(router.snapshot())
+
+    @app.route("/router/nodes", methods=["GET", "POST"])
+    def router_nodes():
+        if request.method == "POST":
+            data = request.get_json(silent=True) or {}
+            if data.get("add"):
+                router.add_node(data["add"])
+                router.check_health()
+            elif data.get("remove"):
+                if not router.remove_node(data["remove"]):
+                    return jsonify({"error": f"Unknown node {data['remove']}"}), 404
+            else:
+                return jsonify({"error": 'Provide "add" or "remove" with a node URL'}), 400
+        return jsonify(router.snapshot()["nodes"])
+
+    # The router answers health and connection checks for the whole cluster
+    @app.route("/health", methods=["GET"])
+    def health():
+        healthy = router.healthy_nodes()
+        return jsonify({
+            "status": "ok" if healthy else "unavailable",
+            "model": "ready" if healthy else "not_ready",
+            "healthy_nodes": len(healthy),
+            "router": router.snapshot(),
+        }), 200 if healthy else 503
+
+    @app.route("/connection_info", methods=["GET"])
+    def connection_info():
+        healthy = router.healthy_nodes()
+        return jsonify({
+            "status": "connected",
+            "server_url": request.host_url.rstrip("/"),
+            "model_status": f"ready on {len(healthy)} node(s)" if healthy else "no healthy nodes",
+            "device": "router",
+        })
+
+    # A cancel by requestId alone can't be routed, so every node is asked
+    @app.route("/cancel", methods=["POST"])
+    def cancel():
+        data = request.get_json(silent=True)
+        if routing_key(request.path, data, client_address()) is not None:
+            return proxy("cancel")
+        body = request.get_data()
+        cancelled = False
+        for url in router.healthy_nodes():
+            started = router.begin(url)
+            try:
+                with send(url, body) as response:
+                    cancelled = cancelled or bool(json.loads(response.read() or b"{}").get("cancelled"))
+            except (OSError, ValueError):
+                router.end(url, started, error=True)
+                continue
+            router.end(url, started)
+        return jsonify({"cancelled": cancelled})
+
+    @app.route("/", defaults={"path": ""}, methods=["GET", "POST"])
+    @app.route("/<path:path>", methods=["GET", "POST"])
+    def proxy(path):
+        body = request.get_data()
+        key = routing_key(request.path, request.get_json(silent=True), client_address())
+        tried = []
+        # A node that can't be reached is taken off the ring and the request goes to the key's next owner
+        for _ in range(2):
+            url = router.route(key, exclude=tried)
+            if url is None:
+                break
+            started = router.begin(url)
+            try:
+                upstream = send(url, body)
+            except OSError as e:
+                if not connection_failed(e):
+                    # Slow rather than down: don't retry the request elsewhere or take the node off the ring
+                    logger.warning(f"Node {url} timed out for {request.path}: {e}")
+                    router.end(url, started)
+                    return jsonify({"error": f"Backend node did not answer within {timeout}s"}), 504
+                logger.warning(f"Node {url} failed for {request.path}: {e}")
+                router.end(url, started, error=True)
+                tried.append(url)
+                continue
+            return relay(url, upstream, started)
+        return jsonify({"error": "No healthy backend nodes"}), 503
+
+    return app
+
+
+def start_tunnel(port):
+    """Expose the router through ngrok and write its URL to server_config.json for clients"""
+    import pyngrok.ngrok as ngrok
+    if os.environ.get("NGROK_AUTH_TOKEN"):
+        ngrok.set_auth_token(os.environ["NGROK_AUTH_TOKEN"])
+    public_url = ngrok.connect(port).public_url
+    with open("server_config.json", "w") as f:
+        json.dump({"server_url": public_url}, f)
+    logger.info(f"ngrok tunnel established at {public_url}, saved to server_config.json")
+    return public_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route CodeGenie requests to backend nodes by document/session affinity")
+    parser.add_argument("--nodes", default=os.environ.get("ROUTER_NODES", ""),
+                        help="Comma-separated node URLs (default: $ROUTER_NODES)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 5000)))
+    parser.add_argument("--health-interval", type=float, default=2.0, help="Seconds between /health checks")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait on a node before failing a request")
+    parser.add_argument("--ngrok", action="store_true", help="Expose the router through an ngrok tunnel")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    router = Router([url for url in args.nodes.split(",") if url.strip()], health_interval=args.health_interval).start()
+    logger.info(f"Routing to {len(router.healthy_nodes())} healthy of {len(router.snapshot()['nodes'])} node(s)")
+    if args.ngrok:
+        start_tunnel(args.port)
+    create_app(router, timeout=args.timeout).run(host="0.0.0.0", port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
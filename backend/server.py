@@ -1,12 +1,41 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, has_request_context, make_response, request, jsonify
 from flask_cors import CORS
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from werkzeug.middleware.proxy_fix import ProxyFix
+import concurrent.futures
+import contextlib
+import functools
 import torch
 import logging
 import os
 import re
 import json
+import multiprocessing
+import queue
+import time
+import uuid
 import pyngrok.ngrok as ngrok
+from admission import AdmissionController, AdmissionRejected
+from backends import check_backend, create_backend, export_onnx_decoder
+from batch import BatchCheckpoint, job_text, parse_jobs
+from documents import DocumentStore, DocumentVersionError
+from engine import GenerationCancelled, GenerationEngine, GenerationExpired
+from fallback import LatencyEstimate, NgramCompleter
+from metrics import TOKEN_BUCKETS, MetricsRegistry, RequestTrace, format_server_timing
+from model_manager import ModelManager
+from prefix_cache import PrefixCache
+from response_cache import ResponseCache
+from sessions import SessionStore
+from stopping import GhostCompletionStop, StopLines, StopStrings
+from worker_pool import WorkerPool
+from streaming import (
+    OptimizedCodeFilter,
+    PassthroughFilter,
+    StopStringFilter,
+    event_stream_response,
+    format_event,
+    get_stream_format,
+    stream_generation,
+)
 
 # Setup Flask and CORS
 app = Flask(__name__)
@@ -19,7 +48,68 @@ logger = logging.getLogger(__name__)
 # Configuration from environment variables
 NGROK_AUTH_TOKEN = os.environ.get("NGROK_AUTH_TOKEN", "2vDDsjBFnwE7d6orXuyZHEN3toS_2fo2ae8eR5qNJsPAJtgfi")
 PORT = int(os.environ.get("PORT", 5000))
+USE_NGROK = os.environ.get("USE_NGROK", "1") == "1"  # 0 for nodes behind router.py, which holds the tunnel
+PROXY_HOPS = int(os.environ.get("PROXY_HOPS", 0))  # proxies in front of the server whose X-Forwarded-For is trusted
 MODEL_PATH = os.environ.get("MODEL_PATH", "./Deepseek-Instruct")
+MODEL_PRECISION = os.environ.get("MODEL_PRECISION", "fp32")  # fp32, bf16, int8-dynamic, int8-weight or int4-weight
+MODEL_LOAD_MODE = os.environ.get("MODEL_LOAD_MODE", "background")  # background, eager or lazy (on first request)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")  # eager, compiled (torch.compile) or onnx
+# Static KV cache lengths the compiled backend pads to, one compiled graph per length and batch bucket
+STATIC_CACHE_LENGTHS = [int(n) for n in os.environ.get("STATIC_CACHE_LENGTHS", "512,1024,2048").split(",") if n]
+ONNX_PATH = os.environ.get("ONNX_PATH", f"./onnx/{os.path.basename(os.path.normpath(MODEL_PATH))}-decode.onnx")
+WARMUP_TOKENS = int(os.environ.get("WARMUP_TOKENS", 8))  # 0 skips the warmup generation
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", 8))
+MODEL_WORKERS = int(os.environ.get("MODEL_WORKERS", 1))  # >1 runs that many engine processes sharing the weights (CPU only)
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", 0))  # torch threads per worker, 0 uses the size of its CPU set
+PREFIX_CACHE_MB = int(os.environ.get("PREFIX_CACHE_MB", 1024))  # 0 disables prefix KV reuse
+RESPONSE_CACHE_MB = int(os.environ.get("RESPONSE_CACHE_MB", 64))  # 0 disables the response cache
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "")  # SQLite file to persist responses across restarts
+DOCUMENT_TOKEN_BUDGET = int(os.environ.get("DOCUMENT_TOKEN_BUDGET", 2048))  # prompt window for synced documents
+MAX_OPEN_DOCUMENTS = int(os.environ.get("MAX_OPEN_DOCUMENTS", 256))
+FIM_SUFFIX_RATIO = float(os.environ.get("FIM_SUFFIX_RATIO", 0.25))  # share of the window after the cursor
+# Endpoints whose output mostly copies the prompt decode with prompt-lookup speculative decoding
+SPECULATIVE_ENDPOINTS = [e for e in os.environ.get("SPECULATIVE_ENDPOINTS", "/fill_in_the_middle,/optimize,/debug").split(",") if e]
+SPECULATIVE_DRAFT_TOKENS = int(os.environ.get("SPECULATIVE_DRAFT_TOKENS", 10))  # tokens drafted per step, 0 disables
+SPECULATIVE_NGRAM = int(os.environ.get("SPECULATIVE_NGRAM", 3))  # longest n-gram matched against the prompt
+CHAT_SESSION_MB = int(os.environ.get("CHAT_SESSION_MB", 512))  # KV kept between chat turns, across all sessions
+CHAT_TOKEN_BUDGET = int(os.environ.get("CHAT_TOKEN_BUDGET", 4096))  # history + new turn + reply, per session
+CHAT_SESSION_TTL = int(os.environ.get("CHAT_SESSION_TTL", 1800))  # seconds before an idle session is forgotten
+ENABLE_PROFILER = os.environ.get("ENABLE_PROFILER", "0") == "1"  # allow on-demand torch profiler captures via /profile
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./profiles")
+MAX_ANALYZE_SELECTIONS = int(os.environ.get("MAX_ANALYZE_SELECTIONS", 16))  # selections per /analyze_multi request
+MAX_CANDIDATES = int(os.environ.get("MAX_CANDIDATES", 5))  # "n" alternatives per /complete or /hf-complete request
+# /hf-complete answers from an n-gram model of the code seen so far while the model is loading, the engine
+# queue is FALLBACK_QUEUE_DEPTH deep, recent model latency would miss the request's deadline, or admission
+# control would reject the request
+FALLBACK_COMPLETIONS = os.environ.get("FALLBACK_COMPLETIONS", "1") == "1"
+FALLBACK_QUEUE_DEPTH = int(os.environ.get("FALLBACK_QUEUE_DEPTH", MAX_BATCH_SIZE))
+FALLBACK_MAX_CONTEXTS = int(os.environ.get("FALLBACK_MAX_CONTEXTS", 200000))  # n-gram contexts kept, about 0.5 KB each
+FALLBACK_LATENCY_TTL = float(os.environ.get("FALLBACK_LATENCY_TTL", 10))  # seconds before model latency is re-measured
+SERVER_MODE = os.environ.get("SERVER_MODE", "threaded")  # threaded (Werkzeug) or waitress (pip install waitress)
+SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 48))  # waitress worker threads
+# Generation requests admitted at once (running or queued on the engine); beyond that requests get a 429.
+# 0 disables admission control.
+MAX_PENDING_GENERATIONS = int(os.environ.get("MAX_PENDING_GENERATIONS", 32))
+# Per-endpoint concurrency limits as "endpoint=limit" pairs; endpoints not listed only share MAX_PENDING_GENERATIONS
+ENDPOINT_CONCURRENCY = os.environ.get(
+    "ENDPOINT_CONCURRENCY",
+    "/hf-complete=16,/complete=8,/generate=8,/fill_in_the_middle=8,/debug=4,/optimize=4,/analyze_multi=2,/batch=1"
+)
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", MAX_BATCH_SIZE))  # /batch jobs in flight at once
+BATCH_DIR = os.environ.get("BATCH_DIR", "./batches")  # server-side checkpoints of /batch runs with a "batchId"
+# Engine priority per endpoint as "endpoint=priority" pairs: lower values are admitted first and preempt
+# running requests of higher values when the batch is full. Endpoints not listed get 0.
+ENDPOINT_PRIORITY = os.environ.get(
+    "ENDPOINT_PRIORITY",
+    "/hf-complete=0,/complete=1,/fill_in_the_middle=1,/generate=2,/analyze_multi=3,/debug=3,/optimize=3"
+)
+# Default deadlines in milliseconds as "endpoint=ms" pairs, for requests that don't send "deadlineMs"
+ENDPOINT_DEADLINE_MS = os.environ.get("ENDPOINT_DEADLINE_MS", "")
+BATCH_PRIORITY = 10  # engine priority of /batch jobs: below every interactive endpoint
+
+# Behind router.py (or another proxy) the caller's address, which keys chat sessions, is in X-Forwarded-For
+if PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
 
 # Global variable for public URL
 public_url = None
@@ -27,24 +117,105 @@ public_url = None
 # Model configuration
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-# Initialize model and tokenizer with proper error handling
-try:
-    logger.info(f"Loading tokenizer and model from {MODEL_PATH}...")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    model.to(device)
-    model.eval()
-    logger.info(f"Model loaded successfully on {device}")
-except Exception as e:
-    logger.error(f"Failed to load model: {str(e)}")
-    # We'll handle this in a more graceful way instead of raising
-    model = None
-    tokenizer = None
+# Model, tokenizer and everything built on them are set once the model manager has loaded the weights
+model = None
+tokenizer = None
+engine = None
+document_store = None
+chat_sessions = None
+
+# Prometheus metrics: per-endpoint request latency, phase timings, token counts and in-flight requests
+metrics = MetricsRegistry()
+requests_total = metrics.counter("requests_total", "HTTP requests by endpoint and status code")
+requests_in_flight = metrics.gauge("requests_in_flight", "HTTP requests currently being handled (including open streams)")
+request_seconds = metrics.histogram("request_duration_seconds", "End-to-end request latency")
+phase_seconds = metrics.histogram("phase_duration_seconds", "Time spent per request phase")
+token_seconds = metrics.histogram("time_per_output_token_seconds", "Decode latency per generated token (at its request's mean)")
+input_tokens = metrics.histogram("input_tokens", "Prompt tokens per request", TOKEN_BUCKETS)
+output_tokens = metrics.histogram("output_tokens", "Generated tokens per request", TOKEN_BUCKETS)
+decode_steps_saved = metrics.counter("decode_steps_saved_total", "Decode steps skipped by stopping requests early, by finish reason")
+completion_sources = metrics.counter("completion_source_total", "Ghost completions by source (model, cache or fallback) and fallback reason")
+
+# Helper function to time a phase of the current request (no-op outside a request, e.g. during warmup)
+def trace_phase(name):
+    if has_request_context() and "trace" in g:
+        return g.trace.phase(name)
+    return contextlib.nullcontext()
+
+# Helper function to attach an engine request to the current request's trace
+def track(req):
+    if has_request_context() and "trace" in g:
+        g.trace.attach(req)
+    return req
+
+# Helper function to tell whether the current request is a /batch job run in-process
+def is_batch_job():
+    return has_request_context() and request.environ.get("codegenie.batch", False)
+
+# Helper function to decode generated token ids, timed as the detokenize phase
+def decode_tokens(output_ids):
+    with trace_phase("detokenize"):
+        return tokenizer.decode(output_ids, skip_special_tokens=True)
+
+@app.before_request
+def start_trace():
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    g.trace = RequestTrace(endpoint)
+    g.received_at = time.time()  # deadlines count from arrival
+    requests_in_flight.inc(endpoint=endpoint)
+    if request.is_json:
+        with g.trace.phase("parse"):
+            request.get_json(silent=True)  # cached by Flask, so handlers don't parse again
+
+# Record the trace once the response is complete; streamed bodies finish after the handler returns
+@app.after_request
+def finish_trace(response):
+    trace = g.pop("trace", None)
+    if trace is None:
+        return response
+    handled = time.perf_counter()
+
+    def record():
+        total = time.perf_counter() - trace.started
+        if not response.is_streamed:
+            trace.close(handled)
+        breakdown = trace.breakdown(total)
+        labels = {"endpoint": trace.endpoint}
+        requests_in_flight.dec(**labels)
+        requests_total.inc(status=str(response.status_code), **labels)
+        request_seconds.observe(total, **labels)
+        for phase, ms in breakdown["phases_ms"].items():
+            if phase != "total":
+                phase_seconds.observe(ms / 1000, phase=phase, **labels)
+        if trace.requests:
+            input_tokens.observe(breakdown["input_tokens"], **labels)
+            output_tokens.observe(breakdown["output_tokens"], **labels)
+            for req in trace.requests:
+                # One observation per token gap, timed over this request's own decode span
+                gaps = len(req.output_ids) - 1
+                if gaps > 0 and req.first_token_at is not None and req.finished_at is not None:
+                    token_seconds.observe((req.finished_at - req.first_token_at) / gaps, count=gaps, **labels)
+                if req.decode_steps_saved:
+                    decode_steps_saved.inc(req.decode_steps_saved, reason=req.finish_reason, **labels)
+        return breakdown
+
+    if response.is_streamed:
+        response.call_on_close(record)
+        return response
+
+    breakdown = record()
+    # Opt-in timing breakdown for this request
+    if request.headers.get("X-Trace", "").lower() in ("1", "true"):
+        response.headers["X-Trace"] = json.dumps(breakdown, separators=(",", ":"))
+        response.headers["Server-Timing"] = format_server_timing(breakdown)
+    return response
 
 # Helper function to ensure model is loaded
 def ensure_model():
-    if model is None or tokenizer is None:
-        return False, {"error": "Model not properly initialized"}, 503
+    if model_manager.status == "not_loaded":
+        model_manager.load(background=True)  # lazy mode: the first request starts loading
+    if not model_manager.ready:
+        return False, {"error": f"Model not ready (status: {model_manager.status})"}, 503
     return True, None, None
 
 # Standardized error response function
@@ -68,40 +239,373 @@ def connection_info():
     return jsonify({
         "status": "connected",
         "server_url": public_url,
-        "model_status": "ready" if model is not None and tokenizer is not None else "not_ready",
+        "model_status": model_manager.status,
         "device": device
     })
 
-# Endpoint 1: /generate (uses 'prompt') - NO LANGUAGE CONTEXT ADDED
-chat_history = []
-
-# Initialize model and tokenizer with proper error handling
-try:
-    logger.info(f"Loading tokenizer and model from {MODEL_PATH}...")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(MODEL_PATH, trust_remote_code=True)
-    model.to(device)
-    model.eval()
-    logger.info(f"Model loaded successfully on {device}")
-except Exception as e:
-    logger.error(f"Failed to load model: {str(e)}")
-    # We'll handle this in a more graceful way instead of raising
-    model = None
-    tokenizer = None
-
-# Helper function to ensure model is loaded
-def ensure_model():
-    if model is None or tokenizer is None:
-        return False, {"error": "Model not properly initialized"}, 503
-    return True, None, None
-
-# Standardized error response function
-def error_response(message, status_code=400):
-    logger.error(message)
-    return jsonify({"error": message}), status_code
+# Worker pool mode: workers map the weights through CPU shared memory, which quantized modules don't support
+use_worker_pool = MODEL_WORKERS > 1 and device == "cpu" and MODEL_PRECISION in ("fp32", "bf16")
+if MODEL_WORKERS > 1 and not use_worker_pool:
+    logger.warning("MODEL_WORKERS needs a CPU device and fp32 or bf16 weights, running a single engine")
+
+# Prefix KV cache shared by all endpoints: repeated document prefixes, language headers and
+# instruction preambles are prefilled once and reused by later requests (pool workers keep their own)
+prefix_cache = PrefixCache(PREFIX_CACHE_MB * 1024 * 1024) if PREFIX_CACHE_MB > 0 and not use_worker_pool else None
+
+# Response cache for deterministic generations (greedy, or sampling with a client-supplied seed)
+response_cache = ResponseCache(
+    RESPONSE_CACHE_MB * 1024 * 1024, path=RESPONSE_CACHE_PATH or None
+) if RESPONSE_CACHE_MB > 0 else None
+
+# N-gram completer for /hf-complete when the model can't answer in time; learns from the code it is sent
+# and from synced documents, and works before the model has loaded
+fallback_completer = NgramCompleter(max_contexts=FALLBACK_MAX_CONTEXTS) if FALLBACK_COMPLETIONS else None
+hf_complete_latency = LatencyEstimate(max_age=FALLBACK_LATENCY_TTL)
+
+# Helper function to tell why /hf-complete should answer from the fallback instead of the model:
+# "loading", "queue" (engine backlog) or "deadline" (recent model latency would miss it); None uses the model.
+# Batch jobs always wait for the model: they fill the queue themselves and nobody is typing.
+def fallback_reason():
+    if fallback_completer is None or is_batch_job():
+        return None
+    if not model_manager.ready:
+        return "loading"
+    if engine.snapshot()["queue_depth"] >= FALLBACK_QUEUE_DEPTH:
+        return "queue"
+    deadline, expected = g.get("deadline"), hf_complete_latency.value
+    if deadline is not None and expected is not None and time.time() + expected > deadline:
+        return "deadline"
+    return None
+
+# Helper function to parse "endpoint=value,..." settings into a dict of integers
+def parse_endpoint_settings(value):
+    settings = {}
+    for item in value.split(","):
+        if "=" in item:
+            endpoint, setting = item.split("=", 1)
+            settings[endpoint.strip()] = int(setting)
+    return settings
+
+endpoint_priorities = parse_endpoint_settings(ENDPOINT_PRIORITY)
+endpoint_deadlines = parse_endpoint_settings(ENDPOINT_DEADLINE_MS)
+
+# Admission control for generation endpoints: a bounded number of requests wait on the engine and
+# the rest are turned away with 429 + Retry-After. Health, stats and document sync are never gated.
+admission_limit = MAX_PENDING_GENERATIONS
+if SERVER_MODE == "waitress" and admission_limit > SERVER_THREADS - 4:
+    # Every admitted request occupies a worker thread, so keep some free for the cheap endpoints
+    admission_limit = max(SERVER_THREADS - 4, 1)
+    logger.warning(f"MAX_PENDING_GENERATIONS lowered to {admission_limit} to leave threads for cheap endpoints")
+admission = AdmissionController(
+    admission_limit, parse_endpoint_settings(ENDPOINT_CONCURRENCY)
+) if MAX_PENDING_GENERATIONS > 0 else None
+
+# Helper function to read the request's "deadlineMs" (time budget from arrival), falling back to the
+# endpoint's default; returns (deadline as a time.time() value or None, error)
+def parse_deadline(data):
+    if is_batch_job():
+        return None, None  # batch jobs are after throughput; a deadline would only drop them
+    budget = data.get("deadlineMs") if isinstance(data, dict) else None
+    if budget is None:
+        budget = endpoint_deadlines.get(request.url_rule.rule)
+    if budget is None:
+        return None, None
+    if not isinstance(budget, (int, float)) or isinstance(budget, bool) or budget <= 0:
+        return None, error_response('Invalid "deadlineMs" value. Expected a positive number of milliseconds')
+    return g.received_at + budget / 1000, None
+
+# Decorator for routes that can answer from the n-gram fallback (g.fallback_reason says why) without the model
+def serves_fallback(view):
+    view.serves_fallback = True
+    return view
+
+# Decorator for generation endpoints: read the request's deadline, then take an admission slot for the
+# whole request (until a streamed body is closed) or reject it before any work is done. Routes that serve
+# the fallback skip the slot when they will use it anyway, and use it instead of rejecting the request.
+def admission_controlled(view):
+    can_fall_back = getattr(view, "serves_fallback", False)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.deadline, deadline_error = parse_deadline(request.get_json(silent=True))
+        if deadline_error:
+            return deadline_error
+        g.fallback_reason = fallback_reason() if can_fall_back else None
+        # Batch jobs are already throttled by their /batch request, which holds its own slot
+        if admission is None or is_batch_job() or g.fallback_reason:
+            return view(*args, **kwargs)
+        try:
+            release = admission.acquire(request.url_rule.rule)
+        except AdmissionRejected as e:
+            if can_fall_back and fallback_completer is not None:
+                g.fallback_reason = "admission"
+                return view(*args, **kwargs)
+            logger.warning(f"Rejected {request.path}: {e}")
+            response = jsonify({"error": str(e), "retry_after": e.retry_after})
+            response.status_code = 429
+            response.headers["Retry-After"] = str(e.retry_after)
+            return response
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            release()
+            raise
+        if response.is_streamed:
+            response.call_on_close(release)
+        else:
+            release()
+        return response
+    return wrapper
+
+# Called by the model manager once the weights are loaded
+def setup_generation(manager):
+    global model, tokenizer, engine, document_store, chat_sessions
+    model, tokenizer = manager.model, manager.tokenizer
+
+    # Synced editor documents: opened once, then updated with edit deltas
+    document_store = DocumentStore(tokenizer, max_documents=MAX_OPEN_DOCUMENTS)
+
+    # Chat conversations for /generate, each keeping its token ids and KV cache between turns
+    chat_sessions = SessionStore(
+        tokenizer, CHAT_SESSION_MB * 1024 * 1024, token_budget=CHAT_TOKEN_BUDGET, idle_ttl=CHAT_SESSION_TTL
+    )
+
+    # Shared generation engine: every endpoint submits here so concurrent requests decode as one batch
+    backend_options = dict(precision=MODEL_PRECISION, static_lengths=STATIC_CACHE_LENGTHS, onnx_path=ONNX_PATH)
+    if use_worker_pool:
+        check_backend(INFERENCE_BACKEND, device, MODEL_PRECISION)
+        if INFERENCE_BACKEND == "onnx":
+            export_onnx_decoder(model, ONNX_PATH)  # once here, rather than in every worker
+        # One engine per worker process, each pinned to its own CPUs, all mapping the same weights
+        engine = WorkerPool(
+            model, device, workers=MODEL_WORKERS, threads_per_worker=WORKER_THREADS,
+            max_batch_size=MAX_BATCH_SIZE, prefix_cache_bytes=max(PREFIX_CACHE_MB, 0) * 1024 * 1024,
+            backend=INFERENCE_BACKEND, backend_options=backend_options
+        ).start()
+    else:
+        backend = create_backend(INFERENCE_BACKEND, model, device, max_batch_size=MAX_BATCH_SIZE, **backend_options)
+        engine = GenerationEngine(
+            model, device, max_batch_size=MAX_BATCH_SIZE, prefix_cache=prefix_cache, backend=backend
+        ).start()
+
+# Run one short generation per engine process so the first real request doesn't pay one-time costs,
+# after compiling or exporting the backend's decode graphs (pool workers do that before they start)
+def warmup_generation(manager):
+    if not use_worker_pool:
+        engine.backend.warmup()
+    input_ids = tokenizer(get_language_context("Python") + "def hello_world():")["input_ids"]
+    # Submitted together, so the pool spreads them over its workers
+    warmups = [engine.submit(input_ids, WARMUP_TOKENS, eos_token_id=tokenizer.eos_token_id)
+               for _ in range(MODEL_WORKERS if use_worker_pool else 1)]
+    for req in warmups:
+        req.wait()
+
+# Loads the tokenizer and model exactly once; /health reports "loading" until it is ready
+model_manager = ModelManager(
+    MODEL_PATH, device,
+    precision=MODEL_PRECISION,
+    on_loaded=setup_generation,
+    warmup=warmup_generation if WARMUP_TOKENS > 0 else None
+)
+# Pool workers are spawned processes that re-import this module; only the serving process loads the model
+if MODEL_LOAD_MODE != "lazy" and multiprocessing.parent_process() is None:
+    model_manager.load(background=MODEL_LOAD_MODE == "background")
+
+# Helper function to queue a prompt (text or token ids) on the shared engine and return its request handle
+def submit_prompt(prompt, max_new_tokens, **options):
+    if isinstance(prompt, str):
+        with trace_phase("tokenize"):
+            prompt = tokenizer(prompt)["input_ids"]
+    if is_batch_job():
+        options.setdefault("priority", BATCH_PRIORITY)
+    elif has_request_context() and request.url_rule is not None:
+        # Interactive requests are scheduled by their endpoint's priority class and their deadline
+        options.setdefault("priority", endpoint_priorities.get(request.url_rule.rule, 0))
+        options.setdefault("deadline", g.get("deadline"))
+    return track(engine.submit(prompt, max_new_tokens, eos_token_id=tokenizer.eos_token_id, **options))
+
+# Helper function to run a prompt through the shared engine and decode only the new tokens
+def generate_text(prompt, max_new_tokens, **sampling):
+    return decode_tokens(submit_prompt(prompt, max_new_tokens, **sampling).wait())
+
+# Helper function to get the speculative decoding options for an endpoint (merged into its sampling
+# parameters, so they also key the response cache)
+def speculative_options(endpoint):
+    # Batch jobs are after throughput, which the padded batch gives; speculative requests run one by one
+    if endpoint not in SPECULATIVE_ENDPOINTS or SPECULATIVE_DRAFT_TOKENS <= 0 or is_batch_job():
+        return {}
+    return {"draft_tokens": SPECULATIVE_DRAFT_TOKENS, "draft_ngram": SPECULATIVE_NGRAM}
+
+# Helper function to tag a request with its id and, for keystroke-driven endpoints, a
+# client/document key so that a newer request for the same document supersedes it
+def get_request_scope(data, supersede=False):
+    client_id = data.get("clientId")
+    document_id = data.get("documentId")
+    return {
+        "request_id": data.get("requestId"),
+        "supersede_key": f"{client_id}:{document_id}" if supersede and client_id and document_id else None
+    }
+
+# Helper function to find the synced document for a request that sends "documentId" instead of
+# the full text field; returns (document, error) and (None, None) for full-text requests
+def get_synced_document(data, text_field):
+    if data.get(text_field) or not data.get("documentId"):
+        return None, None
+    try:
+        return document_store.get(data["documentId"]), None
+    except KeyError:
+        return None, error_response(f"Unknown document {data['documentId']}. Open it via /documents/open first", 404)
+
+# Helper function to read a synced document's "cursor" (a UTF-16 offset, as the editor counts) as a str index
+def document_cursor(document, data):
+    return document.char_index(int(data["cursor"])) if "cursor" in data else len(document.text)
+
+# Helper function to build prompt token ids from a window of a synced document around "cursor";
+# returns (prompt_ids, prompt_text), with the text used for logging and cache keys
+def build_document_prompt(document, data, language_context, suffix_ratio=0.0, instruction=""):
+    cursor = document_cursor(document, data)
+    budget = min(int(data.get("tokenBudget", DOCUMENT_TOKEN_BUDGET)), DOCUMENT_TOKEN_BUDGET)
+    with trace_phase("tokenize"):
+        prefix, suffix = document_store.build_window(document, cursor, budget, suffix_ratio)
+        prompt_ids = tokenizer(language_context)["input_ids"] + prefix + suffix
+        if instruction:
+            prompt_ids += tokenizer(instruction, add_special_tokens=False)["input_ids"]
+        prompt_text = language_context + tokenizer.decode(prefix + suffix) + instruction
+    return prompt_ids, prompt_text
+
+# Helper function to read the optional "stream" field ("sse" or "jsonl"); returns (format, error)
+def parse_stream_format(data):
+    try:
+        return get_stream_format(data), None
+    except ValueError as e:
+        return None, error_response(str(e))
+
+# Helper function to read the optional integer "seed" that makes sampling reproducible; returns (seed, error)
+def parse_seed(data):
+    seed = data.get("seed")
+    if seed is None:
+        return None, None
+    if not isinstance(seed, int) or isinstance(seed, bool):
+        return None, error_response('Invalid "seed" value. Expected an integer')
+    return seed, None
+
+# Helper function to read the optional "n" (number of alternative completions); returns (n, error)
+def parse_candidate_count(data):
+    n = data.get("n", 1)
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_CANDIDATES:
+        return None, error_response(f'Invalid "n" value. Expected an integer from 1 to {MAX_CANDIDATES}')
+    return n, None
+
+# Helper function to sample n completions of one prompt. The prompt is prefilled once; every candidate
+# continues from that KV cache with a one-token prefill, and they decode together as one batch.
+# Candidate i uses seed + i, so seeded requests stay reproducible without repeating one sample n times.
+# make_stop_hooks builds each candidate's own stop hooks (they keep per-request decoding state).
+def submit_candidates(input_ids, n, request_id=None, supersede_key=None, make_stop_hooks=None, seed=None, **sampling):
+    make_stop_hooks = make_stop_hooks or list
+    if isinstance(input_ids, str):
+        with trace_phase("tokenize"):
+            input_ids = tokenizer(input_ids)["input_ids"]
+    if n == 1:
+        return [submit_prompt(input_ids, request_id=request_id, supersede_key=supersede_key,
+                              stop_hooks=make_stop_hooks(), seed=seed, **sampling)]
+    shared = submit_prompt(input_ids, 1, keep_cache=True)
+    shared.wait()
+    # The candidates supersede earlier requests for the document together, without replacing each other
+    group = uuid.uuid4().hex
+    candidates = [
+        submit_prompt(
+            input_ids, past=shared.cache, stop_hooks=make_stop_hooks(), logprobs=True,
+            seed=seed + index if seed is not None else None, supersede_key=supersede_key, supersede_group=group,
+            request_id=request_id if index == 0 else None, **sampling
+        )
+        for index in range(n)
+    ]
+
+    # Only the first candidate carries the client's requestId, so cancelling it cancels the rest
+    def cancel_siblings(req):
+        if req.finish_reason == "cancelled":
+            for sibling in candidates[1:]:
+                sibling.cancel()
+
+    candidates[0].add_done_callback(cancel_siblings)
+    return candidates
+
+# Helper function to wait for candidates. Ones dropped on their own (e.g. expired in the queue) are left
+# out; if none finished, or the request itself was cancelled or superseded, that error is raised.
+def wait_candidates(candidates):
+    finished, first_error = [], None
+    for req in candidates:
+        try:
+            req.wait()
+            finished.append(req)
+        except GenerationCancelled as e:
+            first_error = first_error or e
+    if not finished or candidates[0].finish_reason in ("cancelled", "superseded"):
+        raise first_error
+    return finished
+
+# Helper function to rank finished candidates by mean token log-probability and drop duplicate texts;
+# returns [{"completion", "score"}], best first
+def rank_candidates(candidates, texts):
+    ranked, seen = [], set()
+    for req, text in sorted(zip(candidates, texts), key=lambda item: item[0].mean_logprob, reverse=True):
+        if text in seen:
+            continue
+        seen.add(text)
+        ranked.append({"completion": text, "score": round(req.mean_logprob, 4)})
+    # An empty suggestion is only kept when nothing else came back
+    return [candidate for candidate in ranked if candidate["completion"]] or ranked[:1]
+
+# Helper function to look up a finished response; returns (cache_key, cached_body).
+# Only greedy or seeded generations are cacheable, and streaming requests always generate.
+def lookup_cached_response(endpoint, prompt, language_context, sampling, stream_format=None):
+    if response_cache is None or stream_format:
+        return None, None
+    if sampling.get("do_sample") and sampling.get("seed") is None:
+        return None, None
+    cache_key = ResponseCache.make_key(endpoint, prompt, language_context, sampling)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        logger.info(f"Serving {endpoint} from response cache")
+    return cache_key, cached
+
+# Helper function to tell whether a generation of the current request was cut short by its deadline
+def hit_deadline():
+    return has_request_context() and "trace" in g and any(req.finish_reason == "deadline" for req in g.trace.requests)
+
+# Helper function to return a JSON body, storing it in the response cache when it is cacheable.
+# Output cut short by the request's deadline is marked "partial" and never cached.
+def cached_jsonify(cache_key, body):
+    if hit_deadline():
+        return jsonify(dict(body, partial=True))
+    if cache_key is not None:
+        response_cache.put(cache_key, body)
+    return jsonify(body)
+
+# Helper function to answer a generation that was abandoned: 504 when its deadline passed before it
+# started, 409 when it was cancelled or superseded
+def cancelled_response(e):
+    return error_response(str(e), 504 if isinstance(e, GenerationExpired) else 409)
+
+# Helper function to clean up a raw chat reply (shared by streamed and regular /generate)
+def clean_chat_response(response_text):
+    # Remove any trailing conversation markers
+    response_text = response_text.strip()
+    response_text = response_text.split("Human:")[0].strip()
+    response_text = response_text.split("Assistant:")[0].strip()
+
+    # If response is empty or too short, provide a fallback
+    if not response_text or len(response_text) < 5:
+        response_text = "I understand your question. Could you please provide more details or rephrase it?"
+    return response_text
+
+# Helper function to pick the chat session of a request: "sessionId", else "clientId", else the caller's address
+def get_session_id(data):
+    return data.get("sessionId") or data.get("clientId") or request.remote_addr
 
 # Endpoint 1: /generate (uses 'prompt')
 @app.route('/generate', methods=['POST'])
+@admission_controlled
 def generate():
     try:
         # Check model availability
@@ -120,76 +624,63 @@ def generate():
         if not prompt:
             return error_response("No prompt provided")
 
-        logger.info(f"Processing new prompt: {prompt[:100]}...")
+        stream_format, stream_error = parse_stream_format(data)
+        if stream_error:
+            return stream_error
 
-        # Build conversation context
-        conversation = []
-        for i, (prev_prompt, prev_response) in enumerate(chat_history[-5:]):  # Limit to last 5 exchanges
-            conversation.append(f"Human: {prev_prompt}")
-            conversation.append(f"Assistant: {prev_response}")
-        
-        # Add current prompt
-        conversation.append(f"Human: {prompt}")
-        conversation.append("Assistant:")
-        
-        full_prompt = "\n\n".join(conversation)
-        
-        logger.info(f"Full conversation context length: {len(full_prompt)}")
+        logger.info(f"Processing new prompt: {prompt[:100]}...")
 
-        # Tokenize and generate
-        with torch.no_grad():
-            inputs = tokenizer(full_prompt, return_tensors="pt").to(device)
-            
-            # Get the length of input tokens to extract only the generated part
-            input_length = inputs['input_ids'].shape[1]
-            
-            output_tokens = model.generate(
-                **inputs,
-                max_length=input_length + 512,  # Generate up to 512 new tokens
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9,
-                num_return_sequences=1,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id
-            )
+        # Generate up to 512 new tokens (response only)
+        sampling = dict(max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, **speculative_options("/generate"))
+
+        # Conversation context: the session's earlier turns come with their KV cache,
+        # so only the new message is prefilled
+        session_id = get_session_id(data)
+        with trace_phase("tokenize"):
+            input_ids, past = chat_sessions.begin_turn(session_id, prompt, sampling["max_new_tokens"])
+        reused = past[0][0].shape[2] if past is not None else 0
+        logger.info(f"Session {session_id}: conversation of {len(input_ids)} tokens, {reused} already cached")
+
+        # Store the cleaned reply (and the KV cache for it) in the session
+        def finish_turn(text):
+            response_text = clean_chat_response(text)
+            chat_sessions.end_turn(session_id, prompt, input_ids, req.output_ids, req.cache, response_text)
+            return {"response": response_text}
+
+        # Stop decoding as soon as the model starts writing the next turn itself
+        req = submit_prompt(
+            input_ids, past=past, keep_cache=True, stream=bool(stream_format),
+            stop_hooks=[StopStrings(tokenizer, ["Human:", "Assistant:"])], **get_request_scope(data), **sampling
+        )
+        if stream_format:
+            return stream_generation(req, tokenizer, stream_format, StopStringFilter(["Human:", "Assistant:"]), finish_turn)
 
-            # Extract only the newly generated tokens (response)
-            generated_tokens = output_tokens[0][input_length:]
-            response_text = tokenizer.decode(generated_tokens, skip_special_tokens=True).strip()
-            
-            # Clean up response - remove any trailing conversation markers
-            response_text = response_text.split("Human:")[0].strip()
-            response_text = response_text.split("Assistant:")[0].strip()
-            
-            # If response is empty or too short, provide a fallback
-            if not response_text or len(response_text) < 5:
-                response_text = "I understand your question. Could you please provide more details or rephrase it?"
+        req.wait()
+        response_text = finish_turn(decode_tokens(req.output_ids))["response"]
 
         logger.info(f"Generated clean response: {response_text[:100]}...")
 
-        # Save this pair to history (limit history size)
-        chat_history.append((prompt, response_text))
-        if len(chat_history) > 10:  # Keep only last 10 exchanges
-            chat_history.pop(0)
-
         logger.info(f"Generated response of length: {len(response_text)}")
-        return jsonify({"response": response_text})
+        return cached_jsonify(None, {"response": response_text})
 
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         logger.exception(f"Error in /generate: {str(e)}")
         return error_response(f"An internal error occurred: {str(e)}", 500)
 
-# Clear chat history endpoint
+# Clear chat history endpoint (only the caller's session)
 @app.route('/clear_history', methods=['POST'])
 def clear_history():
-    global chat_history
-    chat_history = []
-    logger.info("Chat history cleared")
+    session_id = get_session_id(request.get_json(silent=True) or {})
+    if chat_sessions is not None:
+        chat_sessions.clear(session_id)
+    logger.info(f"Chat history cleared for session {session_id}")
     return jsonify({"message": "Chat history cleared successfully"})
 
 # Endpoint 2: /complete (uses 'text') - WITH LANGUAGE CONTEXT
 @app.route('/complete', methods=['POST'])
+@admission_controlled
 def complete():
     try:
         # Check model availability
@@ -202,49 +693,88 @@ def complete():
             return error_response("Invalid content type. Expected application/json")
 
         data = request.get_json()
-        if not isinstance(data, dict) or 'text' not in data:
+        if not isinstance(data, dict) or ('text' not in data and 'documentId' not in data):
             return error_response('Missing or invalid "text" field in request')
 
-        input_text = data['text'].strip()
-        if not input_text:
+        # Synced documents send "documentId" + "cursor" instead of the full text
+        document, document_error = get_synced_document(data, 'text')
+        if document_error:
+            return document_error
+
+        input_text = data.get('text', '').strip()
+        if not input_text and document is None:
             return error_response('Empty input text')
 
+        stream_format, stream_error = parse_stream_format(data)
+        if stream_error:
+            return stream_error
+
+        seed, seed_error = parse_seed(data)
+        if seed_error:
+            return seed_error
+
+        n, n_error = parse_candidate_count(data)
+        if n_error:
+            return n_error
+        if n > 1 and stream_format:
+            return error_response('Streaming supports a single completion; omit "n" or set it to 1')
+
         # Get language context
-        language_name = data.get('languageName', '')
-        file_name = data.get('fileName', '')
+        language_name = data.get('languageName', '') or (document.language_name if document else '')
+        file_name = data.get('fileName', '') or (document.file_name if document else '')
         language_context = get_language_context(language_name, file_name)
 
-        logger.info(f"Processing /complete request for input length: {len(input_text)} with language: {language_name}")
+        logger.info(f"Processing /complete request for input length: {len(input_text or document.text)} with language: {language_name}")
 
         # Add language context to the input
-        enhanced_input = language_context + input_text
+        if document is not None:
+            enhanced_input, prompt_text = build_document_prompt(document, data, language_context)
+        else:
+            enhanced_input = prompt_text = language_context + input_text
 
         # Generate completion
-        with torch.no_grad():
-            inputs = tokenizer(enhanced_input, return_tensors="pt").to(device)
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=500,
-                temperature=0.7,
-                top_p=0.95,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id
-            )
-            completion = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+        sampling = dict(
+            max_new_tokens=500, temperature=0.7, top_p=0.95, do_sample=True, seed=seed,
+            **speculative_options("/complete")
+        )
+
+        cache_key, cached = lookup_cached_response(
+            "/complete", prompt_text, language_context, dict(sampling, n=n) if n > 1 else sampling, stream_format
+        )
+        if cached is not None:
+            return jsonify(cached)
+
+        if stream_format:
+            req = submit_prompt(enhanced_input, stream=True, **get_request_scope(data, supersede=True), **sampling)
+            return stream_generation(req, tokenizer, stream_format)
+
+        # With "n", the alternatives share one prefill and come back ranked, best first
+        candidates = wait_candidates(
+            submit_candidates(enhanced_input, n, **get_request_scope(data, supersede=True), **sampling)
+        )
+        ranked = rank_candidates(candidates, [decode_tokens(req.output_ids) for req in candidates])
+        completion = ranked[0]["completion"]
 
         logger.info(f"Generated completion of length: {len(completion)}")
-        return jsonify({'completion': completion})
+        body = {'completion': completion}
+        if n > 1:
+            body['candidates'] = ranked
+        return cached_jsonify(cache_key, body)
 
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         return error_response(f"Error in /complete: {str(e)}", 500)
     
 # Endpoint 3: /hf-complete (uses 'code') - WITH LANGUAGE CONTEXT
 @app.route('/hf-complete', methods=['POST'])
+@admission_controlled
+@serves_fallback
 def hf_complete():
     try:
-        # Check model availability
+        # Check model availability; while it loads, the fallback can still complete raw "code"
         model_ready, error_msg, status_code = ensure_model()
-        if not model_ready:
+        if not model_ready and (fallback_completer is None or not (request.get_json(silent=True) or {}).get("code")):
             return error_msg, status_code
             
         # Validate request format
@@ -254,55 +784,109 @@ def hf_complete():
         data = request.get_json()
         input_text = data.get("code", "").strip()
 
-        if not input_text:
+        # Synced documents send "documentId" + "cursor" instead of the code
+        document, document_error = get_synced_document(data, "code") if model_ready else (None, None)
+        if document_error:
+            return document_error
+
+        if not input_text and document is None:
             return error_response("No code provided")
 
+        # Code up to the cursor, for the fallback completer; raw code is learned from as it arrives
+        # (in full once per client and file, then the line each keystroke request has just finished)
+        language_name = data.get('languageName', '') or (document.language_name if document else '')
+        if document is not None:
+            cursor_text = document.text[:document_cursor(document, data)]
+        else:
+            cursor_text = data.get("code", "")
+            if fallback_completer is not None:
+                source = f"{data['clientId']}:{data.get('fileName', '')}" if data.get("clientId") else None
+                fallback_completer.learn_typing(cursor_text, language_name, source)
+
+        reason = g.get("fallback_reason") or fallback_reason()
+        if reason is not None:
+            with trace_phase("fallback"):
+                suggestion = fallback_completer.complete(cursor_text, language_name)
+            completion_sources.inc(source="fallback", reason=reason)
+            logger.info(f"HF-complete fallback ({reason}) suggestion of length: {len(suggestion)}")
+            return jsonify({"completion": suggestion, "source": "fallback", "fallback_reason": reason})
+        started = time.time()
+
+        seed, seed_error = parse_seed(data)
+        if seed_error:
+            return seed_error
+
+        n, n_error = parse_candidate_count(data)
+        if n_error:
+            return n_error
+
         # Get language context
-        language_name = data.get('languageName', '')
-        file_name = data.get('fileName', '')
+        file_name = data.get('fileName', '') or (document.file_name if document else '')
         language_context = get_language_context(language_name, file_name)
 
-        logger.info(f"Received /hf-complete request for input length {len(input_text)} with language: {language_name}")
+        logger.info(f"Received /hf-complete request for input length {len(input_text or document.text)} with language: {language_name}")
 
         # Add language context to the input
-        enhanced_input = language_context + input_text
-
-        # Generate suggestion
-        with torch.no_grad():
-            inputs = tokenizer(enhanced_input, return_tensors="pt").to(device)
-            outputs = model.generate(
-                **inputs, 
-                max_new_tokens=32,
-                temperature=0.6,
-                top_p=0.95,
-                do_sample=True
-            )
-            full_output = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        if document is not None:
+            input_ids, enhanced_input = build_document_prompt(document, data, language_context)
+        else:
+            enhanced_input = language_context + input_text
+            with trace_phase("tokenize"):
+                input_ids = tokenizer(enhanced_input)["input_ids"]
+
+        sampling = dict(
+            max_new_tokens=32, temperature=0.6, top_p=0.95, do_sample=True, seed=seed,
+            **speculative_options("/hf-complete")
+        )
 
-            # Remove echoed input (including language context)
-            if full_output.startswith(enhanced_input):
-                suggestion = full_output[len(enhanced_input):]
+        cache_key, cached = lookup_cached_response(
+            "/hf-complete", enhanced_input, language_context, dict(sampling, n=n) if n > 1 else sampling
+        )
+        if cached is not None:
+            completion_sources.inc(source="cache", reason="")
+            return jsonify(dict(cached, source="cache"))
+
+        # Generate suggestions, each stopping once the code at the cursor is complete
+        candidates = wait_candidates(submit_candidates(
+            input_ids, n, make_stop_hooks=lambda: [GhostCompletionStop(tokenizer, language_name)],
+            **get_request_scope(data, supersede=True), **sampling
+        ))
+
+        def suggestion_text(req):
+            if document is not None:
+                # The window was built from token ids, so only the new tokens need decoding
+                suggestion = decode_tokens(req.output_ids)
             else:
-                suggestion = full_output
-
-            # Stop suggestion at the start of any new function
-            lines = suggestion.split('\n')
-            filtered = []
-            for line in lines:
-                if line.strip().startswith("def ") and filtered:
-                    break  # Stop if another function is generated
-                filtered.append(line)
-    
-            suggestion = "\n".join(filtered).strip()
+                full_output = decode_tokens(input_ids + req.output_ids)
 
-        logger.info(f"HF-complete suggestion of length: {len(suggestion)}")
-        return jsonify({"completion": suggestion})
+                # Remove echoed input (including language context)
+                if full_output.startswith(enhanced_input):
+                    suggestion = full_output[len(enhanced_input):]
+                else:
+                    suggestion = full_output
+
+            # Cut the suggestion where decoding stopped: a new definition, or the end of the block
+            return req.stop_hooks[0].trim(suggestion).strip()
+
+        ranked = rank_candidates(candidates, [suggestion_text(req) for req in candidates])
+        suggestion = ranked[0]["completion"]
 
+        logger.info(f"HF-complete suggestion of length: {len(suggestion)}")
+        hf_complete_latency.observe(time.time() - started)
+        completion_sources.inc(source="model", reason="")
+        body = {"completion": suggestion, "source": "model"}
+        if n > 1:
+            body["candidates"] = ranked
+        return cached_jsonify(cache_key, body)
+
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         return error_response(f"Error in /hf-complete: {str(e)}", 500)
 
 # Endpoint 4: /fill_in_the_middle (uses 'text') - WITH LANGUAGE CONTEXT
 @app.route("/fill_in_the_middle", methods=["POST"])
+@admission_controlled
 def fill_in_the_middle():
     try:
         # Check model availability
@@ -315,54 +899,70 @@ def fill_in_the_middle():
             return error_response("Invalid content type. Expected application/json")
             
         data = request.get_json()
-        if not isinstance(data, dict) or 'text' not in data:
+        if not isinstance(data, dict) or ('text' not in data and 'documentId' not in data):
             return error_response('Missing or invalid "text" field in request')
-            
-        input_text = data['text'].strip()
-        if not input_text:
+
+        # Synced documents send "documentId" + "cursor" instead of the full text
+        document, document_error = get_synced_document(data, 'text')
+        if document_error:
+            return document_error
+
+        input_text = data.get('text', '').strip()
+        if not input_text and document is None:
             return error_response('Empty input text')
 
+        seed, seed_error = parse_seed(data)
+        if seed_error:
+            return seed_error
+
         # Get language context
-        language_name = data.get('languageName', '')
-        file_name = data.get('fileName', '')
+        language_name = data.get('languageName', '') or (document.language_name if document else '')
+        file_name = data.get('fileName', '') or (document.file_name if document else '')
         language_context = get_language_context(language_name, file_name)
-            
+
         # Create a better prompt for the fill-in-the-middle task with language context
-        prompt = (
-            f"{language_context}"
-            f"{input_text}\n\n"
+        instruction = (
+            "\n\n"
             "----Complete the code by filling in any gaps or implementing missing functionality.\n"
             f"Focus only on providing the missing parts that would make this {language_name or 'code'} more complete.\n"
             "Do not give any other extra block of code, just the present code which contains the filled missing code.\n"
         )
-        
+        if document is not None:
+            # Window around the cursor, with part of the budget kept for the code after it
+            prompt, prompt_text = build_document_prompt(document, data, language_context, FIM_SUFFIX_RATIO, instruction)
+            input_text = prompt_text[len(language_context):-len(instruction)]
+        else:
+            prompt = prompt_text = f"{language_context}{input_text}{instruction}"
+
         logger.info(f"Processing /fill_in_the_middle request for input length: {len(input_text)} with language: {language_name}")
 
+        sampling = dict(
+            max_new_tokens=500, temperature=0.7, top_p=0.95, do_sample=True, seed=seed,
+            **speculative_options("/fill_in_the_middle")
+        )
+
+        cache_key, cached = lookup_cached_response("/fill_in_the_middle", prompt_text, language_context, sampling)
+        if cached is not None:
+            return jsonify(cached)
+
         # Generate completion
-        with torch.no_grad():
-            inputs = tokenizer(prompt, return_tensors="pt").to(device)
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=500,
-                temperature=0.7,
-                top_p=0.95,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id
-            )
-            completion = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
-            
-            # Check if we just got back something too similar to the input
-            if completion.strip() == input_text.strip():
-                completion = f"// No additional {language_name or 'code'} needed"
+        completion = generate_text(prompt, **get_request_scope(data), **sampling)
+
+        # Check if we just got back something too similar to the input
+        if completion.strip() == input_text.strip():
+            completion = f"// No additional {language_name or 'code'} needed"
 
         logger.info(f"Generated fill-in-the-middle completion of length: {len(completion)}")
-        return jsonify({'completion': completion})
+        return cached_jsonify(cache_key, {'completion': completion})
 
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         return error_response(f"Error in /fill_in_the_middle: {str(e)}", 500)
 
 # Endpoint 5: /debug (code debugging and analysis) - WITH LANGUAGE CONTEXT
 @app.route('/debug', methods=['POST'])
+@admission_controlled
 def debug_code():
     def analyze_code_issues(code):
         # Basic dummy issue detection for placeholder
@@ -385,6 +985,14 @@ def debug_code():
         if not prompt:
             return error_response("No prompt provided")
 
+        stream_format, stream_error = parse_stream_format(data)
+        if stream_error:
+            return stream_error
+
+        seed, seed_error = parse_seed(data)
+        if seed_error:
+            return seed_error
+
         # Get language context
         language_name = data.get('languageName', '')
         file_name = data.get('fileName', '')
@@ -423,38 +1031,48 @@ def debug_code():
         if not model_ready:
             return error_msg, status_code
 
-        with torch.no_grad():
-            inputs = tokenizer(prompt, return_tensors="pt").to(device)
-            output_tokens = model.generate(
-                **inputs,
-                max_length=inputs['input_ids'].shape[1] + 512,
-                do_sample=True,
-                temperature=0.7,
-                top_p=0.9,
-                num_return_sequences=1,
-                pad_token_id=tokenizer.eos_token_id
-            )
+        def format_response(response_text):
+            response_text = response_text.strip()
+            if is_debug_request:
+                if "1." not in response_text and "2." not in response_text:
+                    response_text = (
+                        f"## {language_name or 'Code'} Analysis\n\n" +
+                        response_text +
+                        "\n\n## Suggested Fixes\n\n" +
+                        f"Here are the recommended changes to improve the {language_name or 'code'}..."
+                    )
+            return response_text
+
+        sampling = dict(
+            max_new_tokens=512, do_sample=True, temperature=0.7, top_p=0.9, seed=seed,
+            **speculative_options("/debug")
+        )
 
-            response_text = tokenizer.decode(output_tokens[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True).strip()
+        cache_key, cached = lookup_cached_response("/debug", prompt, language_context, sampling, stream_format)
+        if cached is not None:
+            return jsonify(cached)
 
-        if is_debug_request:
-            if "1." not in response_text and "2." not in response_text:
-                response_text = (
-                    f"## {language_name or 'Code'} Analysis\n\n" +
-                    response_text +
-                    "\n\n## Suggested Fixes\n\n" +
-                    f"Here are the recommended changes to improve the {language_name or 'code'}..."
-                )
+        if stream_format:
+            req = submit_prompt(prompt, stream=True, **get_request_scope(data), **sampling)
+            return stream_generation(
+                req, tokenizer, stream_format, PassthroughFilter(),
+                lambda text: {"response": format_response(text)}
+            )
+
+        response_text = format_response(generate_text(prompt, **get_request_scope(data), **sampling))
 
         logger.info(f"Generated response for /debug (length: {len(response_text)}) with language: {language_name}")
-        return jsonify({"response": response_text})
+        return cached_jsonify(cache_key, {"response": response_text})
 
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         logger.error(f"Error in /debug: {str(e)}")
         return error_response(f"An internal error occurred: {str(e)}", 500)
 
 # Endpoint 6: /optimize - WITH LANGUAGE CONTEXT
 @app.route('/optimize', methods=['POST'])
+@admission_controlled
 def optimize():
     try:
         # Check model availability
@@ -470,6 +1088,10 @@ def optimize():
         if not input_text:
             return error_response('Empty input text')
 
+        stream_format, stream_error = parse_stream_format(data)
+        if stream_error:
+            return stream_error
+
         # Get language context
         language_name = data.get('languageName', '')
         file_name = data.get('fileName', '')
@@ -486,45 +1108,430 @@ def optimize():
             f"{input_text}\n\n# Optimized {language_name or 'Code'}:\n"
         )
         
-        with torch.no_grad():
-            inputs = tokenizer(prompt, return_tensors="pt").to(device)
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=600,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=False,
-                pad_token_id=tokenizer.eos_token_id
+        marker = f"# Optimized {language_name or 'Code'}:"
+
+        # The prompt ends with the marker, so the code starts right away (or after the marker, if the
+        # model repeats it) and ends at the first test line; decoding stops there too
+        def code_stop():
+            return StopLines(tokenizer, ("print(", "# Test Cases"), after=marker)
+
+        # Clean up the response
+        def extract_code(completion):
+            completion = completion.strip()
+            if marker in completion:
+                completion = completion.split(marker)[1]
+            return code_stop().trim(completion).strip()
+
+        sampling = dict(max_new_tokens=600, do_sample=False, **speculative_options("/optimize"))
+
+        # Greedy decoding is deterministic, so identical optimize requests are always served from cache
+        cache_key, cached = lookup_cached_response("/optimize", prompt, language_context, sampling, stream_format)
+        if cached is not None:
+            return jsonify(cached)
+
+        if stream_format:
+            req = submit_prompt(prompt, stream=True, stop_hooks=[code_stop()], **get_request_scope(data), **sampling)
+            return stream_generation(
+                req, tokenizer, stream_format, OptimizedCodeFilter(marker),
+                lambda text: {"completion": extract_code(text)}
             )
-            completion = tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True).strip()
-            
-            # Clean up the response
-            if f"# Optimized {language_name or 'Code'}:" in completion:
-                code_block = completion.split(f"# Optimized {language_name or 'Code'}:")[1].strip()
-                code_lines = code_block.splitlines()
-                func_lines = []
-                for line in code_lines:
-                    if line.strip().startswith("print(") or line.strip().startswith("# Test Cases"):
-                        break
-                    func_lines.append(line)
-                completion = "\n".join(func_lines).strip()
+
+        completion = extract_code(generate_text(prompt, stop_hooks=[code_stop()], **get_request_scope(data), **sampling))
 
         logger.info(f"Generated optimized {language_name or 'code'} of length: {len(completion)}")
-        return jsonify({'completion': completion})
+        return cached_jsonify(cache_key, {'completion': completion})
 
+    except GenerationCancelled as e:
+        return cancelled_response(e)
     except Exception as e:
         logger.exception("Error during optimization")
         return error_response(f"An internal error occurred: {str(e)}", 500)
 
+# Endpoint 7: /analyze_multi (uses 'selections': [{fileName, text}]) - WITH LANGUAGE CONTEXT
+@app.route('/analyze_multi', methods=['POST'])
+@admission_controlled
+def analyze_multi():
+    try:
+        # Check model availability
+        model_ready, error_msg, status_code = ensure_model()
+        if not model_ready:
+            return error_msg, status_code
+
+        if not request.is_json:
+            return error_response("Invalid content type. Expected application/json")
+
+        data = request.get_json()
+        selections = data.get("selections")
+        if not isinstance(selections, list) or not selections:
+            return error_response('Missing or invalid "selections" field in request')
+        if len(selections) > MAX_ANALYZE_SELECTIONS:
+            return error_response(f"Too many selections ({len(selections)}). At most {MAX_ANALYZE_SELECTIONS} per request")
+        if not all(isinstance(s, dict) and isinstance(s.get("text"), str) and s["text"].strip() for s in selections):
+            return error_response('Every selection needs a non-empty "text" field')
+
+        stream_format, stream_error = parse_stream_format(data)
+        if stream_error:
+            return stream_error
+
+        seed, seed_error = parse_seed(data)
+        if seed_error:
+            return seed_error
+
+        # Get language context
+        language_name = data.get('languageName', '')
+        language_context = get_language_context(language_name)
+
+        logger.info(f"Processing /analyze_multi request with {len(selections)} selections")
+
+        # Every selection prompt starts with the same instruction, which is prefilled once and shared
+        shared_prefix = (
+            f"{language_context}"
+            f"You are reviewing {len(selections)} code selections from the same project. "
+            "For the selection below, explain what it does, point out bugs or risks, and suggest improvements.\n\n"
+        )
+        with trace_phase("tokenize"):
+            prefix_ids = tokenizer(shared_prefix)["input_ids"]
+            selection_ids = [
+                prefix_ids + tokenizer(
+                    f"Selection {index + 1} (file: {s.get('fileName') or 'unknown'}):\n```\n{s['text'].strip()}\n```\n\nAnalysis:\n",
+                    add_special_tokens=False
+                )["input_ids"]
+                for index, s in enumerate(selections)
+            ]
+
+        sampling = dict(
+            do_sample=True, temperature=0.7, top_p=0.9, seed=seed,
+            **speculative_options("/analyze_multi")
+        )
+        # One-token request whose finished KV cache covers the shared prefix
+        shared = submit_prompt(prefix_ids, 1, keep_cache=True)
+        shared.wait()
+
+        # Submitted together, the selections are admitted and decoded as one padded batch
+        finished = queue.Queue()
+        requests = []
+        for index, input_ids in enumerate(selection_ids):
+            req = submit_prompt(input_ids, 256, past=shared.cache, **sampling)
+            req.add_done_callback(lambda r, index=index: finished.put(index))
+            requests.append(req)
+
+        def selection_result(index):
+            return {
+                "selection": index + 1,
+                "fileName": selections[index].get("fileName", ""),
+                "analysis": decode_tokens(requests[index].wait()).strip()
+            }
+
+        # Cross-selection pass over the finished analyses
+        def summarize(results):
+            summary_prompt = (
+                f"{language_context}"
+                f"Here are analyses of {len(results)} related code selections:\n\n" +
+                "\n\n".join(f"Selection {r['selection']} ({r['fileName']}): {r['analysis']}" for r in results) +
+                "\n\nSummarize how these selections relate to each other and list the most important cross-cutting issues.\n\nSummary:\n"
+            )
+            return generate_text(summary_prompt, 384, **sampling).strip()
+
+        def combined_analysis(results, summary):
+            sections = [f"## Selection {r['selection']}: {r['fileName']}\n\n{r['analysis']}" for r in results]
+            return "\n\n".join(sections + [f"## Summary\n\n{summary}"])
+
+        if stream_format:
+            def events():
+                results = []
+                try:
+                    # Each selection is sent as soon as its generation finishes
+                    for _ in requests:
+                        result = selection_result(finished.get())
+                        results.append(result)
+                        yield format_event(result, stream_format)
+                    results.sort(key=lambda r: r["selection"])
+                    summary = summarize(results)
+                    yield format_event({
+                        "summary": summary,
+                        "analysis": combined_analysis(results, summary),
+                        "done": True
+                    }, stream_format)
+                except Exception as e:
+                    logger.exception("Error while streaming multi-selection analysis")
+                    yield format_event({"error": f"An internal error occurred: {str(e)}", "done": True}, stream_format)
+                finally:
+                    for req in requests:
+                        if not req.done:
+                            req.cancel()
+
+            return event_stream_response(events(), stream_format)
+
+        try:
+            results = [selection_result(index) for index in range(len(requests))]
+            summary = summarize(results)
+        finally:
+            # A failed or cancelled selection leaves the others nothing to be used for
+            for req in requests:
+                if not req.done:
+                    req.cancel()
+
+        logger.info(f"Generated analysis for {len(results)} selections")
+        return cached_jsonify(None, {
+            "analysis": combined_analysis(results, summary),
+            "selections": results,
+            "summary": summary
+        })
+
+    except GenerationCancelled as e:
+        return cancelled_response(e)
+    except Exception as e:
+        logger.exception("Error during multi-selection analysis")
+        return error_response(f"An internal error occurred: {str(e)}", 500)
+
+# Helper function to run one batch job through its route in-process: low priority, no admission slot, no streaming
+def run_batch_job(job):
+    body = dict(job["body"], stream=False)
+    with app.test_request_context(job["endpoint"], method="POST", json=body, environ_base={"codegenie.batch": True}):
+        response = app.full_dispatch_request()
+    return {
+        "id": job["id"],
+        "endpoint": job["endpoint"],
+        "status": response.status_code,
+        "response": response.get_json(silent=True)
+    }
+
+# Helper function to run batch jobs shortest prompt first with BATCH_SIZE in flight, so the requests
+# decoding together have similar lengths; yields results as they finish and records them in the checkpoint
+def run_batch(jobs, checkpoint=None):
+    if checkpoint is not None:
+        jobs = [job for job in jobs if job["id"] not in checkpoint.completed]
+    lengths = {job["id"]: len(tokenizer(job_text(job))["input_ids"]) for job in jobs}
+    executor = concurrent.futures.ThreadPoolExecutor(BATCH_SIZE, thread_name_prefix="batch")
+    try:
+        futures = [executor.submit(run_batch_job, job) for job in sorted(jobs, key=lambda job: lengths[job["id"]])]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if checkpoint is not None:
+                checkpoint.record(result)
+            yield result
+    finally:
+        # If the client went away, jobs that haven't started are dropped (and rerun on resume)
+        executor.shutdown(wait=False, cancel_futures=True)
+
+# Endpoint 8: /batch (JSONL body, or {"jobs": [...]}, of {"id", "endpoint", "body"} jobs) - results stream back
+# as JSONL. With a "batchId", completed jobs are checkpointed on the server and skipped when the batch is resent.
+@app.route('/batch', methods=['POST'])
+@admission_controlled
+def batch():
+    try:
+        # Check model availability
+        model_ready, error_msg, status_code = ensure_model()
+        if not model_ready:
+            return error_msg, status_code
+
+        if request.is_json:
+            data = request.get_json()
+            items = data.get("jobs") if isinstance(data, dict) else None
+            if not isinstance(items, list):
+                return error_response('Missing or invalid "jobs" field in request')
+            batch_id = data.get("batchId")
+        else:
+            items = request.get_data(as_text=True).splitlines()
+            batch_id = request.args.get("batchId")
+
+        try:
+            jobs = parse_jobs(items)
+        except ValueError as e:
+            return error_response(str(e))
+        if not jobs:
+            return error_response("No jobs provided")
+
+        checkpoint = None
+        if batch_id:
+            if not re.fullmatch(r"[\w.-]+", str(batch_id)):
+                return error_response('Invalid "batchId". Use letters, digits, "_", "-" and "."')
+            checkpoint = BatchCheckpoint(os.path.join(BATCH_DIR, f"{batch_id}.jsonl"))
+        skipped = sum(job["id"] in checkpoint.completed for job in jobs) if checkpoint is not None else 0
+
+        logger.info(f"Processing /batch request with {len(jobs)} jobs ({skipped} already completed)")
+
+        def events():
+            completed = failed = 0
+            try:
+                for result in run_batch(jobs, checkpoint):
+                    completed += result["status"] == 200
+                    failed += result["status"] != 200
+                    yield format_event(result, "jsonl")
+            except Exception as e:
+                logger.exception("Error while running batch")
+                yield format_event({"error": f"An internal error occurred: {str(e)}", "done": True}, "jsonl")
+                return
+            logger.info(f"Batch finished: {completed} completed, {failed} failed, {skipped} skipped")
+            yield format_event({
+                "done": True, "jobs": len(jobs), "completed": completed, "failed": failed, "skipped": skipped
+            }, "jsonl")
+
+        return event_stream_response(events(), "jsonl")
+
+    except Exception as e:
+        logger.exception("Error in /batch")
+        return error_response(f"An internal error occurred: {str(e)}", 500)
+
+# Document sync: register a document's full text once; later requests refer to it by "documentId"
+@app.route('/documents/open', methods=['POST'])
+def open_document():
+    model_ready, error_msg, status_code = ensure_model()
+    if not model_ready:
+        return error_msg, status_code
+    if not request.is_json:
+        return error_response("Invalid content type. Expected application/json")
+
+    data = request.get_json()
+    document_id = data.get("documentId")
+    text = data.get("text")
+    if not document_id or not isinstance(text, str):
+        return error_response('Missing "documentId" or "text" field in request')
+
+    document = document_store.open(
+        document_id, text,
+        language_name=data.get("languageName", ""),
+        file_name=data.get("fileName", ""),
+        version=data.get("version", 0)
+    )
+    if fallback_completer is not None:
+        fallback_completer.learn(text, document.language_name)
+    logger.info(f"Opened document {document_id} ({len(text)} chars, {len(document.chunks)} chunks)")
+    return jsonify({"documentId": document_id, "version": document.version, "chunks": len(document.chunks)})
+
+# Document sync: apply edit deltas ({rangeOffset, rangeLength, text}, offsets in UTF-16 code units as VS Code
+# reports them) to an open document.
+# "baseVersion" (the version the edit applies to) lets the server detect missed edits.
+@app.route('/documents/edit', methods=['POST'])
+def edit_document():
+    model_ready, error_msg, status_code = ensure_model()
+    if not model_ready:
+        return error_msg, status_code
+    if not request.is_json:
+        return error_response("Invalid content type. Expected application/json")
+
+    data = request.get_json()
+    document_id = data.get("documentId")
+    changes = data.get("changes")
+    if not document_id or not isinstance(changes, list):
+        return error_response('Missing "documentId" or "changes" field in request')
+
+    try:
+        document = document_store.edit(document_id, data.get("version"), changes, data.get("baseVersion"))
+    except KeyError:
+        return error_response(f"Unknown document {document_id}. Open it via /documents/open first", 404)
+    except DocumentVersionError as e:
+        # The client's copy has diverged; it should re-open the document with its full text
+        return error_response(str(e), 409)
+    except ValueError as e:
+        return error_response(f"Invalid change in request: {str(e)}")
+
+    # Only finished lines are learned, so edits within a line wait until a newline is typed
+    if fallback_completer is not None and any("\n" in str(change.get("text", "")) for change in changes):
+        fallback_completer.learn(document.text, document.language_name)
+    return jsonify({"documentId": document_id, "version": document.version})
+
+# Document sync: forget a document the editor closed
+@app.route('/documents/close', methods=['POST'])
+def close_document():
+    if document_store is None:
+        return error_response("Model not properly initialized", 503)
+    if not request.is_json:
+        return error_response("Invalid content type. Expected application/json")
+
+    data = request.get_json()
+    closed = document_store.close(data.get("documentId"))
+    return jsonify({"closed": closed})
+
+# Cancel an in-flight generation by "requestId", or the latest one for "clientId" + "documentId"
+@app.route('/cancel', methods=['POST'])
+def cancel():
+    if engine is None:
+        return error_response("Generation engine not initialized", 503)
+    if not request.is_json:
+        return error_response("Invalid content type. Expected application/json")
+
+    data = request.get_json()
+    scope = get_request_scope(data, supersede=True)
+    if not scope["request_id"] and not scope["supersede_key"]:
+        return error_response('Provide "requestId" or both "clientId" and "documentId"')
+
+    cancelled = engine.cancel(request_id=scope["request_id"], supersede_key=scope["supersede_key"])
+    logger.info(f"Cancel request for {scope['request_id'] or scope['supersede_key']}: {'cancelled' if cancelled else 'not found'}")
+    return jsonify({"cancelled": cancelled})
+
 # Add health check endpoint
 @app.route("/health", methods=["GET"])
 def health_check():
-    model_status = "ready" if model is not None and tokenizer is not None else "not_ready"
     return jsonify({
         "status": "ok",
         "server_url": public_url,
-        "model": model_status,
-        "device": device
+        "model": model_manager.status,
+        "device": device,
+        "precision": MODEL_PRECISION,
+        "backend": INFERENCE_BACKEND,
+        "model_load": model_manager.snapshot()
+    })
+
+# Prometheus scrape endpoint: request metrics plus the engine, cache and session counters from /stats
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Export every numeric value of the component snapshots as a gauge at scrape time
+def collect_component_stats():
+    components = {
+        "engine": engine,
+        "prefix_cache": prefix_cache,
+        "response_cache": response_cache,
+        "documents": document_store,
+        "chat_sessions": chat_sessions,
+        "admission": admission,
+        "fallback": fallback_completer,
+    }
+    for component, source in components.items():
+        if source is None:
+            continue
+        for key, value in source.snapshot().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f"{component}_{key}", f"{component} {key.replace('_', ' ')}", {(): value}
+
+metrics.add_collector(collect_component_stats)
+
+# On-demand profiler: POST {"steps": N} profiles the next N decode-loop iterations (whatever is running
+# then) and writes a Chrome trace; GET returns the latest capture with its hottest ops
+@app.route("/profile", methods=["GET", "POST"])
+def profile():
+    if not ENABLE_PROFILER:
+        return error_response("Profiling is disabled. Set ENABLE_PROFILER=1 to allow captures", 403)
+    if engine is None:
+        return error_response("Generation engine not initialized", 503)
+    if request.method == "GET":
+        return jsonify({"last_profile": engine.last_profile})
+
+    data = request.get_json(silent=True) or {}
+    steps = data.get("steps", 20)
+    if not isinstance(steps, int) or steps <= 0:
+        return error_response('Invalid "steps" value. Expected a positive integer')
+    path = os.path.join(PROFILE_DIR, f"trace-{int(time.time() * 1000)}.json")
+    if not engine.capture_profile(steps, path):
+        return error_response("A profiler capture is already in progress", 409)
+    logger.info(f"Profiler armed for {steps} decode-loop iterations, trace will be written to {path}")
+    return jsonify({"capturing": True, "steps": steps, "path": path})
+
+# Engine statistics: batch sizes, decode steps and queue depth of the shared decode loop
+@app.route("/stats", methods=["GET"])
+def stats():
+    if engine is None:
+        return error_response("Generation engine not initialized", 503)
+    return jsonify({
+        "engine": engine.snapshot(),
+        "prefix_cache": prefix_cache.snapshot() if prefix_cache is not None else None,
+        "response_cache": response_cache.snapshot() if response_cache is not None else None,
+        "documents": document_store.snapshot() if document_store is not None else None,
+        "chat_sessions": chat_sessions.snapshot() if chat_sessions is not None else None,
+        "admission": admission.snapshot() if admission is not None else None,
+        "fallback": fallback_completer.snapshot() if fallback_completer is not None else None
     })
 
 def start_ngrok():
@@ -556,11 +1563,17 @@ def start_ngrok():
 # Run the flask app
 if __name__ == '__main__':
     # Start ngrok tunnel
-    public_url = start_ngrok()
+    public_url = start_ngrok() if USE_NGROK else None
     
     if not public_url:
         logger.warning("Failed to established ngrok tunnel. Running with local access only.")
         public_url = f"http://127.0.0.1:{PORT}"
 
     logger.info(f"Starting Flask server with ngrok tunnel at {public_url}")
-    app.run(debug=False, port=PORT, host='0.0.0.0')  # Set debug=False for production
+    if SERVER_MODE == "waitress":
+        # Connections are handled by an event loop and requests by a fixed thread pool
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=PORT, threads=SERVER_THREADS)
+    else:
+        # One thread per request: generation runs on the engine thread, so cheap endpoints are never stuck behind it
+        app.run(debug=False, port=PORT, host='0.0.0.0', threaded=True)  # Set debug=False for production
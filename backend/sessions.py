@@ -0,0 +1,210 @@
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Text that ends an assistant reply: anything after it is the model continuing the dialogue
+REPLY_STOP_MARKERS = ("Human:", "Assistant:")
+
+
+def _truncate_kv(kv, length):
+    """Copy the first length positions of a legacy (key, value) per-layer cache"""
+    return tuple((key[:, :, :length].clone(), value[:, :, :length].clone()) for key, value in kv)
+
+
+def _kv_nbytes(kv):
+    return sum(key.numel() * key.element_size() + value.numel() * value.element_size() for key, value in kv)
+
+
+class ChatSession:
+    """One conversation: its token ids, where each exchange starts, and the KV cache of a prefix of them"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.exchanges = []
+        self.token_ids = []
+        self.exchange_starts = []
+        self.kv = None
+        self.kv_bytes = 0
+        self.last_used = time.monotonic()
+
+    @property
+    def kv_length(self):
+        return self.kv[0][0].shape[2] if self.kv is not None else 0
+
+
+class SessionStore:
+    """
+    Per-session chat state for /generate.
+
+    Each session keeps the token ids of its conversation and the KV cache
+    left behind by its last turn, so a new turn only prefills the new user
+    message. History is trimmed on a token budget: when a turn would not fit,
+    the oldest exchanges are dropped until the conversation uses at most half
+    the budget, which forces one full re-prefill. KV caches of least recently
+    used sessions are released once max_bytes is exceeded, and sessions idle
+    for longer than idle_ttl are forgotten entirely.
+    """
+
+    def __init__(self, tokenizer, max_bytes, token_budget=4096, idle_ttl=1800, max_sessions=1024):
+        self.tokenizer = tokenizer
+        self.max_bytes = max_bytes
+        self.token_budget = token_budget
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.total_bytes = 0
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "turns": 0,
+            "prefill_tokens_reused": 0,
+            "history_trims": 0,
+            "kv_evictions": 0,
+            "sessions_expired": 0,
+        }
+
+    def begin_turn(self, session_id, prompt, max_new_tokens):
+        """
+        Return (input_ids, past) for a new user message in a session.
+
+        past is the session's KV cache for a prefix of input_ids, or None. It
+        is handed over to the caller, so a concurrent turn on the same session
+        simply prefills from scratch instead of sharing it.
+        """
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = ChatSession(session_id)
+                while len(self._sessions) > self.max_sessions:
+                    _, evicted = self._sessions.popitem(last=False)
+                    self._release(evicted)
+            self._sessions.move_to_end(session_id)
+            session.last_used = time.monotonic()
+
+            turn_ids = self._turn_ids(prompt, first=not session.token_ids)
+            if len(session.token_ids) + len(turn_ids) + max_new_tokens > self.token_budget:
+                self._trim(session, self.token_budget // 2 - len(turn_ids) - max_new_tokens)
+                turn_ids = self._turn_ids(prompt, first=not session.token_ids)
+
+            past = session.kv
+            self._release(session)
+            self.stats["turns"] += 1
+            self.stats["prefill_tokens_reused"] += past[0][0].shape[2] if past is not None else 0
+            return session.token_ids + turn_ids, past
+
+    def end_turn(self, session_id, prompt, input_ids, output_ids, cache, response_text):
+        """
+        Record a finished turn.
+
+        The generated tokens are kept up to the reply's end (before any
+        "Human:" / "Assistant:" continuation) together with the KV cache the
+        engine returned for them. If the reply text was replaced altogether,
+        its tokens are stored without KV and prefilled by the next turn.
+        """
+        output_ids = self._reply_ids(output_ids)
+        if self.tokenizer.decode(output_ids, skip_special_tokens=True).strip() != response_text:
+            output_ids = self.tokenizer(" " + response_text, add_special_tokens=False)["input_ids"]
+            cached = min(cache[0][0].shape[2], len(input_ids)) if cache is not None else 0
+        else:
+            cached = min(cache[0][0].shape[2], len(input_ids) + len(output_ids)) if cache is not None else 0
+
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                # Cleared (or expired) while the turn was running
+                return
+            session.exchange_starts.append(len(session.token_ids))
+            session.exchanges.append((prompt, response_text))
+            session.token_ids = list(input_ids) + list(output_ids)
+            session.last_used = time.monotonic()
+            self._release(session)
+            if cached > 0:
+                session.kv = _truncate_kv(cache, cached)
+                session.kv_bytes = _kv_nbytes(session.kv)
+                self.total_bytes += session.kv_bytes
+                self._evict()
+
+    def clear(self, session_id):
+        """Forget a session's history; returns whether it existed"""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._release(session)
+            return session is not None
+
+    def history(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return list(session.exchanges) if session is not None else []
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                self.stats,
+                sessions=len(self._sessions),
+                sessions_with_kv=sum(1 for s in self._sessions.values() if s.kv is not None),
+                kv_bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                token_budget=self.token_budget,
+            )
+
+    def _turn_ids(self, prompt, first):
+        # Same layout as the old "\n\n".join(...) prompt: Human: ...\n\nAssistant: ...\n\nHuman: ...
+        text = f"Human: {prompt}\n\nAssistant:" if first else f"\n\nHuman: {prompt}\n\nAssistant:"
+        return self.tokenizer(text, add_special_tokens=first)["input_ids"]
+
+    def _reply_ids(self, output_ids):
+        """Cut generated ids before the first stop marker, dropping trailing whitespace tokens"""
+        keep = len(output_ids)
+        text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        if any(marker in text for marker in REPLY_STOP_MARKERS):
+            # Decoded prefixes grow monotonically, so binary search for the longest clean one
+            low, high = 0, len(output_ids)
+            while low < high:
+                middle = (low + high + 1) // 2
+                prefix = self.tokenizer.decode(output_ids[:middle], skip_special_tokens=True)
+                if any(marker in prefix for marker in REPLY_STOP_MARKERS):
+                    high = middle - 1
+                else:
+                    low = middle
+            keep = low
+        while keep > 0 and not self.tokenizer.decode(output_ids[keep - 1:keep], skip_special_tokens=True).strip():
+            keep -= 1
+        return output_ids[:keep]
+
+    def _trim(self, session, target):
+        """Drop the oldest exchanges until the history is at most target tokens and re-tokenize the rest"""
+        dropped = 0
+        while dropped < len(session.exchanges) and len(session.token_ids) - session.exchange_starts[dropped] > target:
+            dropped += 1
+        exchanges = session.exchanges[dropped:]
+        session.exchanges, session.token_ids, session.exchange_starts = [], [], []
+        for prompt, response_text in exchanges:
+            session.exchange_starts.append(len(session.token_ids))
+            session.token_ids += self._turn_ids(prompt, first=not session.token_ids)
+            session.token_ids += self.tokenizer(" " + response_text, add_special_tokens=False)["input_ids"]
+            session.exchanges.append((prompt, response_text))
+        # Positions changed, so the cached KV no longer lines up with the history
+        self._release(session)
+        self.stats["history_trims"] += 1
+
+    def _release(self, session):
+        self.total_bytes -= session.kv_bytes
+        session.kv, session.kv_bytes = None, 0
+
+    def _evict(self):
+        for session in self._sessions.values():
+            if self.total_bytes <= self.max_bytes:
+                break
+            if session.kv is not None:
+                self._release(session)
+                self.stats["kv_evictions"] += 1
+
+    def _expire(self):
+        now = time.monotonic()
+        for session_id in [s for s, session in self._sessions.items() if now - session.last_used > self.idle_ttl]:
+            self._release(self._sessions.pop(session_id))
+            self.stats["sessions_expired"] += 1
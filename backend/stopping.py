@@ -0,0 +1,237 @@
+import functools
+import os
+
+from transformers import AutoTokenizer
+
+from model_manager import TOKENIZER_KWARGS
+from streaming import IncrementalDecoder
+
+# Line prefixes that start a new top-level definition, by language (lowercase languageName).
+# A ghost suggestion that starts another definition has finished the one at the cursor.
+DEFINITION_PREFIXES = {
+    "python": ("def ", "async def ", "class ", "@"),
+    "javascript": ("function ", "async function ", "class ", "export "),
+    "typescript": ("function ", "async function ", "class ", "export ", "interface "),
+    "go": ("func ", "type "),
+    "rust": ("fn ", "pub fn ", "impl ", "struct ", "enum "),
+    "ruby": ("def ", "class ", "module "),
+    "php": ("function ", "public function ", "private function ", "class "),
+    "kotlin": ("fun ", "class "),
+    "scala": ("def ", "class ", "object "),
+    "swift": ("func ", "class ", "struct "),
+}
+DEFAULT_DEFINITION_PREFIXES = ("def ",)
+# Languages whose blocks end by dedenting rather than with a closing bracket
+INDENT_LANGUAGES = ("python",)
+BRACKETS = {"(": ")", "[": "]", "{": "}"}
+
+
+@functools.lru_cache(maxsize=4)
+def _load_tokenizer(name_or_path):
+    return AutoTokenizer.from_pretrained(name_or_path, **TOKENIZER_KWARGS)
+
+
+class StopCondition:
+    """
+    Stop hook that ends a request as soon as the endpoint's post-processing
+    would throw the rest of its output away.
+
+    find(text) returns where the completion text is cut, or None while that
+    can't be decided yet. The engine calls the hook between decode steps and
+    stops the request with `reason` once find() succeeds; trim() applies the
+    same cut to the final text, so the response matches a full-length run.
+    Between decode steps the text only grows, so the hook detokenizes just
+    the new tokens and passes find() a scan dict where it keeps its progress,
+    and each step only looks at the text added since the last one.
+    Hooks pickle without their tokenizer: worker processes reload it by path,
+    with the same options the server loaded it with.
+    """
+
+    reason = "stop"
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self._decoder = None
+        self._text = ""
+        self._scan = {}
+
+    def __call__(self, req):
+        if self._decoder is None:
+            self._decoder = IncrementalDecoder(self.tokenizer)
+        new_tokens = req.output_ids[len(self._decoder.tokens):]
+        if not new_tokens:
+            return None
+        added = "".join(self._decoder.push(token_id) for token_id in new_tokens)
+        if not added:
+            return None
+        self._text += added
+        return self.reason if self.find(self._text, self._scan) is not None else None
+
+    def find(self, text, scan=None):
+        """Cut index in text or None; scan carries progress between calls on the same growing text"""
+        raise NotImplementedError
+
+    def trim(self, text):
+        cut = self.find(text)
+        return text if cut is None else text[:cut]
+
+    def __getstate__(self):
+        state = dict(self.__dict__, _decoder=None, _text="", _scan={})
+        path = self.tokenizer.name_or_path
+        # Absolute, so a local model directory resolves regardless of the worker's working directory
+        state["tokenizer"] = os.path.abspath(path) if os.path.isdir(path) else path
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.tokenizer, str):
+            self.tokenizer = _load_tokenizer(self.tokenizer)
+
+
+class StopStrings(StopCondition):
+    """Cut at the first occurrence of any stop string"""
+
+    reason = "stop_string"
+
+    def __init__(self, tokenizer, stop_strings):
+        super().__init__(tokenizer)
+        self.stop_strings = tuple(stop_strings)
+        self._overlap = max((len(stop) for stop in self.stop_strings), default=1) - 1
+
+    def find(self, text, scan=None):
+        # A stop string that ends in the new text can start at most len(stop) - 1 characters before it
+        start = max(scan.get("scanned", 0) - self._overlap, 0) if scan is not None else 0
+        hits = [index for index in (text.find(stop, start) for stop in self.stop_strings) if index >= 0]
+        if scan is not None:
+            scan["scanned"] = len(text)
+        return min(hits) if hits else None
+
+
+class StopLines(StopCondition):
+    """
+    Cut before the first line whose stripped text starts with one of the
+    prefixes. When `after` is given and appears in the text, only lines
+    after it count.
+    """
+
+    reason = "stop_line"
+
+    def __init__(self, tokenizer, prefixes, after=None):
+        super().__init__(tokenizer)
+        self.prefixes = tuple(prefixes)
+        self.after = after
+
+    def find(self, text, scan=None):
+        scan = {} if scan is None else scan
+        if self.after and "after" not in scan:
+            index = text.find(self.after, scan.get("after_from", 0))
+            if index >= 0:
+                scan["after"] = index + len(self.after)
+            else:
+                scan["after_from"] = max(len(text) - len(self.after) + 1, 0)
+        return _find_line(text, self.prefixes, scan.get("after", 0), scan)
+
+
+class GhostCompletionStop(StopCondition):
+    """
+    Ends a ghost (inline) suggestion once the code at the cursor is complete:
+    another definition starts, a block opened in the suggestion is closed
+    again, a bracket that was open before the cursor is closed, or (for
+    indentation-based languages) a line dedents out of the suggestion's block.
+    """
+
+    reason = "block_complete"
+
+    def __init__(self, tokenizer, language_name=""):
+        super().__init__(tokenizer)
+        language = (language_name or "").lower()
+        self.definition_prefixes = DEFINITION_PREFIXES.get(language, DEFAULT_DEFINITION_PREFIXES)
+        self.indent_based = language in INDENT_LANGUAGES
+
+    def find(self, text, scan=None):
+        scan = {} if scan is None else scan
+        # The first line finishes the line at the cursor, so only later lines can start a definition
+        first_newline = text.find("\n")
+        cuts = [_find_line(text, self.definition_prefixes, first_newline + 1, scan) if first_newline >= 0 else None,
+                _bracket_balance(text, scan)]
+        if self.indent_based:
+            cuts.append(_dedent(text, scan))
+        cuts = [cut for cut in cuts if cut is not None]
+        return min(cuts) if cuts else None
+
+
+def _find_line(text, prefixes, start=0, scan=None):
+    """
+    Index of the newline before the first line at or after start whose
+    stripped text starts with a prefix. With a scan dict, complete lines
+    already checked are skipped; the last, still growing line is rechecked.
+    """
+    offset = max(start, scan.get("line", 0)) if scan is not None else start
+    for line in text[offset:].split("\n"):
+        if line.strip().startswith(prefixes):
+            return offset - 1 if offset > 0 and text[offset - 1] == "\n" else offset
+        if scan is not None:
+            scan["line"] = offset
+        offset += len(line) + 1
+    return None
+
+
+def _bracket_balance(text, scan=None):
+    """
+    End of the first completed line on which either a bracket opened on an
+    earlier line was closed back to depth zero, or the depth went below zero
+    (closing something opened before the cursor). String literals are skipped.
+    With a scan dict, the scan resumes where the previous call stopped.
+    """
+    depth, spanned, quote, index = scan.get("brackets", (0, False, None, 0)) if scan is not None else (0, False, None, 0)
+    while index < len(text):
+        char = text[index]
+        if quote is not None:
+            if char == "\\":
+                index += 1
+            elif char == quote or (char == "\n" and quote != "`"):
+                quote = None
+        elif char in "\"'`":
+            quote = char
+        elif char in BRACKETS:
+            depth += 1
+        elif char in BRACKETS.values():
+            depth -= 1
+        if char == "\n":
+            if depth < 0 or (spanned and depth == 0):
+                return index
+            spanned = spanned or depth > 0
+        index += 1
+    if scan is not None:
+        scan["brackets"] = (depth, spanned, quote, index)
+    return None
+
+
+def _dedent(text, scan=None):
+    """
+    Index of the newline before the first line indented less than the
+    suggestion's first full line. Continuation lines inside brackets and
+    lines starting with a closing bracket don't count. With a scan dict,
+    complete lines already checked are skipped.
+    """
+    if scan is not None and "dedent" in scan:
+        base, depth, offset = scan["dedent"]
+    else:
+        base, depth = None, 0
+        offset = text.find("\n") + 1
+        if offset == 0:
+            return None
+    for line in text[offset:].split("\n"):
+        if scan is not None:
+            # Saved at the start of each line, so the next call resumes at the last (growing) one
+            scan["dedent"] = (base, depth, offset)
+        stripped = line.strip()
+        if stripped and depth <= 0 and stripped[0] not in BRACKETS.values():
+            indent = len(line) - len(line.lstrip())
+            if base is None:
+                base = indent
+            elif indent < base:
+                return offset - 1
+        depth += sum(line.count(opener) - line.count(closer) for opener, closer in BRACKETS.items())
+        offset += len(line) + 1
+    return None
@@ -0,0 +1,210 @@
+import json
+import logging
+
+from flask import Response
+
+logger = logging.getLogger(__name__)
+
+STREAM_FORMATS = {True: "sse", "sse": "sse", "jsonl": "jsonl", "ndjson": "jsonl"}
+
+
+def get_stream_format(data):
+    """Read the optional 'stream' field of a request body: None, 'sse' or 'jsonl'"""
+    value = data.get("stream")
+    if value in (None, False):
+        return None
+    if value not in STREAM_FORMATS:
+        raise ValueError('Invalid "stream" value. Expected true, "sse" or "jsonl"')
+    return STREAM_FORMATS[value]
+
+
+class IncrementalDecoder:
+    """
+    Turns generated token ids into text deltas as they arrive.
+
+    Decoding a window that starts a few tokens back keeps spacing and merged
+    byte sequences correct; text is only released once it no longer ends in
+    an incomplete UTF-8 character.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_id):
+        self.tokens.append(token_id)
+        prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.tokens[self.prefix_offset:])
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.tokens)
+            return new_text[len(prefix_text):]
+        return ""
+
+    def _decode(self, tokens):
+        return self.tokenizer.decode(tokens, skip_special_tokens=self.skip_special_tokens)
+
+
+class PassthroughFilter:
+    """Streams text unchanged apart from leading whitespace"""
+
+    def __init__(self, lstrip=True):
+        self._lstrip = lstrip
+        self.stopped = False
+
+    def feed(self, text):
+        return self._emit(text)
+
+    def finish(self):
+        return []
+
+    def _emit(self, text):
+        if self._lstrip:
+            text = text.lstrip()
+            if text:
+                self._lstrip = False
+        return [{"token": text}] if text else []
+
+
+class StopStringFilter(PassthroughFilter):
+    """Streams text until any stop string appears, holding back possible partial matches"""
+
+    def __init__(self, stop_strings, lstrip=True):
+        super().__init__(lstrip)
+        self.stop_strings = stop_strings
+        self._buffer = ""
+
+    def feed(self, text):
+        if self.stopped:
+            return []
+        self._buffer += text
+        hits = [self._buffer.find(stop) for stop in self.stop_strings]
+        hits = [index for index in hits if index >= 0]
+        if hits:
+            self.stopped = True
+            out, self._buffer = self._buffer[:min(hits)], ""
+            return self._emit(out)
+
+        hold = _partial_suffix(self._buffer, self.stop_strings)
+        out = self._buffer[:len(self._buffer) - hold]
+        self._buffer = self._buffer[len(self._buffer) - hold:]
+        return self._emit(out)
+
+    def finish(self):
+        if self.stopped:
+            return []
+        out, self._buffer = self._buffer, ""
+        return self._emit(out)
+
+
+class OptimizedCodeFilter(PassthroughFilter):
+    """
+    Streaming counterpart of the code extraction in /optimize.
+
+    The prompt ends with the "# Optimized X:" marker, so code is streamed line
+    by line from the start, stopping at the first print( or "# Test Cases"
+    line. If the model repeats the marker, the client is told to reset and
+    only the code after it is streamed.
+    """
+
+    def __init__(self, marker):
+        super().__init__(lstrip=True)
+        self.marker = marker
+        self._buffer = ""
+        self._seen_marker = False
+        self._emitted = False
+
+    def feed(self, text):
+        if self.stopped:
+            return []
+        self._buffer += text
+        events = []
+        # The marker fits on one line, so it can only be in the line still being buffered
+        if not self._seen_marker and self.marker in self._buffer:
+            self._seen_marker = True
+            self._buffer = self._buffer.split(self.marker, 1)[1]
+            self._lstrip = True
+            if self._emitted:
+                events.append({"reset": True})
+
+        while "\n" in self._buffer and not self.stopped:
+            line, self._buffer = self._buffer.split("\n", 1)
+            events.extend(self._emit_line(line + "\n"))
+        return events
+
+    def finish(self):
+        if self.stopped:
+            return []
+        out, self._buffer = self._buffer, ""
+        return self._emit_line(out)
+
+    def _emit_line(self, line):
+        stripped = line.strip()
+        if stripped.startswith("print(") or stripped.startswith("# Test Cases"):
+            self.stopped = True
+            return []
+        return self._emit_code(line)
+
+    def _emit_code(self, text):
+        events = self._emit(text)
+        self._emitted = self._emitted or bool(events)
+        return events
+
+
+def _partial_suffix(text, stop_strings):
+    """Length of the longest suffix of text that is a proper prefix of a stop string"""
+    longest = 0
+    for stop in stop_strings:
+        for size in range(min(len(stop) - 1, len(text)), longest, -1):
+            if text.endswith(stop[:size]):
+                longest = size
+                break
+    return longest
+
+
+def format_event(event, fmt):
+    payload = json.dumps(event)
+    return f"data: {payload}\n\n" if fmt == "sse" else payload + "\n"
+
+
+def stream_generation(req, tokenizer, fmt, text_filter=None, finalize=None):
+    """
+    Build a streaming Flask response for an engine request.
+
+    Each decoded delta is passed through text_filter and sent as a
+    {"token": ...} event. The last event carries "done": true together with
+    finalize(full_text), the same JSON body the non-streaming route returns.
+    """
+    text_filter = text_filter or PassthroughFilter(lstrip=False)
+
+    def events():
+        decoder = IncrementalDecoder(tokenizer)
+        try:
+            for token_id in req.iter_tokens():
+                for event in text_filter.feed(decoder.push(token_id)):
+                    yield format_event(event, fmt)
+            for event in text_filter.finish():
+                yield format_event(event, fmt)
+        except Exception as e:
+            logger.exception("Error while streaming generation")
+            yield format_event({"error": f"An internal error occurred: {str(e)}", "done": True}, fmt)
+            return
+        finally:
+            # The client went away mid-stream: stop decoding for it
+            if not req.done:
+                req.cancel()
+
+        text = tokenizer.decode(req.output_ids, skip_special_tokens=True)
+        final = finalize(text) if finalize else {"completion": text}
+        yield format_event(dict(final, done=True, finish_reason=req.finish_reason), fmt)
+
+    return event_stream_response(events(), fmt)
+
+
+def event_stream_response(events, fmt):
+    """Wrap an iterable of already formatted events in a streaming Flask response"""
+    mimetype = "text/event-stream" if fmt == "sse" else "application/x-ndjson"
+    return Response(events, mimetype=mimetype, headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
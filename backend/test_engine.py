@@ -0,0 +1,106 @@
+"""
+Regression tests for the continuous-batching engine, run against the tiny
+random model from make_tiny_model.py (no network or GPU needed):
+
+    cd backend && python -m pytest -q test_engine.py
+"""
+import time
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+import make_tiny_model
+from engine import GenerationCancelled, GenerationEngine, GenerationExpired
+
+PROMPTS = [
+    "def fibonacci(n):\n",
+    "class Stack:\n    def push(self, item):\n",
+    "for i in range(10):\n    print(i)\n",
+    "const items = list.filter",
+]
+
+
+@pytest.fixture(scope="module")
+def model_and_tokenizer(tmp_path_factory):
+    path = tmp_path_factory.mktemp("tiny-model")
+    make_tiny_model.build(str(path))
+    model = AutoModelForCausalLM.from_pretrained(path).eval()
+    return model, AutoTokenizer.from_pretrained(path)
+
+
+@pytest.fixture
+def engine(model_and_tokenizer):
+    return GenerationEngine(model_and_tokenizer[0], "cpu", max_batch_size=4).start()
+
+
+def reference(model, input_ids, max_new_tokens):
+    """Greedy tokens from model.generate, without stopping at EOS (engine requests don't set one here)"""
+    with torch.inference_mode():
+        return model.generate(
+            torch.tensor([input_ids]), max_new_tokens=max_new_tokens, do_sample=False,
+            eos_token_id=None, pad_token_id=0,
+        )[0, len(input_ids):].tolist()
+
+
+def test_batched_greedy_matches_generate(model_and_tokenizer, engine):
+    model, tokenizer = model_and_tokenizer
+    prompts = [tokenizer.encode(prompt) for prompt in PROMPTS]
+    # Submitted together so the prompts (of different lengths) share decode steps
+    requests = [engine.submit(ids, 24) for ids in prompts]
+    for ids, req in zip(prompts, requests):
+        assert req.wait(60) == reference(model, ids, 24)
+    assert engine.stats["max_batch_seen"] > 1
+
+
+def test_preempted_request_resumes_with_same_output(model_and_tokenizer):
+    model, tokenizer = model_and_tokenizer
+    engine = GenerationEngine(model, "cpu", max_batch_size=1).start()
+    ids = tokenizer.encode(PROMPTS[0])
+    background = engine.submit(ids, 64, priority=1, stream=True)
+    next(background.iter_tokens())
+    urgent = engine.submit(tokenizer.encode(PROMPTS[1]), 4, priority=0)
+
+    urgent.wait(60)
+    assert not background.done or urgent.finished_at <= background.finished_at
+    assert background.wait(60) == reference(model, ids, 64)
+    assert engine.stats["requests_preempted"] >= 1
+
+
+def test_cancel_stops_running_request(model_and_tokenizer, engine):
+    tokenizer = model_and_tokenizer[1]
+    req = engine.submit(tokenizer.encode(PROMPTS[0]), 100000, stream=True)
+    next(req.iter_tokens())
+    assert engine.cancel(request_id=req.request_id)
+    with pytest.raises(GenerationCancelled):
+        req.wait(60)
+    assert req.finish_reason == "cancelled"
+    assert len(req.output_ids) < 100000
+
+
+def test_deadline_expires_queued_and_cuts_running(model_and_tokenizer, engine):
+    tokenizer = model_and_tokenizer[1]
+    ids = tokenizer.encode(PROMPTS[0])
+    with pytest.raises(GenerationExpired):
+        engine.generate(ids, 8, timeout=60, deadline=time.time() - 1)
+
+    req = engine.submit(ids, 100000, deadline=time.time() + 0.2)
+    assert req.wait(60)
+    assert req.finish_reason == "deadline"
+
+
+def test_failing_request_does_not_fail_the_batch(model_and_tokenizer, engine):
+    model, tokenizer = model_and_tokenizer
+    ids = tokenizer.encode(PROMPTS[2])
+
+    def broken_hook(req):
+        # Fails mid-decode, while both requests share the batch
+        if len(req.output_ids) >= 8:
+            raise RuntimeError("stop hook failed")
+
+    broken = engine.submit(ids, 32, stop_hooks=[broken_hook])
+    healthy = engine.submit(ids, 32)
+    with pytest.raises(RuntimeError):
+        broken.wait(60)
+    assert healthy.wait(60) == reference(model, ids, 32)
+    assert engine.stats["requests_failed"] == 1
@@ -0,0 +1,348 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from backends import create_backend
+from engine import GenerationEngine, GenerationRequest
+from prefix_cache import PrefixCache
+
+logger = logging.getLogger(__name__)
+
+# Engine counters that are maxima or ratios rather than sums across workers
+_MAX_STATS = ("max_batch_seen",)
+_DERIVED_STATS = ("draft_acceptance_rate", "speculative_speedup")
+
+
+def cpu_sets(workers):
+    """
+    Split the CPUs this process may run on into one contiguous set per worker.
+
+    Returns None entries (no pinning) when there are fewer CPUs than workers.
+    """
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if len(cpus) < workers:
+        return [None] * workers
+    size, extra = divmod(len(cpus), workers)
+    sets, start = [], 0
+    for index in range(workers):
+        end = start + size + (index < extra)
+        sets.append(cpus[start:end])
+        start = end
+    return sets
+
+
+def _serve(index, model, device, cpus, threads, max_batch_size, prefix_cache_bytes, backend, inbox, outbox):
+    """Worker process: run one GenerationEngine over the shared weights and answer the pool's commands"""
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+    prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+    # Compiled graphs and ONNX sessions can't be shared across processes, so each worker warms up its own
+    backend = create_backend(backend["name"], model, device, max_batch_size=max_batch_size, **backend["options"])
+    backend.warmup()
+    engine = GenerationEngine(
+        model, device, max_batch_size=max_batch_size, prefix_cache=prefix_cache, backend=backend
+    ).start()
+    running = {}
+    lock = threading.Lock()
+    sent_profile = [None]
+
+    def report(req):
+        with lock:
+            running.pop(req.request_id, None)
+        profile = engine.last_profile
+        if profile is sent_profile[0]:
+            profile = None
+        else:
+            sent_profile[0] = profile
+        outbox.put(("done", index, req.request_id, {
+            "output_ids": req.output_ids,
+            "finish_reason": req.finish_reason,
+            "error": repr(req.error) if req.error is not None else None,
+            "started_at": req.started_at,
+            "prefill_seconds": req.prefill_seconds,
+            "first_token_at": req.first_token_at,
+            "decode_steps_saved": req.decode_steps_saved,
+            "token_logprobs": req.token_logprobs,
+            "cache": req.cache,
+            # Stats travel with every result, so the pool never has to poll workers
+            "engine": engine.snapshot(),
+            "prefix_cache": prefix_cache.snapshot() if prefix_cache is not None else None,
+            "profile": profile,
+        }))
+
+    def forward_tokens(req):
+        try:
+            for token_id in req.iter_tokens():
+                outbox.put(("token", index, req.request_id, token_id))
+        except Exception:
+            pass  # reported with the result
+        report(req)
+
+    outbox.put(("ready", index, os.getpid(), threads))
+    while True:
+        command, *args = inbox.get()
+        if command == "submit":
+            request_id, input_ids, max_new_tokens, options = args
+            req = engine.submit(input_ids, max_new_tokens, request_id=request_id, **options)
+            with lock:
+                running[request_id] = req
+            if options.get("stream"):
+                threading.Thread(target=forward_tokens, args=(req,), daemon=True).start()
+            else:
+                req.add_done_callback(report)
+        elif command == "cancel":
+            request_id, reason = args
+            with lock:
+                req = running.get(request_id)
+            if req is not None:
+                req.cancel(reason)
+        elif command == "profile":
+            engine.capture_profile(*args)
+        elif command == "stop":
+            return
+
+
+class RemoteRequest(GenerationRequest):
+    """Handle for a request running in a worker process, with the same interface as GenerationRequest"""
+
+    def __init__(self, pool, input_ids, max_new_tokens, **kwargs):
+        super().__init__(input_ids, max_new_tokens, **kwargs)
+        self.pool = pool
+        self.worker = None
+
+    def cancel(self, reason="cancelled"):
+        if not self.done and self._cancel_reason is None:
+            self._cancel_reason = reason
+            self.pool._send(self.worker, ("cancel", self.request_id, reason))
+
+
+class WorkerPool:
+    """
+    Several engine processes sharing one copy of the model weights.
+
+    The weights are moved to shared memory once and handed to each worker, so
+    N workers cost one model plus N sets of activations and KV caches. Every
+    worker is pinned to its own CPU set with a matching torch thread count.
+    Requests go to the worker with the fewest outstanding requests; tokens,
+    results and KV caches (as shared tensors) come back over a queue. The pool
+    has the same submit/cancel/snapshot interface as GenerationEngine, so the
+    routes don't care which one they talk to.
+
+    prefix_cache_bytes is the budget for the whole pool: each worker keeps its
+    own prefix cache of an equal share, so the pool stays within it.
+    """
+
+    def __init__(self, model, device, workers=2, threads_per_worker=0, max_batch_size=8, prefix_cache_bytes=0,
+                 backend="eager", backend_options=None):
+        if str(device) != "cpu":
+            raise ValueError("The worker pool shares weights through CPU shared memory and only runs on CPU")
+        self.model = model
+        self.device = device
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.max_batch_size = max_batch_size
+        self.prefix_cache_bytes = prefix_cache_bytes
+        self.backend = {"name": backend, "options": backend_options or {}}
+
+        self._context = mp.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._processes = [None] * workers
+        self._inboxes = [None] * workers
+        self._cpus = cpu_sets(workers)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._latest_by_key = {}
+        self._outstanding = [0] * workers
+        self._worker_stats = [{} for _ in range(workers)]
+        self._profiles = [None] * workers
+        self._ready = threading.Semaphore(0)
+        self._round_robin = itertools.count()
+        self._stopping = False
+        self.stats = {"requests_dispatched": 0, "worker_restarts": 0}
+
+    def start(self, timeout=600):
+        # One shared copy: every worker maps these storages instead of unpickling its own weights
+        self.model.share_memory()
+        for index in range(self.workers):
+            self._spawn(index)
+        threading.Thread(target=self._receive, name="worker-pool", daemon=True).start()
+        for _ in range(self.workers):
+            if not self._ready.acquire(timeout=timeout):
+                raise RuntimeError("Worker processes did not start in time")
+        logger.info(f"Worker pool started ({self.workers} workers, CPU sets {self._cpus})")
+        return self
+
+    def submit(self, input_ids, max_new_tokens, **kwargs):
+        """Queue a prompt on the least loaded worker and return its request handle"""
+        req = RemoteRequest(self, input_ids, max_new_tokens, **kwargs)
+        options = {
+            "do_sample": req.do_sample, "temperature": req.temperature, "top_p": req.top_p,
+            "eos_token_id": req.eos_token_id, "stream": req._stream is not None, "stop_hooks": req.stop_hooks,
+            "seed": req.seed, "past": req.past, "keep_cache": req.keep_cache,
+            "draft_tokens": req.draft_tokens, "draft_ngram": req.draft_ngram, "priority": req.priority,
+            "deadline": req.deadline, "logprobs": req.logprobs,
+        }
+        # The worker holds the caller's cache from here on
+        req.past = None
+        with self._lock:
+            # Superseding is tracked here because the previous request may live in another worker
+            if req.supersede_key is not None:
+                latest = self._latest_by_key.get(req.supersede_key, [])
+                if req.joins(latest):
+                    latest.append(req)
+                else:
+                    for previous in latest:
+                        previous.cancel("superseded")
+                    self._latest_by_key[req.supersede_key] = [req]
+            offset = next(self._round_robin)
+            req.worker = min(range(self.workers), key=lambda i: (self._outstanding[i], (i - offset) % self.workers))
+            self._outstanding[req.worker] += 1
+            self._inflight[req.request_id] = req
+            self.stats["requests_dispatched"] += 1
+        self._send(req.worker, ("submit", req.request_id, req.input_ids, req.max_new_tokens, options))
+        return req
+
+    def cancel(self, request_id=None, supersede_key=None):
+        """Cancel an in-flight request by id, or the latest requests for a supersede key; returns whether any was found"""
+        with self._lock:
+            if request_id is not None:
+                requests = [self._inflight[request_id]] if request_id in self._inflight else []
+            else:
+                requests = list(self._latest_by_key.get(supersede_key, []))
+        requests = [req for req in requests if not req.done]
+        for req in requests:
+            req.cancel()
+        return bool(requests)
+
+    def capture_profile(self, steps, path):
+        """Profile the next `steps` decode-loop iterations of every worker, one Chrome trace each"""
+        root, ext = os.path.splitext(path)
+        for index in range(self.workers):
+            self._send(index, ("profile", steps, f"{root}-worker{index}{ext or '.json'}"))
+        return True
+
+    @property
+    def last_profile(self):
+        with self._lock:
+            profiles = [dict(profile, worker=index) for index, profile in enumerate(self._profiles) if profile]
+        return profiles or None
+
+    def generate(self, input_ids, max_new_tokens, timeout=None, **kwargs):
+        """Submit a prompt and block until its generated token ids are available"""
+        return self.submit(input_ids, max_new_tokens, **kwargs).wait(timeout)
+
+    def snapshot(self):
+        """Engine counters summed over the workers (as of each worker's latest result), plus per-worker load"""
+        with self._lock:
+            workers = [
+                dict(stats, worker=index, outstanding=self._outstanding[index],
+                     pid=self._processes[index].pid, cpus=self._cpus[index])
+                for index, stats in enumerate(self._worker_stats)
+            ]
+            outstanding = sum(self._outstanding)
+            total = dict(self.stats)
+        for stats in workers:
+            for key, value in stats.get("engine", {}).items():
+                if key in _DERIVED_STATS or not isinstance(value, (int, float)):
+                    continue
+                total[key] = max(total.get(key, 0), value) if key in _MAX_STATS else total.get(key, 0) + value
+        # Results arrive after the worker stats were taken, so the pool's own count is the live one
+        total["active"] = outstanding
+        total["queue_depth"] = max(outstanding - self.max_batch_size * self.workers, 0)
+        proposed, steps = total.get("draft_tokens_proposed", 0), total.get("speculative_steps", 0)
+        total["draft_acceptance_rate"] = round(total.get("draft_tokens_accepted", 0) / proposed, 4) if proposed else 0.0
+        total["speculative_speedup"] = round(total.get("speculative_tokens", 0) / steps, 3) if steps else 0.0
+        total["workers"] = workers
+        return total
+
+    def shutdown(self):
+        self._stopping = True
+        for index in range(self.workers):
+            self._send(index, ("stop",))
+        for process in self._processes:
+            process.join(timeout=5)
+
+    def _spawn(self, index):
+        inbox = self._context.Queue()
+        threads = self.threads_per_worker or (len(self._cpus[index]) if self._cpus[index] else
+                                              max(torch.get_num_threads() // self.workers, 1))
+        process = self._context.Process(
+            target=_serve,
+            args=(index, self.model, self.device, self._cpus[index], threads,
+                  self.max_batch_size, self.prefix_cache_bytes // self.workers, self.backend, inbox, self._outbox),
+            name=f"generation-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self._inboxes[index], self._processes[index] = inbox, process
+
+    def _send(self, index, message):
+        if index is not None:
+            self._inboxes[index].put(message)
+
+    def _receive(self):
+        checked = time.monotonic()
+        while True:
+            # On a timer rather than when the outbox is idle: other workers' tokens can keep it busy indefinitely
+            if time.monotonic() - checked >= 1.0:
+                self._check_workers()
+                checked = time.monotonic()
+            try:
+                kind, index, *payload = self._outbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if kind == "ready":
+                pid, threads = payload
+                logger.info(f"Worker {index} ready (pid {pid}, {threads} threads, CPUs {self._cpus[index]})")
+                self._ready.release()
+            elif kind == "token":
+                request_id, token_id = payload
+                req = self._inflight.get(request_id)
+                if req is not None:
+                    req._push(token_id)
+            elif kind == "done":
+                self._finish(index, *payload)
+
+    def _finish(self, index, request_id, result):
+        with self._lock:
+            req = self._inflight.pop(request_id, None)
+            self._outstanding[index] -= 1
+            self._worker_stats[index] = {"engine": result["engine"], "prefix_cache": result["prefix_cache"]}
+            if result["profile"] is not None:
+                self._profiles[index] = result["profile"]
+            latest = self._latest_by_key.get(req.supersede_key) if req is not None and req.supersede_key is not None else None
+            if latest is not None and req in latest:
+                latest.remove(req)
+                if not latest:
+                    del self._latest_by_key[req.supersede_key]
+        if req is None:
+            return
+        if req._stream is None:
+            req.output_ids = result["output_ids"]
+        for key in ("started_at", "prefill_seconds", "first_token_at", "decode_steps_saved", "token_logprobs", "cache"):
+            setattr(req, key, result[key])
+        error = RuntimeError(f"Worker {index}: {result['error']}") if result["error"] else None
+        req._finish(result["finish_reason"], error)
+
+    def _check_workers(self):
+        """Fail the requests of a worker that died and start a replacement on the same CPU set"""
+        for index, process in enumerate(self._processes):
+            if self._stopping or process.is_alive():
+                continue
+            logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+            with self._lock:
+                lost = [req for req in self._inflight.values() if req.worker == index]
+                for req in lost:
+                    del self._inflight[req.request_id]
+                self._outstanding[index] = 0
+                self.stats["worker_restarts"] += 1
+            for req in lost:
+                req._finish("error", RuntimeError(f"Worker {index} exited with code {process.exitcode}"))
+            self._spawn(index)
@@ -65,18 +65,21 @@ function getLanguageInfo(editor: vscode.TextEditor):{
     languageName: string;
     fileName: string;
     fileExtension: string;
+    documentId: string;
 } {
     const document = editor.document;
     const languageId = document.languageId;
     const languageName = LANGUAGE_MAPPINGS[languageId] || languageId;
     const fileName = path.basename(document.fileName);
     const fileExtension = path.extname(document.fileName);
+    const documentId = document.uri.toString();
 
     return {
         languageId,
         languageName,
         fileName,
-        fileExtension
+        fileExtension,
+        documentId
     };
 
 }
@@ -100,6 +103,8 @@ export function activate(context: vscode.ExtensionContext) {
     // Configuration keys
     const CONFIG_SERVER_URL = 'codegenie.serverUrl';
     const CONFIG_AUTOCONNECT = 'codegenie.autoConnect';
+    // A ghost suggestion that arrives later than this is stale; the server returns what it has by then
+    const GHOST_COMPLETION_DEADLINE_MS = 1500;
     
     // Create status bar item
     const statusBarItem = vscode.window.createStatusBarItem(vscode.StatusBarAlignment.Right);
@@ -112,6 +117,10 @@ export function activate(context: vscode.ExtensionContext) {
     let isProcessing = false;
     let isConnected = false;
 
+    // Documents mirrored on the server (incremental sync): documentId -> last synced version
+    const syncedDocuments = new Map<string, number>();
+    let documentSync: Promise<void> = Promise.resolve();
+
     // Get server URL from configuration
     let serverUrl = vscode.workspace.getConfiguration().get(CONFIG_SERVER_URL) as string || '';
     const autoConnect = vscode.workspace.getConfiguration().get(CONFIG_AUTOCONNECT) as boolean || false;
@@ -162,6 +171,8 @@ export function activate(context: vscode.ExtensionContext) {
             
             if (info.status === 'connected') {
                 isConnected = true;
+                // A (possibly different) server has none of our documents yet
+                syncedDocuments.clear();
                 updateStatusBar(`$(cloud) CodeGenie (Connected: ${info.model_status})`);
                 vscode.window.showInformationMessage(`Connected to CodeGenie server at ${url}`);
             } else {
@@ -420,6 +431,9 @@ export function activate(context: vscode.ExtensionContext) {
             if (languageInfo) {
                 requestBody.languageName = languageInfo.languageName;
                 requestBody.fileName = languageInfo.fileName;
+                // Lets the server abandon our previous, now stale, request for this document
+                requestBody.clientId = vscode.env.sessionId;
+                requestBody.documentId = languageInfo.documentId;
             }
             
             const response = await fetch(`${serverUrl}/complete`, {
@@ -533,17 +547,23 @@ export function activate(context: vscode.ExtensionContext) {
         currentSuggestion = '';
     }
 
-    async function getGhostCompletion(text: string, languageInfo?: any): Promise<string> {
+    async function getGhostCompletion(text: string, languageInfo?: any, cursorOffset?: number): Promise<string> {
         if (!ensureConnected()) return '';
         
         try {
             // Show status bar for ghost completion
             updateStatusBar("$(sync~spin) Generating suggestion...");
             
-            const requestBody: any = { code: text };
+            // Synced documents only need the cursor; the server already has the text
+            const synced = languageInfo && cursorOffset !== undefined && syncedDocuments.has(languageInfo.documentId);
+            const requestBody: any = synced ? { cursor: cursorOffset } : { code: text };
+            requestBody.deadlineMs = GHOST_COMPLETION_DEADLINE_MS;
             if (languageInfo) {
                 requestBody.languageName = languageInfo.languageName;
                 requestBody.fileName = languageInfo.fileName;
+                // Lets the server abandon our previous, now stale, request for this document
+                requestBody.clientId = vscode.env.sessionId;
+                requestBody.documentId = languageInfo.documentId;
             }
             
             const res = await fetch(`${serverUrl}/hf-complete`, {
@@ -583,20 +603,100 @@ export function activate(context: vscode.ExtensionContext) {
         })
     );
 
+    // Send a document's full text once so later requests only carry edit deltas
+    async function openSyncedDocument(document: vscode.TextDocument, languageInfo: any): Promise<void> {
+        const res = await fetch(`${serverUrl}/documents/open`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                documentId: languageInfo.documentId,
+                text: document.getText(),
+                version: document.version,
+                languageName: languageInfo.languageName,
+                fileName: languageInfo.fileName
+            }),
+        });
+        if (res.ok) {
+            syncedDocuments.set(languageInfo.documentId, document.version);
+        } else {
+            syncedDocuments.delete(languageInfo.documentId);
+        }
+    }
+
+    // Keep the server's copy of a document up to date; changes are sent one at a time, in order
+    function syncDocumentChange(event: vscode.TextDocumentChangeEvent, languageInfo: any): Promise<void> {
+        documentSync = documentSync.then(async () => {
+            const documentId = languageInfo.documentId;
+            const baseVersion = syncedDocuments.get(documentId);
+            if (baseVersion === undefined) {
+                await openSyncedDocument(event.document, languageInfo);
+                return;
+            }
+            if (event.document.version <= baseVersion) {
+                return; // Already covered by a full re-open
+            }
+
+            const res = await fetch(`${serverUrl}/documents/edit`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    documentId,
+                    baseVersion,
+                    version: event.document.version,
+                    changes: event.contentChanges.map(change => ({
+                        rangeOffset: change.rangeOffset,
+                        rangeLength: change.rangeLength,
+                        text: change.text
+                    }))
+                }),
+            });
+            if (res.ok) {
+                syncedDocuments.set(documentId, event.document.version);
+            } else {
+                // The server lost or diverged from our copy: send the full text again
+                await openSyncedDocument(event.document, languageInfo);
+            }
+        }).catch(error => {
+            console.error('Document sync error:', error);
+            syncedDocuments.delete(languageInfo.documentId);
+        });
+        return documentSync;
+    }
+
+    // Tell the server to drop documents the editor closed
+    context.subscriptions.push(
+        vscode.workspace.onDidCloseTextDocument(document => {
+            const documentId = document.uri.toString();
+            if (!syncedDocuments.delete(documentId) || !isConnected) return;
+            fetch(`${serverUrl}/documents/close`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ documentId }),
+            }).catch(error => console.error('Document close error:', error));
+        })
+    );
+
     // Handle user typing (and ghost suggestion logic)
     context.subscriptions.push(
         vscode.workspace.onDidChangeTextDocument(async (event) => {
             const editor = vscode.window.activeTextEditor;
+            if (editor && event.document !== editor.document) {
+                // Edits we don't forward would leave the server copy stale; re-open it next time
+                syncedDocuments.delete(event.document.uri.toString());
+            }
             if (!editor || event.document !== editor.document || !isConnected) return;
 
+            const languageInfo = getLanguageInfo(editor);
+            await syncDocumentChange(event, languageInfo);
+
             // Skip suggestion if just inserted
             if (isInsertingSuggestion) return;
 
             const position = editor.selection.active;
             const text = editor.document.getText(new vscode.Range(new vscode.Position(0, 0), position));
-            const languageInfo = getLanguageInfo(editor);
+            const cursorOffset = editor.document.offsetAt(position);
 
-            const suggestion = await debouncedGhostCompletion(text, languageInfo);
+            const suggestion = await debouncedGhostCompletion(text, languageInfo, cursorOffset);
             if (editor === vscode.window.activeTextEditor && suggestion) {
                 currentSuggestion = suggestion;
                 showSuggestion(editor, currentSuggestion);
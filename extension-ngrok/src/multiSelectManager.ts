@@ -141,20 +141,50 @@ export class MultiSelectManager {
                         selections: this._selections.map(s => ({
                             fileName: s.fileName,
                             text: s.text
-                        }))
+                        })),
+                        stream: 'jsonl'
                     })
                 });
                 
-                if (!response.ok) {
+                if (!response.ok || !response.body) {
                     throw new Error(`Server returned ${response.status}: ${response.statusText}`);
                 }
-                
-                const result = await response.json();
-                console.log('MultiSelectManager: Received analysis result');
-                
-                // Display results
+
+                // Each selection's analysis arrives as its own JSON line as soon as it is ready,
+                // followed by a final line with the cross-selection summary
                 outputChannel.appendLine('--- Analysis Results ---\n');
-                outputChannel.appendLine(result.analysis || "No analysis returned");
+                const total = this._selections.length;
+                let received = 0;
+                let summary = '';
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffered = '';
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) {
+                        break;
+                    }
+                    buffered += decoder.decode(value, { stream: true });
+                    const lines = buffered.split('\n');
+                    buffered = lines.pop() || '';
+                    for (const line of lines.filter(l => l.trim())) {
+                        const event = JSON.parse(line);
+                        if (event.error) {
+                            throw new Error(event.error);
+                        }
+                        if (event.done) {
+                            summary = event.summary || '';
+                            continue;
+                        }
+                        received++;
+                        progress.report({ message: `Analyzed ${received} of ${total} selections...` });
+                        outputChannel.appendLine(`## Selection ${event.selection}: ${event.fileName}\n`);
+                        outputChannel.appendLine(`${event.analysis || "No analysis returned"}\n`);
+                    }
+                }
+                console.log('MultiSelectManager: Received analysis result');
+                outputChannel.appendLine('## Summary\n');
+                outputChannel.appendLine(summary || "No summary returned");
                 
                 // Show completion message
                 vscode.window.showInformationMessage('Multi-selection analysis completed! Results in output panel.');
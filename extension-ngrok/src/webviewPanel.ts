@@ -105,6 +105,9 @@ export class WebviewPanel {
                 <script type="text/babel">
                     const { useState, useRef, useEffect } = React;
 
+                    // One server-side chat session per panel, so conversations don't mix
+                    const chatSessionId = \`chat-\${Date.now()}-\${Math.random().toString(36).slice(2)}\`;
+
                     // Simple Lucide Icons Components
                     const Send = ({ size = 20, className = "" }) => (
                         <svg className={\`lucide \${className}\`} width={size} height={size} viewBox="0 0 24 24">
@@ -170,7 +173,7 @@ export class WebviewPanel {
                                     headers: {
                                         'Content-Type': 'application/json'
                                     },
-                                    body: JSON.stringify({ prompt: currentPrompt })
+                                    body: JSON.stringify({ prompt: currentPrompt, sessionId: chatSessionId })
                                 });
 
                                 console.log('Response status:', response.status);